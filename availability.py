@@ -0,0 +1,198 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Works out who is away, e.g. on PTO, in the weeks being planned. Expected usage:
+
+busy = get_busy(addresses, time_min, time_max, get_service)  # or load_busy("availability.json")
+away = weeks_away(busy, MEMBERS, weeks)  # {week: ids of the people who are away}
+
+The busy times of everyone's calendar (get_address()) over the whole planning horizon come from a
+single free/busy query, or one batch of them for rosters of more than MAX_FREEBUSY_CALENDARS people.
+Free/busy only says when people are busy, not why: someone is away in a week if they are busy for at
+least AWAY_FRACTION of their WORKING_HOURS on AWAY_DAYS of its working days or more, so PTO and
+conferences count but meetings don't. People whose calendar can't be read are never away.
+
+The answers are cached in PATH_AVAILABILITY_CACHE for AVAILABILITY_TTL, per calendar, so running
+again (e.g. to plan a longer horizon) doesn't query the calendar again unless someone new needs to
+be looked up or the cached range doesn't cover the weeks being planned.
+
+Reading other people's calendars needs gcal.FREEBUSY_SCOPE, which the reminders don't, so it is
+only requested with --availability: the cached credentials have to be fetched again with it once.
+For tests and offline runs, --availability-file reads the busy times from a file instead, in the
+format of a free/busy response:
+
+{"calendars": {"bas@mozilla.com": {"busy": [{"start": "2024-03-04T00:00:00Z", "end": ...}]}}}
+"""
+
+from datetime import datetime, timedelta, timezone
+import json
+import logging
+import os
+
+from rotation import get_address, working_hours
+
+PATH_AVAILABILITY_CACHE = ".availability-cache.json"
+# Bumped when the layout of the cache changes.
+CACHE_VERSION = 1
+AVAILABILITY_TTL = timedelta(hours=12)
+# The free/busy query takes at most 50 calendars.
+MAX_FREEBUSY_CALENDARS = 50
+# Times to retry a free/busy query that fails with a transient error.
+QUERY_RETRIES = 5
+AWAY_DAYS = 3
+AWAY_FRACTION = 0.75
+
+logger = logging.getLogger()
+
+
+def _parse_time(value):
+    # fromisoformat() only understands "Z" from Python 3.11.
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def parse_calendars(calendars):
+    """Returns {address: [(start, end)]} for the "calendars" of a free/busy response, without the
+    calendars that have errors."""
+    busy = {}
+    for address, calendar in calendars.items():
+        if calendar.get("errors"):
+            reasons = ", ".join(e.get("reason", "unknown") for e in calendar["errors"])
+            logger.warning(f"Unable to get the availability of {address}: {reasons}")
+            continue
+        busy[address] = sorted(
+            (_parse_time(b["start"]), _parse_time(b["end"]))
+            for b in calendar.get("busy", [])
+        )
+    return busy
+
+
+def load_busy(path):
+    """Returns the busy times in the free/busy response saved at <path>: see parse_calendars()."""
+    with open(path) as f:
+        return parse_calendars(json.load(f)["calendars"])
+
+
+def query_busy(service, addresses, time_min, time_max):
+    """Returns the "calendars" of the free/busy responses for <addresses> between the datetimes
+    <time_min> and <time_max>."""
+    requests = [
+        service.freebusy().query(
+            body={
+                "timeMin": time_min.isoformat(),
+                "timeMax": time_max.isoformat(),
+                "items": [{"id": address} for address in addresses[i:i + MAX_FREEBUSY_CALENDARS]],
+            }
+        )
+        for i in range(0, len(addresses), MAX_FREEBUSY_CALENDARS)
+    ]
+    if len(requests) == 1:
+        return requests[0].execute(num_retries=QUERY_RETRIES)["calendars"]
+
+    calendars = {}
+    errors = []
+
+    def callback(request_id, response, error):
+        if error is None:
+            calendars.update(response["calendars"])
+        else:
+            errors.append(error)
+
+    batch = service.new_batch_http_request(callback=callback)
+    for request in requests:
+        batch.add(request)
+    batch.execute()
+    if errors:
+        raise errors[0]
+    return calendars
+
+
+def _load_cache(path):
+    try:
+        with open(path) as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError:
+        logger.warning(f"Ignoring unreadable availability cache {path}")
+        return {}
+    return cache["calendars"] if cache.get("version") == CACHE_VERSION else {}
+
+
+def _save_cache(path, calendars):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": CACHE_VERSION, "calendars": calendars}, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def get_busy(addresses, time_min, time_max, get_service, cache_path=PATH_AVAILABILITY_CACHE,
+             ttl=AVAILABILITY_TTL, now=None):
+    """Returns the busy times of <addresses> between the datetimes <time_min> and <time_max>: see
+    parse_calendars(). Calendars that were fetched less than <ttl> before <now> for a range that
+    covers this one are read from the cache at <cache_path>. The others are fetched with a
+    free/busy query with the service get_service() returns, which is only called then, and cached.
+    """
+    now = now or datetime.now(timezone.utc)
+    calendars = _load_cache(cache_path)
+
+    def is_fresh(calendar):
+        return (
+            now - _parse_time(calendar["fetched"]) < ttl
+            and _parse_time(calendar["timeMin"]) <= time_min
+            and _parse_time(calendar["timeMax"]) >= time_max
+        )
+
+    missing = [a for a in addresses if a not in calendars or not is_fresh(calendars[a])]
+    if missing:
+        print(f"Looking up the availability of {len(missing)} people")
+        fetched = query_busy(get_service(), missing, time_min, time_max)
+        for address in missing:
+            # Calendars the response leaves out are cached as free, like ones without events.
+            calendars[address] = dict(
+                fetched.get(address, {}),
+                fetched=now.isoformat(),
+                timeMin=time_min.isoformat(),
+                timeMax=time_max.isoformat(),
+            )
+        _save_cache(
+            cache_path,
+            {a: c for a, c in calendars.items() if now - _parse_time(c["fetched"]) < ttl},
+        )
+    return parse_calendars({a: calendars[a] for a in addresses})
+
+
+def time_range(weeks):
+    """Returns the datetimes between which to look up the availability for <weeks> (yyyy-mm-dd),
+    with a day to spare on either side for timezones far from UTC."""
+    first = datetime.strptime(min(weeks), "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    last = datetime.strptime(max(weeks), "%Y-%m-%d").replace(tzinfo=timezone.utc)
+    return first - timedelta(days=1), last + timedelta(days=6)
+
+
+def _busy_seconds(intervals, start, end):
+    return sum(max((min(e, end) - max(s, start)).total_seconds(), 0) for s, e in intervals)
+
+
+def _days_away(intervals, tz, monday):
+    days = 0
+    for day in range(5):
+        start, end = working_hours(tz, monday + timedelta(days=day))
+        if _busy_seconds(intervals, start, end) >= AWAY_FRACTION * (end - start).total_seconds():
+            days += 1
+    return days
+
+
+def weeks_away(busy, people, weeks):
+    """Returns {week: frozenset of the ids of <people> who are away that week} for each of <weeks>
+    (yyyy-mm-dd), given their <busy> times."""
+    away = {}
+    for week in weeks:
+        monday = datetime.strptime(week, "%Y-%m-%d").date()
+        away[week] = frozenset(
+            person.id
+            for person in people
+            if get_address(person) in busy
+            and _days_away(busy[get_address(person)], person.get_tz(), monday) >= AWAY_DAYS
+        )
+    return away
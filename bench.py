@@ -0,0 +1,279 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Benchmarks of generating, saving, loading and rendering rotations at scale. Expected usage:
+
+python bench.py  # compare with the baselines in BASELINES_PATH
+python bench.py --update  # save the results as the new baselines
+python bench.py --filter generate_rotation --threshold 0.5
+
+generate_rotation() is timed with synthetic rosters of ROSTER_SIZES people: the real MEMBERS,
+repeated with new ids for the larger sizes. save_rotations(), load_rotations() and generate_html()
+are timed with synthetic histories of HISTORY_SIZES weeks of the real MEMBERS, in a temporary
+directory. Each benchmark times --repeat runs and reports the median time per call, with the
+median absolute deviation of the runs as a measure of the noise, so the results show how each one
+scales.
+
+A benchmark fails, and the exit status is 1, if its median is more than --threshold slower than its
+baseline and the difference is also more than NOISE_FACTOR times the noise of the two, so that a
+noisy run doesn't fail it. Timings depend on the machine, so the baselines aren't part of the
+repository: save your own in BASELINES_PATH before making a change, on the machine you compare on.
+"""
+
+from datetime import timedelta
+from pathlib import Path
+import argparse
+import contextlib
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import timeit
+
+import rotation
+import sitegen
+
+# Local to the machine they were measured on: not committed.
+BASELINES_PATH = Path(__file__).parent / ".bench-baselines.json"
+ROSTER_SIZES = [24, 100, 1_000, 10_000]
+HISTORY_SIZES = [10, 1_000, 100_000]
+# Slowdown from the baseline that fails a benchmark, e.g. 0.25 for 25% slower.
+DEFAULT_THRESHOLD = 0.25
+# Runs of each benchmark, of which the median is reported.
+DEFAULT_REPEAT = 7
+# How many times the noise of the result and the baseline a slowdown has to exceed to fail.
+NOISE_FACTOR = 3
+
+
+def make_roster(size):
+    """Returns a roster of <size> people, starting with MEMBERS and repeating them with new ids."""
+    members = rotation.MEMBERS
+    roster = list(members[:size])
+    next_id = max(rotation.ROSTER) + 1
+    while len(roster) < size:
+        model = members[len(roster) % len(members)]
+        roster.append(
+            rotation.Person(
+                f"{model.name} {len(roster)}",
+                f"{model.nick}{len(roster)}",
+                model.geo,
+                model.lead,
+                tz=model.tz,
+                id=next_id,
+            )
+        )
+        next_id += 1
+    return roster
+
+
+def make_history(weeks, members, rng, index=None):
+    """Returns {week: Rotation} for <weeks> consecutive weeks of <members>, ending next week."""
+    leaders = [m for m in members if m.lead]
+    index = index if index is not None else rotation.RotationIndex(rotation.history_window(leaders))
+    history = {}
+    for i in range(weeks - 2, -2, -1):
+        week = rotation.get_week(rotation.DATE - timedelta(weeks=i))
+        try:
+            history[week] = rotation.generate_rotation(leaders, index, rng, members, week=week)
+        except IndexError:
+            # The random picks can run out of leaders: any rotation will do for a benchmark.
+            people = rng.sample(members, 3)
+            history[week] = rotation.Rotation(rng.choice(leaders), people[1:])
+        index.add(week, history[week])
+    return history
+
+
+@contextlib.contextmanager
+def _in_temporary_directory():
+    # The journal and the website are written relative to the working directory.
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as directory:
+        os.chdir(directory)
+        try:
+            yield Path(directory)
+        finally:
+            os.chdir(cwd)
+
+
+def _times(fn, repeat=DEFAULT_REPEAT):
+    """Returns the time per call of <fn> in each of <repeat> runs of at least 0.2 s."""
+    timer = timeit.Timer(fn)
+    number, taken = timer.autorange()
+    if number == 1:
+        # A single call already took 0.2 s or more: keep it as the first run.
+        return [taken] + timer.repeat(repeat=repeat - 1, number=1)
+    return [t / number for t in timer.repeat(repeat=repeat, number=number)]
+
+
+def bench_generate_rotation(size, repeat):
+    rng = random.Random(size)
+    members = make_roster(size)
+    leaders = [m for m in members if m.lead]
+    index = rotation.RotationIndex(rotation.history_window(leaders))
+    # Fill the window so the cooldowns exclude as many people as they would in practice.
+    make_history(rotation.history_window(leaders), members, rng, index)
+    return _times(lambda: rotation.generate_rotation(leaders, index, rng, members), repeat)
+
+
+def bench_get_week(size, repeat):
+    dates = [rotation.DATE + timedelta(days=i) for i in range(size)]
+    return [t / size for t in _times(lambda: [rotation.get_week(d) for d in dates], repeat)]
+
+
+def bench_save_rotations(weeks, repeat):
+    history = make_history(weeks, rotation.MEMBERS, random.Random(weeks))
+    with _in_temporary_directory():
+
+        def save():
+            rotation.SAVED_ROTATIONS_PATH.unlink(missing_ok=True)
+            rotation.save_rotations(history)
+
+        return _times(save, repeat)
+
+
+def bench_load_rotations(weeks, repeat):
+    history = make_history(weeks, rotation.MEMBERS, random.Random(weeks))
+    with _in_temporary_directory():
+        rotation.save_rotations(history)
+        return _times(rotation.load_rotations, repeat)
+
+
+def bench_load_recent_rotations(weeks, repeat):
+    # What main() reads: the last weeks of history, from the end of the journal.
+    history = make_history(weeks, rotation.MEMBERS, random.Random(weeks))
+    this_week = rotation.get_week(rotation.DATE)
+    with _in_temporary_directory():
+        rotation.save_rotations(history)
+        return _times(lambda: rotation.load_rotations(last=24, before=this_week), repeat)
+
+
+def bench_generate_html(weeks, repeat):
+    history = make_history(weeks, rotation.MEMBERS, random.Random(weeks))
+    with _in_temporary_directory() as directory:
+        manifest = directory / sitegen.OUTPUT_PATH / sitegen.MANIFEST_NAME
+
+        def render():
+            # Without the manifest every page is rendered again.
+            manifest.unlink(missing_ok=True)
+            rotation.generate_html(history)
+
+        # Rendering 100,000 weeks takes long enough that fewer runs are already stable.
+        return _times(render, min(repeat, 3))
+
+
+BENCHMARKS = {
+    "generate_rotation": (bench_generate_rotation, ROSTER_SIZES),
+    "get_week": (bench_get_week, [1_000]),
+    "save_rotations": (bench_save_rotations, HISTORY_SIZES),
+    "load_rotations": (bench_load_rotations, HISTORY_SIZES),
+    "load_recent_rotations": (bench_load_recent_rotations, HISTORY_SIZES),
+    "generate_html": (bench_generate_html, HISTORY_SIZES),
+}
+
+
+def run_benchmarks(names, repeat=DEFAULT_REPEAT):
+    """Yields (benchmark name, seconds per call in each of <repeat> runs) for the benchmarks in
+    <names>, at every size."""
+    for name in names:
+        fn, sizes = BENCHMARKS[name]
+        for size in sizes:
+            yield f"{name}[{size}]", fn(size, repeat)
+
+
+def summarize(times):
+    """Returns the median of <times> and their median absolute deviation, as a dict."""
+    median = statistics.median(times)
+    return {"median": median, "mad": statistics.median(abs(t - median) for t in times)}
+
+
+def is_slower(result, baseline, threshold):
+    """Returns whether <result> is slower than <baseline> (see summarize()) by more than <threshold>
+    and by more than the noise of the two."""
+    difference = result["median"] - baseline["median"]
+    return (
+        difference > threshold * baseline["median"]
+        and difference > NOISE_FACTOR * (result["mad"] + baseline["mad"])
+    )
+
+
+def _format_time(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("µs", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:.3g} {unit}"
+    return f"{seconds / 1e-9:.3g} ns"
+
+
+def _load_baselines():
+    try:
+        with BASELINES_PATH.open() as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        return {}
+    # Baselines saved before the noise was recorded can't be compared with.
+    return {name: b for name, b in baselines.items() if isinstance(b, dict)}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--filter", metavar="TEXT", help="Only run the benchmarks whose name contains TEXT"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help="Fail if a benchmark is this much slower than its baseline (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=DEFAULT_REPEAT,
+        help="Runs of each benchmark to take the median of (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--update", action="store_true", help=f"Save the results to {BASELINES_PATH.name}"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    # The website logs a warning for each asset it can't vendor: once is enough.
+    logging.getLogger().setLevel(logging.ERROR)
+    names = [n for n in BENCHMARKS if not args.filter or args.filter in n]
+    baselines = _load_baselines()
+    if not baselines and not args.update:
+        print(f"No baselines in {BASELINES_PATH}: run with --update first to compare with them")
+
+    results = {}
+    slower = []
+    for name, times in run_benchmarks(names, args.repeat):
+        result = results[name] = summarize(times)
+        timing = f"{_format_time(result['median']):>10} ± {_format_time(result['mad']):<9}"
+        baseline = baselines.get(name)
+        if baseline is None:
+            print(f"{name:32} {timing}".rstrip())
+            continue
+        change = result["median"] / baseline["median"] - 1
+        print(f"{name:32} {timing} {change:+7.1%} from {_format_time(baseline['median'])}")
+        if is_slower(result, baseline, args.threshold):
+            slower.append(name)
+
+    if args.update:
+        with BASELINES_PATH.open("w") as f:
+            json.dump(dict(baselines, **results), f, indent=1, sort_keys=True)
+            f.write("\n")
+        print(f"Saved the baselines to {BASELINES_PATH}")
+    elif slower:
+        sys.exit(
+            f"{len(slower)} benchmarks are more than {args.threshold:.0%} slower, beyond the "
+            f"noise: {', '.join(slower)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
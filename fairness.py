@@ -0,0 +1,61 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Metrics that score a planned schedule: lower scores are better. Expected usage:
+
+score = METRICS["combined"](members, history, plan)
+
+<members> is the current roster, <history> a dict of past rotations keyed by week and <plan> a list
+of (week, Rotation) pairs that follow the history. To add a metric, write a function with the same
+signature and register it in METRICS.
+"""
+
+from collections import Counter
+from statistics import pvariance
+
+# Number of weeks of history counted when balancing duties.
+FAIRNESS_WEEKS = 52
+
+# How much worse an uncovered geo is than one extra duty of imbalance in the combined metric.
+COVERAGE_WEIGHT = 0.5
+
+
+def _on_duty(rotation):
+    return [rotation.leader] + rotation.sheriffs
+
+
+def balance(members, history, plan):
+    """Returns the variance of the number of duties of each member across the history and the
+    plan, with leading counted separately from being on duty at all."""
+    duties = Counter()
+    leads = Counter()
+    for _, rotation in list(history.items()) + plan:
+        leads[rotation.leader.id] += 1
+        for person in _on_duty(rotation):
+            duties[person.id] += 1
+    leaders = [m for m in members if m.lead]
+    lead_variance = pvariance([leads[m.id] for m in leaders]) if leaders else 0
+    return pvariance([duties[m.id] for m in members]) + lead_variance
+
+
+def coverage(members, history, plan):
+    """Returns the number of planned weeks each geo of the roster has no one on duty, plus the
+    number of empty sheriff slots."""
+    geos = {m.geo for m in members}
+    uncovered = 0
+    for _, rotation in plan:
+        uncovered += len(geos - {p.geo for p in _on_duty(rotation)})
+        uncovered += max(2 - len(rotation.sheriffs), 0)
+    return uncovered
+
+
+def combined(members, history, plan):
+    return balance(members, history, plan) + COVERAGE_WEIGHT * coverage(members, history, plan)
+
+
+METRICS = {
+    "balance": balance,
+    "coverage": coverage,
+    "combined": combined,
+}
@@ -0,0 +1,413 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""A local stand-in for the parts of the Google Calendar API that gcal.py uses, to try sending
+reminders offline. Expected usage:
+
+python fake_gcal.py --port 8080 --latency 0.1 --error-rate 0.2  # serve until interrupted
+python fake_gcal.py --load-test 1000 --rate 100 --error-rate 0.1 --outage 2
+
+service = get_fake_calendar_service("http://localhost:8080/calendar/v3/")
+gcal.reconcile_triage_reminders(service, reminders)
+
+It keeps the events of every calendar in memory and supports inserting, updating, deleting and
+listing them, with sync tokens, like the real API: e.g. deleted events are kept as "cancelled" and
+their IDs can't be inserted again, and listed times are in CALENDAR_TIME_ZONE unless the request
+asks for another time zone. Each request waits for about --latency seconds, and requests
+fail like real ones do:
+- --error-rate: the fraction of requests that fail at random with one of --error-status.
+- --rate-limit: the requests per second above which requests fail with 429.
+- --outage: every request fails with 503 for that many seconds after the server starts.
+
+--load-test starts the server in this process, sends that many new events to it with
+gcal_dispatch.Dispatcher (without the retry queue) and prints the throughput, the number of
+attempts and what the server answered.
+"""
+
+from collections import Counter, deque
+from datetime import datetime, timezone
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from zoneinfo import ZoneInfo
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+import uuid
+
+import gcal_dispatch
+
+# The reasons the real API gives for these statuses.
+ERROR_REASONS = {
+    403: "rateLimitExceeded",
+    404: "notFound",
+    409: "duplicate",
+    410: "deleted",
+    429: "rateLimitExceeded",
+    500: "backendError",
+    503: "backendError",
+}
+DEFAULT_ERROR_STATUSES = [429, 500, 503]
+DEFAULT_MAX_RESULTS = 250
+# The time zone of every fake calendar: listed times are in it unless the request asks otherwise.
+CALENDAR_TIME_ZONE = "America/Toronto"
+
+
+def _error(status, message=None):
+    message = message or HTTPStatus(status).phrase
+    reason = ERROR_REASONS.get(status, "unknown")
+    return status, {
+        "error": {
+            "code": status,
+            "message": message,
+            "errors": [{"domain": "global", "reason": reason, "message": message}],
+        }
+    }
+
+
+def _in_time_zone(event, time_zone):
+    """Returns <event> with its times in <time_zone>, or in CALENDAR_TIME_ZONE like the real API
+    does without one, so that clients have to compare times rather than strings."""
+    event = dict(event)
+    zone = ZoneInfo(time_zone or CALENDAR_TIME_ZONE)
+    for key in ("start", "end"):
+        if "dateTime" in event.get(key, {}):
+            parsed = datetime.fromisoformat(event[key]["dateTime"].replace("Z", "+00:00"))
+            event[key] = dict(event[key], dateTime=parsed.astimezone(zone).isoformat())
+    return event
+
+
+class FakeCalendar:
+    """The events of every calendar. Each change is numbered, and sync tokens are the number of the
+    last change they include."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = {}  # calendar ID -> {event ID: event}
+        self.changed = {}  # (calendar ID, event ID) -> number of the last change to the event
+        self.last_change = 0
+
+    def _save(self, calendar_id, event):
+        self.last_change += 1
+        self.events.setdefault(calendar_id, {})[event["id"]] = event
+        self.changed[calendar_id, event["id"]] = self.last_change
+        return event
+
+    def insert(self, calendar_id, body):
+        with self.lock:
+            event_id = body.get("id") or uuid.uuid4().hex
+            if event_id in self.events.get(calendar_id, {}):
+                return _error(409, "The requested identifier already exists.")
+            event = dict(body, id=event_id, htmlLink=f"https://calendar.invalid/{event_id}")
+            event.setdefault("status", "confirmed")
+            return 200, self._save(calendar_id, event)
+
+    def update(self, calendar_id, event_id, body):
+        with self.lock:
+            current = self.events.get(calendar_id, {}).get(event_id)
+            if current is None:
+                return _error(404)
+            event = dict(body, id=event_id, htmlLink=current["htmlLink"])
+            event.setdefault("status", "confirmed")
+            return 200, self._save(calendar_id, event)
+
+    def delete(self, calendar_id, event_id):
+        with self.lock:
+            current = self.events.get(calendar_id, {}).get(event_id)
+            if current is None:
+                return _error(404)
+            if current["status"] == "cancelled":
+                return _error(410, "Resource has been deleted")
+            self._save(calendar_id, dict(current, status="cancelled"))
+            return 204, None
+
+    def list(self, calendar_id, query):
+        page_token = query.get("pageToken")
+        sync_token = query.get("syncToken")
+        max_results = int(query.get("maxResults", DEFAULT_MAX_RESULTS))
+        with self.lock:
+            if page_token:
+                offset, since, until = (int(n) for n in page_token.split(":"))
+            else:
+                offset, since, until = 0, 0, self.last_change
+                if sync_token:
+                    number = sync_token.removeprefix("fake")
+                    since = int(number) if number.isdigit() else -1
+                    if not 0 <= since <= self.last_change:
+                        return _error(410, "Sync token is no longer valid, a full sync is required")
+            events = sorted(
+                (changed, event_id)
+                for event_id in self.events.get(calendar_id, {})
+                if since < (changed := self.changed[calendar_id, event_id]) <= until
+            )
+            items = [
+                _in_time_zone(self.events[calendar_id][event_id], query.get("timeZone"))
+                for _, event_id in events
+            ]
+        if not sync_token and query.get("showDeleted") != "true":
+            # Incremental syncs always include the deleted events.
+            items = [event for event in items if event["status"] != "cancelled"]
+
+        response = {"kind": "calendar#events", "items": items[offset:offset + max_results]}
+        if offset + max_results < len(items):
+            response["nextPageToken"] = f"{offset + max_results}:{since}:{until}"
+        else:
+            response["nextSyncToken"] = f"fake{until}"
+        return 200, response
+
+
+class FakeCalendarServer(ThreadingHTTPServer):
+    """Serves a FakeCalendar at http://<address>/calendar/v3/, with the latency and errors in the
+    keyword arguments: see the top of the file."""
+
+    def __init__(
+        self,
+        address,
+        latency=0.0,
+        error_rate=0.0,
+        error_statuses=DEFAULT_ERROR_STATUSES,
+        rate_limit=None,
+        outage=0.0,
+        seed=None,
+    ):
+        super().__init__(address, FakeCalendarRequestHandler)
+        self.calendar = FakeCalendar()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses
+        self.rate_limit = rate_limit
+        self.outage_until = time.monotonic() + outage
+        self.rng = random.Random(seed)
+        self.statuses = Counter()  # of the responses sent
+        self._lock = threading.Lock()
+        self._recent = deque()  # times of the requests in the last second
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/calendar/v3/"
+
+    def _injected_error(self):
+        with self._lock:
+            now = time.monotonic()
+            if now < self.outage_until:
+                return _error(503)
+            if self.rate_limit:
+                while self._recent and self._recent[0] <= now - 1:
+                    self._recent.popleft()
+                if len(self._recent) >= self.rate_limit:
+                    return _error(429, "Rate Limit Exceeded")
+                self._recent.append(now)
+            if self.rng.random() < self.error_rate:
+                return _error(self.rng.choice(self.error_statuses))
+            latency = self.latency * self.rng.uniform(0.5, 1.5)
+        time.sleep(latency)
+        return None
+
+    def respond(self, method, path, body):
+        """Returns the (status, JSON response) to the request."""
+        response = self._injected_error() or self._route(method, path, body)
+        with self._lock:
+            self.statuses[response[0]] += 1
+        return response
+
+    def _route(self, method, path, body):
+        url = urllib.parse.urlsplit(path)
+        parts = [urllib.parse.unquote(p) for p in url.path.strip("/").split("/")]
+        query = dict(urllib.parse.parse_qsl(url.query))
+        match method, parts:
+            case "GET", ["calendar", "v3", "calendars", calendar_id, "events"]:
+                return self.calendar.list(calendar_id, query)
+            case "POST", ["calendar", "v3", "calendars", calendar_id, "events"]:
+                return self.calendar.insert(calendar_id, json.loads(body))
+            case "PUT", ["calendar", "v3", "calendars", calendar_id, "events", event_id]:
+                return self.calendar.update(calendar_id, event_id, json.loads(body))
+            case "DELETE", ["calendar", "v3", "calendars", calendar_id, "events", event_id]:
+                return self.calendar.delete(calendar_id, event_id)
+        return _error(404)
+
+
+class FakeCalendarRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length) if length else b""
+        status, response = self.server.respond(self.command, self.path, body)
+        content = b"" if response is None else json.dumps(response).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=UTF-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    do_POST = do_PUT = do_DELETE = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_calendar(host="localhost", port=0, **options):
+    """Starts a FakeCalendarServer with <options> in a background thread and returns it. Port 0
+    picks a free port: see FakeCalendarServer.url."""
+    server = FakeCalendarServer((host, port), **options)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get_fake_calendar_service(url):
+    """Returns a Google Calendar API object that sends its requests to the fake calendar at <url>,
+    without authenticating."""
+    from googleapiclient.discovery import build
+    import httplib2
+
+    return build(
+        "calendar",
+        "v3",
+        http=httplib2.Http(timeout=gcal_dispatch.TIMEOUT),
+        static_discovery=True,
+        cache_discovery=False,
+        client_options={"api_endpoint": url},
+    )
+
+
+def load_test(server, count, seed=None, **options):
+    """Sends <count> new events to <server> with a gcal_dispatch.Dispatcher with <options> and
+    prints the results."""
+    service = get_fake_calendar_service(server.url)
+    date = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    changes = [
+        gcal_dispatch.EventChange(
+            "insert",
+            "load-test",
+            f"loadtest{i:06d}",
+            date,
+            {"id": f"loadtest{i:06d}", "summary": f"Load test {i}"},
+            f"create event {i}",
+        )
+        for i in range(count)
+    ]
+    dispatcher = gcal_dispatch.Dispatcher(service, rng=random.Random(seed), **options)
+    start = time.perf_counter()
+    # Don't print a line for every request.
+    with open(os.devnull, "w") as devnull:
+        with contextlib.redirect_stdout(devnull), contextlib.redirect_stderr(devnull):
+            result = asyncio.run(dispatcher.run(changes))
+    elapsed = time.perf_counter() - start
+
+    print(
+        f"Made {len(result.done)} of {count} changes in {elapsed:.2f}s "
+        f"({len(result.done) / elapsed:.1f}/s) with {result.attempts} requests"
+    )
+    print(f"To retry on the next run: {len(result.queued)}, failed: {len(result.failed)}")
+    statuses = ", ".join(f"{status}: {n}" for status, n in sorted(server.statuses.items()))
+    print(f"The fake calendar answered {statuses}")
+    print(f"The fake calendar has {len(server.calendar.events.get('load-test', {}))} events")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--host", default="localhost", help="Address to listen on (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--port", type=int, default=8080, help="Port to listen on (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        metavar="SECONDS",
+        help="Average time to answer a request (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of the requests that fail at random (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--error-status",
+        type=lambda s: [int(status) for status in s.split(",")],
+        default=DEFAULT_ERROR_STATUSES,
+        help="Comma-separated statuses of the random failures (default: 429,500,503)",
+    )
+    parser.add_argument(
+        "--rate-limit", type=float, help="Fail the requests above this many per second with 429"
+    )
+    parser.add_argument(
+        "--outage",
+        type=float,
+        default=0.0,
+        metavar="SECONDS",
+        help="Fail every request with 503 for this long after starting",
+    )
+    parser.add_argument("--seed", type=int, help="Seed of the random failures and latencies")
+
+    load_test = parser.add_argument_group("load test")
+    load_test.add_argument(
+        "--load-test", type=int, metavar="N", help="Send N events to a fake calendar and exit"
+    )
+    load_test.add_argument(
+        "--concurrency",
+        type=int,
+        default=gcal_dispatch.DEFAULT_CONCURRENCY,
+        help="Requests to send at once (default: %(default)s)",
+    )
+    load_test.add_argument(
+        "--rate",
+        type=float,
+        default=gcal_dispatch.DEFAULT_RATE,
+        help="Requests to send per second (default: %(default)s)",
+    )
+    load_test.add_argument(
+        "--max-attempts",
+        type=int,
+        default=gcal_dispatch.DEFAULT_MAX_ATTEMPTS,
+        help="Attempts before a change is left for the next run (default: %(default)s)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    options = dict(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        error_statuses=args.error_status,
+        rate_limit=args.rate_limit,
+        outage=args.outage,
+        seed=args.seed,
+    )
+    if args.load_test is not None:
+        server = start_fake_calendar(args.host, 0, **options)
+        load_test(
+            server,
+            args.load_test,
+            seed=args.seed,
+            concurrency=args.concurrency,
+            rate=args.rate,
+            max_attempts=args.max_attempts,
+        )
+        server.shutdown()
+        return
+
+    server = FakeCalendarServer((args.host, args.port), **options)
+    print(f"Serving a fake Google Calendar API on {server.url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -6,7 +6,7 @@
 
 creds = auth_as_user()
 service = get_calendar_service(creds)
-send_triage_reminder(service, ...)
+send_triage_reminder(service, ...)  # or send_triage_reminders(service, [...]) for several reminders
 
 To use this API, you must:
 1. Create or reuse a Google Cloud Project with access to the Google Calendar API: we created the
@@ -61,15 +61,22 @@ from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from dataclasses import replace
+from datetime import datetime, timezone
 import json
 import os
 import os.path
 import sys
 
+import gcal_dispatch
+
 # List of scopes: https://developers.google.com/identity/protocols/oauth2/scopes#calendar
 # If these scopes are modified, users (including you) will need to delete the
 # PATH_CACHED_USER_SECRETS file.
 SCOPES = ["https://www.googleapis.com/auth/calendar.events"]
+# Needed on top of SCOPES to look up when people are busy (see availability.py). It's only requested
+# when that's used, because credentials fetched without it have to be fetched again.
+FREEBUSY_SCOPE = "https://www.googleapis.com/auth/calendar.readonly"
 
 # 'Performance Team' calendar ID.
 ID_CALENDAR = "mozilla.com_9bk5f2rqdeuip38jbeld84kpqc@group.calendar.google.com"
@@ -84,6 +91,21 @@ ENV_CACHED_USER_SECRETS = 'PERF_TRIAGE_BOT_CACHED_USER_SECRETS'
 
 IN_AUTOMATION = True if os.environ.get('CI') else False  # CI is always true on GitHub Actions.
 
+# Event IDs may only use base32hex characters (a-v and 0-9): see
+# https://developers.google.com/calendar/api/v3/reference/events/insert
+EVENT_ID_PREFIX = "perftriage"
+# The most events the Calendar API returns per page when listing events.
+MAX_LIST_RESULTS = 2500
+# Times to retry a list request that fails with a transient error (with googleapiclient's own
+# exponential backoff): the changes to make can't be known without it.
+LIST_RETRIES = 5
+
+# The sync token of the last time events were listed, and the triage reminder events at that time.
+# Keeping it between runs means only the events that changed since need to be fetched.
+PATH_SYNC_CACHE = ".gcal-sync-cache.json"
+# Bumped when the layout of the sync cache changes, e.g. since start times are kept in UTC.
+SYNC_CACHE_VERSION = 2
+
 DESCRIPTION = """{lead_sheriff} as Triage Sheriff #1, can you please take the lead to coordinate a date/time this week?
 
 For the latest guidelines, please see https://wiki.mozilla.org/Performance/Triage.
@@ -95,15 +117,15 @@ class CredentialException(Exception):
     pass
 
 
-def _fetch_cached_user_credentials():
+def _fetch_cached_user_credentials(scopes):
     log_prefix = 'Fetching cached user credentials from'
     env_secrets = os.environ.get(ENV_CACHED_USER_SECRETS)
     if env_secrets:
         print(f'{log_prefix} environment variable')
-        creds = Credentials.from_authorized_user_info(json.loads(env_secrets), SCOPES)
+        creds = Credentials.from_authorized_user_info(json.loads(env_secrets), scopes)
     elif os.path.exists(PATH_CACHED_USER_SECRETS):
         print(f'{log_prefix} local file')
-        creds = Credentials.from_authorized_user_file(PATH_CACHED_USER_SECRETS, SCOPES)
+        creds = Credentials.from_authorized_user_file(PATH_CACHED_USER_SECRETS, scopes)
     else:
         print('Cached user credentials not found')
         creds = None
@@ -111,7 +133,7 @@ def _fetch_cached_user_credentials():
 
 
 # via https://developers.google.com/calendar/api/quickstart/python
-def auth_as_user():
+def auth_as_user(scopes=SCOPES):
     """Prompt the user to authorize access to their calendars via a web browser and returns
     credentials on success. If this is called a second time, the user will not be prompted because a
     cached version will be used.
@@ -119,7 +141,7 @@ def auth_as_user():
     To call this API locally, you must get a PATH_GCLOUD_PROJECT_SECRETS: see the top-of-file
     comment.
     """
-    creds = _fetch_cached_user_credentials()
+    creds = _fetch_cached_user_credentials(scopes)
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
@@ -127,7 +149,7 @@ def auth_as_user():
             raise CredentialException(('Credentials unavailable for refresh. Credentials must be '
                                        'refetched manually and updated in secrets.'))
         else:
-            flow = InstalledAppFlow.from_client_secrets_file(PATH_GCLOUD_PROJECT_SECRETS, SCOPES)
+            flow = InstalledAppFlow.from_client_secrets_file(PATH_GCLOUD_PROJECT_SECRETS, scopes)
             creds = flow.run_local_server(port=0)
 
         if not IN_AUTOMATION:  # Don't save secrets to disk.
@@ -140,15 +162,26 @@ def auth_as_user():
 def get_calendar_service(creds):
     """Returns the Google Calendar API object."""
     try:
-        return build("calendar", "v3", credentials=creds)
+        # Use the discovery document bundled with googleapiclient rather than fetching it, and
+        # don't look for a discovery cache: it needs oauth2client, which we don't install.
+        return build(
+            "calendar", "v3", credentials=creds, static_discovery=True, cache_discovery=False
+        )
     except HttpError as error:
         print("Unable to fetch calendar service: {}".format(error), file=sys.stderr)
         raise error
 
 
-def send_triage_reminder(service, date, emails):
-    """Adds a triage reminder event to the Performance Team Google Calendar."""
-    details = {
+def get_event_id(date):
+    """Returns the ID of the triage reminder event for the week of <date> (yyyy-mm-dd). There is one
+    reminder per rotation week so sending the same reminder again is a no-op."""
+    year, week, _ = datetime.strptime(date, "%Y-%m-%d").isocalendar()
+    return "{}{:04d}{:02d}".format(EVENT_ID_PREFIX, year, week)
+
+
+def _get_event_details(date, emails):
+    return {
+        "id": get_event_id(date),
         "summary": "Reminder: perf triage rotation",
         "description": DESCRIPTION.format(lead_sheriff=emails[0]),
         "start": {
@@ -162,9 +195,225 @@ def send_triage_reminder(service, date, emails):
         "sendNotifications": True,  # send an "Invitation: ..." email to attendees.
     }
 
+
+def send_triage_reminder(service, date, emails, calendar_id=ID_CALENDAR, credentials=None):
+    """Adds a triage reminder event to the Performance Team Google Calendar."""
+    send_triage_reminders(service, [(date, emails)], calendar_id, credentials)
+
+
+def send_triage_reminders(service, reminders, calendar_id=ID_CALENDAR, credentials=None,
+                          queue_path=gcal_dispatch.PATH_RETRY_QUEUE):
+    """Adds a triage reminder event to the Performance Team Google Calendar for each (date, emails)
+    in <reminders>. Reminders that were already added are updated to <emails>.
+
+    The events are sent with gcal_dispatch like reconcile_triage_reminders() sends its changes, one
+    request each: a batch would save round trips but not quota, which counts every request in it,
+    and a failed batch couldn't be retried by event.
+    """
+    # Only one event can be added per week.
+    reminders = {get_event_id(date): (date, emails) for date, emails in reminders}
+    changes = [
+        gcal_dispatch.EventChange(
+            "insert", calendar_id, event_id, date, _get_event_details(date, emails),
+            f"create event for {date}",
+        )
+        for event_id, (date, emails) in reminders.items()
+    ]
+    _send_changes(service, changes, credentials, queue_path)
+
+
+def _utc_time(date_time):
+    """Returns <date_time>, an RFC 3339 time with any offset, in UTC: the API lists times in the
+    calendar's time zone unless asked otherwise, so the same time can be written several ways."""
+    if date_time is None:
+        return None
+    parsed = datetime.fromisoformat(date_time.replace("Z", "+00:00"))
+    return parsed.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _summarize_event(event):
+    """Returns the fields of a reminder event that reconcile_triage_reminders() compares."""
+    return {
+        "start": _utc_time(event.get("start", {}).get("dateTime")),
+        "attendees": sorted(a["email"] for a in event.get("attendees", [])),
+        "cancelled": event.get("status") == "cancelled",
+    }
+
+
+def _load_sync_cache(path, calendar_id):
     try:
-        event = service.events().insert(calendarId=ID_CALENDAR, body=details).execute()
-        print("Event created: {}".format(event.get("htmlLink")))
-    except HttpError as error:
-        print("Error when creating event: {}".format(error), file=sys.stderr)
-        raise error
+        with open(path) as f:
+            cache = json.load(f)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        print("Ignoring unreadable sync cache {}".format(path), file=sys.stderr)
+        return None
+    if cache.get("version") != SYNC_CACHE_VERSION or cache.get("calendarId") != calendar_id:
+        return None
+    return cache
+
+
+def _save_sync_cache(path, cache):
+    with open(path, "w") as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+
+
+def _list_changes(service, sync_token, calendar_id):
+    """Returns the events changed since <sync_token>, or every event if it is None, and the token to
+    pass next time. Raises HttpError with status 410 if <sync_token> has expired."""
+    events = []
+    page_token = None
+    while True:
+        response = service.events().list(
+            calendarId=calendar_id,
+            syncToken=sync_token,
+            pageToken=page_token,
+            showDeleted=True,
+            maxResults=MAX_LIST_RESULTS,
+            timeZone="UTC",
+        ).execute(num_retries=LIST_RETRIES)
+        events.extend(response.get("items", []))
+        page_token = response.get("nextPageToken")
+        if not page_token:
+            return events, response["nextSyncToken"]
+
+
+def _sync_reminder_events(service, cache_path, calendar_id):
+    """Returns the triage reminder events on the calendar as a dict of event ID to
+    _summarize_event(), updating the sync cache at <cache_path>."""
+    cache = _load_sync_cache(cache_path, calendar_id)
+    changes = None
+    if cache is not None:
+        try:
+            changes, sync_token = _list_changes(service, cache["syncToken"], calendar_id)
+            events = cache["events"]
+        except HttpError as error:
+            if error.resp.status != 410:
+                raise error
+            print("The calendar sync token expired")
+    if changes is None:
+        # Sync tokens can't be combined with filters (e.g. on the event ID) so the first sync, or
+        # the one after the token expires, has to list the whole calendar.
+        print("Listing every event on the calendar to get a new sync token")
+        changes, sync_token = _list_changes(service, None, calendar_id)
+        events = {}
+
+    for event in changes:
+        if event["id"].startswith(EVENT_ID_PREFIX):
+            events[event["id"]] = _summarize_event(event)
+    _save_sync_cache(
+        cache_path,
+        {
+            "version": SYNC_CACHE_VERSION,
+            "calendarId": calendar_id,
+            "syncToken": sync_token,
+            "events": events,
+        },
+    )
+    return events
+
+
+def _reminder_changes(service, reminders, cache_path, calendar_id):
+    """Returns the gcal_dispatch.EventChanges that make the reminders on <calendar_id> match
+    <reminders>: see reconcile_triage_reminders()."""
+    existing = _sync_reminder_events(service, cache_path, calendar_id)
+    wanted = {get_event_id(date): (date, emails) for date, emails in reminders.items()}
+    first = min(reminders) + "T" if reminders else None
+
+    changes = []
+    for event_id, (date, emails) in sorted(wanted.items()):
+        details = _get_event_details(date, emails)
+        current = existing.get(event_id)
+        if current is None:
+            changes.append(gcal_dispatch.EventChange(
+                "insert", calendar_id, event_id, date, details, f"create event for {date}"
+            ))
+        elif current != _summarize_event(details):
+            # Restores the event too if it was deleted from the calendar.
+            details["status"] = "confirmed"
+            changes.append(gcal_dispatch.EventChange(
+                "update", calendar_id, event_id, date, details, f"update event for {date}"
+            ))
+    for event_id, current in sorted(existing.items()):
+        if event_id in wanted or current["cancelled"] or first is None or current["start"] < first:
+            continue
+        date = current["start"][:10]
+        changes.append(gcal_dispatch.EventChange(
+            "delete", calendar_id, event_id, date, label=f"delete event for {date}"
+        ))
+    return changes
+
+
+def _send_changes(service, changes, credentials, queue_path, reconciled=None):
+    """Sends <changes> and the queued changes with a single gcal_dispatch.dispatch(). <reconciled>
+    is a dict of calendar ID to the earliest date <changes> were worked out from: they were worked
+    out from the calendar as it is now, so they supersede the queued changes to it from that date
+    on, e.g. a queued delete of an event that is wanted again."""
+    queued = []
+    superseded = 0
+    for change in gcal_dispatch.load_retry_queue(queue_path):
+        first = (reconciled or {}).get(change.calendar_id)
+        if first is not None and change.date >= first:
+            superseded += 1
+        else:
+            queued.append(change)
+    if superseded:
+        print("Not retrying {} queued changes: their calendars were reconciled again".format(
+            superseded
+        ))
+    result = gcal_dispatch.dispatch(service, changes, credentials, queue_path, queued=queued)
+    if result.queued:
+        print(
+            "{} changes failed and will be retried by the next run".format(len(result.queued)),
+            file=sys.stderr,
+        )
+    if result.failed:
+        raise result.failed[0][1]
+
+
+def reconcile_triage_reminders(service, reminders, cache_path=PATH_SYNC_CACHE,
+                               calendar_id=ID_CALENDAR, credentials=None,
+                               queue_path=gcal_dispatch.PATH_RETRY_QUEUE):
+    """Makes the triage reminder events on the Performance Team Google Calendar match <reminders>,
+    a dict of date (yyyy-mm-dd) to emails, and returns the number of events that were changed.
+
+    Only the events that changed since the last call are fetched, using the sync token kept at
+    <cache_path>, so a call with nothing to change costs a single list request. Missing reminders
+    are created, reminders with different attendees are updated and reminders on or after the
+    earliest date of <reminders> that aren't in it are deleted.
+
+    Changes are sent concurrently and retried with gcal_dispatch, authenticated with
+    <credentials>. The ones that still fail with transient errors are saved to the retry queue at
+    <queue_path>, and the next call works them out again or, for events before the earliest date of
+    its reminders, sends them again. The first other error is raised once every change was sent.
+    """
+    changes = _reminder_changes(service, reminders, cache_path, calendar_id)
+    reconciled = {calendar_id: min(reminders)} if reminders else {}
+    _send_changes(service, changes, credentials, queue_path, reconciled)
+    return len(changes)
+
+
+def reconcile_calendars(service, calendars, credentials=None,
+                        queue_path=gcal_dispatch.PATH_RETRY_QUEUE):
+    """Like reconcile_triage_reminders() for several calendars at once. <calendars> is a dict of
+    name to (calendar ID, reminders, sync cache path). The changes for every calendar are sent
+    together and share the same rate limit and retry queue, so the time it takes grows with the
+    number of changes, not with the number of calendars, apart from one list request per calendar.
+    Returns a dict of name to the number of events that were changed."""
+    changes = []
+    changed = {}
+    for name, (calendar_id, reminders, cache_path) in calendars.items():
+        calendar_changes = _reminder_changes(service, reminders, cache_path, calendar_id)
+        changes.extend(
+            replace(change, label=f"{name}: {change.label}")
+            for change in calendar_changes
+        )
+        changed[name] = len(calendar_changes)
+    reconciled = {
+        calendar_id: min(reminders)
+        for calendar_id, reminders, _ in calendars.values()
+        if reminders
+    }
+    _send_changes(service, changes, credentials, queue_path, reconciled)
+    return changed
@@ -0,0 +1,311 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Sends changes to Google Calendar events concurrently, retrying the ones that fail. Expected
+usage:
+
+changes = [EventChange("insert", calendar_id, event_id, "2024-03-04", body, "create event"), ...]
+result = dispatch(service, changes, credentials)
+
+Calendar requests fail now and then (rate limits, backend errors, timeouts) and a reminder is only
+useful the week it's for, so a change that fails is retried rather than dropped:
+- Up to DEFAULT_CONCURRENCY requests are sent at once from a thread pool, each thread with its own
+HTTP connection because httplib2 connections can't be shared between threads. A token bucket keeps
+them under DEFAULT_RATE requests per second.
+- A request that fails with a transient error (429, 5xx, a 403 rate limit or a network error) is
+retried up to DEFAULT_MAX_ATTEMPTS times, after an exponential backoff with full jitter so that the
+requests that failed together don't retry together.
+- Changes that still fail are saved to the retry queue at PATH_RETRY_QUEUE, and the next call to
+dispatch() sends them again, unless a newer change to the same event replaces them or the event is
+in the past.
+
+Errors that retrying won't fix, e.g. a 400, aren't queued: they are returned in
+DispatchResult.failed. fake_gcal.py serves a local stand-in for the Calendar API to try this
+offline.
+"""
+
+from dataclasses import asdict, dataclass, field, replace
+from datetime import datetime, timezone
+import asyncio
+import concurrent.futures
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+from googleapiclient.errors import HttpError
+import google_auth_httplib2
+import httplib2
+
+import instrument
+
+# Changes that failed with transient errors, to send again on the next run.
+PATH_RETRY_QUEUE = ".gcal-retry-queue.json"
+# Bumped when the layout of the retry queue changes.
+QUEUE_VERSION = 1
+
+DEFAULT_CONCURRENCY = 8
+# The Calendar API allows about 600 requests per minute per user by default: stay well under it.
+DEFAULT_RATE = 5.0
+DEFAULT_BURST = 10
+DEFAULT_MAX_ATTEMPTS = 6
+# Backoff before the nth retry: a random time up to BASE_DELAY * 2 ** (n - 1), and MAX_DELAY.
+BASE_DELAY = 0.5
+MAX_DELAY = 30.0
+# Seconds to wait for each HTTP response.
+TIMEOUT = 30
+
+TRANSIENT_STATUSES = {429, 500, 502, 503, 504}
+# The Calendar API also reports rate limits with 403, which otherwise means retrying won't help.
+RATE_LIMIT_REASONS = {"rateLimitExceeded", "userRateLimitExceeded"}
+
+
+@dataclass
+class EventChange:
+    """A change to the event <event_id> on <calendar_id>: "insert" it with <body>, "update" it to
+    <body> or "delete" it. <date> (yyyy-mm-dd) is the day of the event and <label> describes the
+    change in the output."""
+
+    action: str
+    calendar_id: str
+    event_id: str
+    date: str
+    body: dict = None
+    label: str = ""
+
+    def key(self):
+        return self.calendar_id, self.event_id
+
+    def request(self, service):
+        events = service.events()
+        if self.action == "insert":
+            return events.insert(calendarId=self.calendar_id, body=self.body)
+        if self.action == "update":
+            return events.update(calendarId=self.calendar_id, eventId=self.event_id, body=self.body)
+        if self.action == "delete":
+            return events.delete(calendarId=self.calendar_id, eventId=self.event_id)
+        raise ValueError(f"Unknown event change {self.action!r}")
+
+
+@dataclass
+class DispatchResult:
+    done: list = field(default_factory=list)  # EventChanges that were made
+    queued: list = field(default_factory=list)  # EventChanges to retry on the next run
+    failed: list = field(default_factory=list)  # (EventChange, error) that retrying won't fix
+    attempts: int = 0
+
+
+def _error_reasons(error):
+    try:
+        return {e.get("reason") for e in json.loads(error.content)["error"]["errors"]}
+    except (ValueError, KeyError, TypeError, AttributeError):
+        return set()
+
+
+def _status(error):
+    return error.resp.status if isinstance(error, HttpError) else None
+
+
+def is_transient(error):
+    """Returns whether the request that raised <error> may succeed if it's sent again."""
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        return status in TRANSIENT_STATUSES or (
+            status == 403 and bool(_error_reasons(error) & RATE_LIMIT_REASONS)
+        )
+    # Timeouts, refused or reset connections and failed DNS lookups.
+    return isinstance(error, (OSError, httplib2.HttpLib2Error))
+
+
+def backoff_delay(attempt, rng=random):
+    """Returns the seconds to wait before retrying a request that failed <attempt> times."""
+    return rng.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** (attempt - 1)))
+
+
+def _retry_after(error):
+    try:
+        return float(error.resp["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Lets acquire() return <rate> times per second on average, and up to <burst> times at once."""
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self._clock = clock
+        self._last = clock()
+
+    async def acquire(self):
+        while True:
+            now = self._clock()
+            self.tokens = min(self.burst, self.tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Dispatcher:
+    """Sends EventChanges with <service>, authenticated with <credentials> (None if the service
+    doesn't need any, like fake_gcal.py)."""
+
+    def __init__(
+        self,
+        service,
+        credentials=None,
+        concurrency=DEFAULT_CONCURRENCY,
+        rate=DEFAULT_RATE,
+        burst=DEFAULT_BURST,
+        max_attempts=DEFAULT_MAX_ATTEMPTS,
+        rng=random,
+    ):
+        self.service = service
+        self.credentials = credentials
+        self.concurrency = concurrency
+        self.rate = rate
+        self.burst = burst
+        self.max_attempts = max_attempts
+        self.rng = rng
+        self._local = threading.local()
+
+    def _http(self):
+        http = getattr(self._local, "http", None)
+        if http is None:
+            http = httplib2.Http(timeout=TIMEOUT)
+            if self.credentials is not None:
+                http = google_auth_httplib2.AuthorizedHttp(self.credentials, http=http)
+            self._local.http = http
+        return http
+
+    def _execute(self, change):
+        # Runs in a worker thread.
+        return change.request(self.service).execute(http=self._http())
+
+    async def run(self, changes):
+        """Sends <changes> and returns the DispatchResult. Nothing is saved to the retry queue: see
+        dispatch()."""
+        result = DispatchResult()
+        slots = asyncio.Semaphore(self.concurrency)
+        bucket = TokenBucket(self.rate, self.burst)
+        with concurrent.futures.ThreadPoolExecutor(self.concurrency) as executor:
+            await asyncio.gather(
+                *(self._send(change, executor, slots, bucket, result) for change in changes)
+            )
+        return result
+
+    async def _send(self, change, executor, slots, bucket, result):
+        loop = asyncio.get_running_loop()
+        attempt = 0
+        while True:
+            attempt += 1
+            result.attempts += 1
+            instrument.count("gcal_requests")
+            error = None
+            async with slots:
+                await bucket.acquire()
+                try:
+                    await loop.run_in_executor(executor, self._execute, change)
+                except Exception as e:
+                    error = e
+
+            if error is None:
+                print("Done: {}".format(change.label))
+                result.done.append(change)
+                return
+            status = _status(error)
+            if change.action == "insert" and status == 409:
+                # The ID is taken, maybe by a deleted event since their IDs can't be reused.
+                body = dict(change.body, status="confirmed")
+                change = replace(change, action="update", body=body)
+                continue
+            if change.action == "delete" and status in (404, 410):
+                print("Done (already deleted): {}".format(change.label))
+                result.done.append(change)
+                return
+            if not is_transient(error):
+                print("Error when trying to {}: {}".format(change.label, error), file=sys.stderr)
+                result.failed.append((change, error))
+                return
+            if attempt >= self.max_attempts:
+                print(
+                    "Giving up on trying to {} after {} attempts: {}".format(
+                        change.label, attempt, error
+                    ),
+                    file=sys.stderr,
+                )
+                result.queued.append(change)
+                return
+
+            delay = _retry_after(error) or backoff_delay(attempt, self.rng)
+            instrument.count("gcal_retries")
+            print(
+                "Retrying to {} in {:.1f}s: {}".format(change.label, delay, error), file=sys.stderr
+            )
+            await asyncio.sleep(delay)
+
+
+def load_retry_queue(path=PATH_RETRY_QUEUE):
+    """Returns the EventChanges saved to the retry queue at <path>."""
+    try:
+        with open(path) as f:
+            queue = json.load(f)
+    except FileNotFoundError:
+        return []
+    except ValueError:
+        print("Ignoring unreadable retry queue {}".format(path), file=sys.stderr)
+        return []
+    if queue.get("version") != QUEUE_VERSION:
+        print("Ignoring retry queue {} of another version".format(path), file=sys.stderr)
+        return []
+    return [EventChange(**change) for change in queue["changes"]]
+
+
+def save_retry_queue(changes, path=PATH_RETRY_QUEUE):
+    # Written to a temporary file first so that an interrupted run doesn't lose the queue.
+    tmp_path = "{}.tmp".format(path)
+    with open(tmp_path, "w") as f:
+        json.dump(
+            {"version": QUEUE_VERSION, "changes": [asdict(change) for change in changes]},
+            f,
+            indent=1,
+            sort_keys=True,
+        )
+    os.replace(tmp_path, path)
+
+
+def dispatch(service, changes, credentials=None, queue_path=PATH_RETRY_QUEUE, today=None,
+             queued=None, **options):
+    """Sends <changes> and the changes in the retry queue at <queue_path> with a Dispatcher, and
+    replaces the queue with the changes that failed with transient errors. Returns the
+    DispatchResult.
+
+    <queued> are the queued changes to send again, if the caller already loaded the queue with
+    load_retry_queue(). A change replaces a queued change to the same event. Queued changes to
+    events before <today> (yyyy-mm-dd, default: today in UTC) are dropped. <options> are passed on
+    to Dispatcher.
+    """
+    today = today or datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    if queued is None:
+        queued = load_retry_queue(queue_path)
+    pending = {}
+    for change in queued:
+        if change.date < today:
+            print("Not retrying to {}: the event is in the past".format(change.label))
+        else:
+            pending[change.key()] = change
+    if pending:
+        print("Retrying {} changes from {}".format(len(pending), queue_path))
+    for change in changes:
+        pending[change.key()] = change
+
+    result = asyncio.run(Dispatcher(service, credentials, **options).run(list(pending.values())))
+    save_retry_queue(result.queued, queue_path)
+    return result
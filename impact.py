@@ -0,0 +1,254 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Scores many bugs at once with the rules of the Performance Impact Calculator. Expected usage:
+
+python impact.py bugs.csv  # or bugs.json; prints id, score, impact and keywords as CSV
+python impact.py bugs.json --output scores.json
+
+Each bug lists the options selected in the calculator, using the names and values of the form
+fields (the same ones as in the calculator URL), e.g. {"id": 1234, "affects-browser": "startup",
+"platform-windows": "true"}. Radio buttons that aren't given keep the calculator's default and
+checkboxes are unchecked unless given as "true". In a CSV file each field is a column and empty
+cells are left out.
+
+The rules are read once from the data-* attributes of the inputs in templates/calculator.html into
+a RuleTable, and every bug is scored at once with NumPy. The arithmetic follows computeScore() in
+the calculator step by step, in the same order and with the same quirks, so the scores are
+identical to the calculator's, not just close:
+- Scores are summed and multiplied in document order, then each group in order of appearance.
+- A group's caps come from its first input. A missing data-group-max-* cap compares as null in
+JavaScript, so a positive group total is replaced by 0.
+
+This needs NumPy: pip install -r requirements-analysis.txt
+"""
+
+from dataclasses import dataclass, field
+from html.parser import HTMLParser
+from pathlib import Path
+import argparse
+import csv
+import json
+import sys
+
+import numpy as np
+
+CALCULATOR_PATH = Path(__file__).parent / "templates" / "calculator.html"
+ID_FIELD = "id"
+
+# (upper bound, impact) for the impact buckets, from computeScore(). A score of 0 has no impact.
+IMPACT_BUCKETS = [(10, "low"), (40, "medium"), (None, "high")]
+
+
+@dataclass
+class RuleTable:
+    """The scoring rules of the calculator: one entry per option (a checkbox, or one value of a
+    radio button), in document order."""
+
+    names: list = field(default_factory=list)  # form field of each option
+    values: list = field(default_factory=list)  # value the option submits
+    radio: list = field(default_factory=list)  # whether the option is a radio button value
+    default: list = field(default_factory=list)  # whether the option is checked by default
+    scored: list = field(default_factory=list)  # whether it has a basescore or a multiplier
+    basescores: list = field(default_factory=list)
+    multipliers: list = field(default_factory=list)
+    groups: list = field(default_factory=list)  # index into group_names, or -1
+    keywords: list = field(default_factory=list)  # tuple of keywords of each option
+    group_names: list = field(default_factory=list)
+    group_max_basescores: list = field(default_factory=list)
+    group_max_multipliers: list = field(default_factory=list)
+
+    def add(self, attrs):
+        if "name" not in attrs or attrs.get("type") not in ("checkbox", "radio"):
+            return
+        group = attrs.get("data-group")
+        if group is None:
+            group_index = -1
+        elif group in self.group_names:
+            group_index = self.group_names.index(group)
+        else:
+            group_index = len(self.group_names)
+            self.group_names.append(group)
+            # A missing cap is null in JavaScript, which compares like 0.
+            self.group_max_basescores.append(float(attrs.get("data-group-max-basescore", 0)))
+            self.group_max_multipliers.append(float(attrs.get("data-group-max-multiplier", 0)))
+
+        self.names.append(attrs["name"])
+        self.values.append(attrs.get("value", "on"))
+        self.radio.append(attrs["type"] == "radio")
+        self.default.append("checked" in attrs)
+        self.scored.append("data-basescore" in attrs or "data-multiplier" in attrs)
+        self.basescores.append(float(attrs.get("data-basescore", 0)))
+        self.multipliers.append(float(attrs.get("data-multiplier", 1)))
+        self.groups.append(group_index)
+        self.keywords.append(tuple(attrs.get("data-keywords", "").split()))
+
+    def fields(self):
+        """Returns the names of the form fields, in document order."""
+        return list(dict.fromkeys(self.names))
+
+
+class _RuleParser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.rules = RuleTable()
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "input":
+            self.rules.add(dict(attrs))
+
+
+def load_rules(path=CALCULATOR_PATH):
+    """Returns the RuleTable of the calculator page at <path>."""
+    parser = _RuleParser()
+    parser.feed(Path(path).read_text())
+    parser.close()
+    return parser.rules
+
+
+def encode_bugs(rules, bugs):
+    """Returns a boolean array [bug, option] of the options checked for each of <bugs>, a list of
+    dicts of form field to value. Raises ValueError for unknown fields or values."""
+    fields = rules.fields()
+    field_of_option = np.array([fields.index(name) for name in rules.names])
+    options = {(name, value): i for i, (name, value) in enumerate(zip(rules.names, rules.values))}
+
+    # Collect the options to check and check them all at once: indexing NumPy arrays one cell at a
+    # time is slow.
+    rows, columns = [], []
+    for row, bug in enumerate(bugs):
+        for name, value in bug.items():
+            i = options.get((name, value))
+            if i is None:
+                if name == ID_FIELD or value in (None, "", "false", False):
+                    continue  # Unchecked checkboxes; radio buttons have no "false" value.
+                i = options.get((name, str(value).lower() if value is True else str(value)))
+                if i is None:
+                    bug_id = bug.get(ID_FIELD, row)
+                    if name not in fields:
+                        raise ValueError(f"Unknown field {name!r} for bug {bug_id}")
+                    raise ValueError(f"Unknown value {value!r} for {name} in bug {bug_id}")
+            rows.append(row)
+            columns.append(i)
+
+    # Checking a radio button unchecks the other values of the field, like the calculator does.
+    given = np.zeros((len(bugs), len(fields)), dtype=bool)
+    given[rows, field_of_option[columns]] = True
+    checked = np.array(rules.default, dtype=bool) & ~given[:, field_of_option]
+    checked[rows, columns] = True
+    return checked
+
+
+def _impact(scores):
+    # Same comparisons as computeScore(), so e.g. negative scores would be low too.
+    conditions = [scores == 0] + [scores < upper for upper, _ in IMPACT_BUCKETS[:-1]]
+    names = ["none"] + [name for _, name in IMPACT_BUCKETS]
+    return np.select(conditions, names[:-1], default=names[-1])
+
+
+def score_bugs(rules, checked):
+    """Returns (scores, impacts, keywords) for the bugs in <checked> (see encode_bugs()): an array of
+    scores, an array of impact names and a list of the keywords of each bug."""
+    bugs = checked.shape[0]
+    basescore = np.zeros(bugs)
+    multiplier = np.ones(bugs)
+    group_basescores = np.zeros((len(rules.group_names), bugs))
+    group_multipliers = np.ones((len(rules.group_names), bugs))
+
+    # Add one option at a time across every bug so the floating point operations happen in the same
+    # order as in computeScore(). Unchecked options add 0 and multiply by 1, which is exact.
+    for i in range(len(rules.names)):
+        if not rules.scored[i]:
+            continue
+        on = checked[:, i]
+        base = np.where(on, rules.basescores[i], 0.0)
+        mult = np.where(on, rules.multipliers[i], 1.0)
+        group = rules.groups[i]
+        if group < 0:
+            basescore += base
+            multiplier *= mult
+        else:
+            group_basescores[group] += base
+            group_multipliers[group] *= mult
+
+    for group in range(len(rules.group_names)):
+        max_basescore = rules.group_max_basescores[group]
+        max_multiplier = rules.group_max_multipliers[group]
+        basescore += np.minimum(group_basescores[group], max_basescore)
+        multiplier *= np.minimum(group_multipliers[group], max_multiplier)
+
+    scores = basescore * multiplier
+    keywords = []
+    with_keywords = [i for i, k in enumerate(rules.keywords) if k]
+    for row in checked[:, with_keywords]:
+        found = dict.fromkeys(k for i, on in zip(with_keywords, row) if on for k in rules.keywords[i])
+        keywords.append(list(found))
+    return scores, _impact(scores), keywords
+
+
+def read_bugs(path):
+    """Returns the bugs in the JSON (a list of objects) or CSV file at <path>."""
+    with open(path, newline="") as f:
+        if str(path).endswith(".json"):
+            return json.load(f)
+        return list(csv.DictReader(f))
+
+
+def write_results(f, bugs, scores, impacts, keywords, as_json=False):
+    results = [
+        {
+            ID_FIELD: bug.get(ID_FIELD, row),
+            "score": float(score),
+            "impact": impact,
+            "keywords": bug_keywords,
+        }
+        for row, (bug, score, impact, bug_keywords) in enumerate(
+            zip(bugs, scores, impacts, keywords)
+        )
+    ]
+    if as_json:
+        json.dump(results, f, indent=1)
+        f.write("\n")
+        return
+    writer = csv.DictWriter(f, fieldnames=[ID_FIELD, "score", "impact", "keywords"])
+    writer.writeheader()
+    for result in results:
+        # Formatted like the calculator shows them.
+        writer.writerow(
+            dict(
+                result,
+                score=f"{result['score']:.2f}",
+                keywords=", ".join(result["keywords"]) or "(none)",
+            )
+        )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("bugs", help="JSON or CSV file of the options selected for each bug")
+    parser.add_argument("--output", help="Write to this file instead (JSON if it ends in .json)")
+    parser.add_argument(
+        "--calculator", default=CALCULATOR_PATH, help="Read the rules from this calculator page"
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    rules = load_rules(args.calculator)
+    bugs = read_bugs(args.bugs)
+    try:
+        checked = encode_bugs(rules, bugs)
+    except ValueError as error:
+        sys.exit(f"{args.bugs}: {error}")
+    results = score_bugs(rules, checked)
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            write_results(f, bugs, *results, as_json=args.output.endswith(".json"))
+    else:
+        write_results(sys.stdout, bugs, *results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Lightweight instrumentation of the phases of a run. Expected usage:
+
+start(trace_memory=True)
+with span("load"):
+    ...
+count("generate_rotation")
+observe("sheriff_candidates", len(pool))
+write_metrics("metrics.json")
+
+Each span records its wall and CPU time and, if memory is traced, the peak of the memory allocated
+by Python while it ran, including what was already allocated when it started (with tracemalloc,
+which slows allocations down, so it is off by default).
+Spans can be nested. Counters and observations are cheap enough to leave in hot code: an
+observation keeps the count, total, min and max of the values, not the values themselves.
+
+Only the current process is instrumented: work done in a process pool isn't counted.
+"""
+
+from datetime import datetime, timezone
+import contextlib
+import json
+import sys
+import time
+import tracemalloc
+
+# Bumped when the layout of the metrics file changes.
+METRICS_VERSION = 1
+
+_spans = []  # finished spans, in the order they started
+_stack = []  # peak memory seen so far by each of the open spans
+_counters = {}
+_observations = {}  # name -> [count, total, min, max]
+_started = None
+
+
+def start(trace_memory=False):
+    """Starts a new set of metrics, tracing memory allocations if <trace_memory>."""
+    global _started
+    _spans.clear()
+    _counters.clear()
+    _observations.clear()
+    _started = datetime.now(timezone.utc)
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+@contextlib.contextmanager
+def span(name):
+    """Times the code in the with block as the phase <name>."""
+    record = {"name": name, "depth": len(_stack)}
+    _spans.append(record)
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        # Hand the peak so far to the enclosing span before measuring this one on its own.
+        if _stack:
+            _stack[-1] = max(_stack[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+    _stack.append(0)
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        record["wall_s"] = time.perf_counter() - wall
+        record["cpu_s"] = time.process_time() - cpu
+        peak = max(_stack.pop(), tracemalloc.get_traced_memory()[1]) if tracing else None
+        record["peak_bytes"] = peak
+        if tracing and _stack:
+            _stack[-1] = max(_stack[-1], peak)
+
+
+def count(name, n=1):
+    """Adds <n> to the counter <name>."""
+    _counters[name] = _counters.get(name, 0) + n
+
+
+def observe(name, value):
+    """Records <value> as one observation of <name>, e.g. the size of a candidate pool."""
+    stats = _observations.get(name)
+    if stats is None:
+        _observations[name] = [1, value, value, value]
+    else:
+        stats[0] += 1
+        stats[1] += value
+        stats[2] = min(stats[2], value)
+        stats[3] = max(stats[3], value)
+
+
+def _max_rss_bytes():
+    try:
+        import resource
+    except ImportError:
+        return None  # Not on Windows.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def metrics():
+    """Returns the metrics recorded since start(), as a dict that can be saved as JSON."""
+    return {
+        "version": METRICS_VERSION,
+        "started": _started.isoformat() if _started else None,
+        "argv": sys.argv,
+        "spans": _spans,
+        "counters": dict(_counters),
+        "observations": {
+            name: {"count": n, "mean": total / n, "min": low, "max": high}
+            for name, (n, total, low, high) in _observations.items()
+        },
+        "max_rss_bytes": _max_rss_bytes(),
+    }
+
+
+def write_metrics(path):
+    with open(path, "w") as f:
+        json.dump(metrics(), f, indent=1)
+        f.write("\n")
@@ -0,0 +1,141 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""An append-only journal of weekly records. Expected usage:
+
+append_weeks(path, [{"week": "2022-08-08", ...}, ...])
+recent = read_weeks(path, last=4)
+
+The journal is a UTF-8 text file with one JSON object per line. The first line is a header that
+records the format version; every following line is the record for a single week and must have a
+"week" key. New weeks are appended to the end of the file so existing history is never rewritten,
+and the most recent weeks are read by seeking backwards from the end of the file so their cost does
+not depend on how much history there is.
+
+Records are expected to be appended in week order. A week may be appended more than once (e.g.
+when a rotation is regenerated with --force): the last record for a week supersedes earlier ones.
+
+When the record format changes, VERSION is bumped and journals written with an older version are
+migrated by the caller: read_weeks(path, version=old) and rewrite_weeks() with the new records. This
+is the only time a journal is rewritten, and it is replaced atomically.
+"""
+
+import json
+import os
+
+FORMAT = "perf-triage-journal"
+VERSION = 2
+
+# How much of the file is read at a time when scanning backwards from the end.
+_BLOCK_SIZE = 16 * 1024
+
+
+class JournalError(Exception):
+    pass
+
+
+def _encode(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+def _read_header(f, path, version=VERSION):
+    """Validates the header at the start of <f> and leaves <f> positioned on the first record."""
+    line = f.readline()
+    try:
+        header = json.loads(line)
+    except ValueError:
+        header = None
+    if not isinstance(header, dict) or header.get("format") != FORMAT:
+        raise JournalError(f"{path} is not a rotation journal")
+    if version is not None and header.get("version") != version:
+        raise JournalError(f"{path} has unsupported journal version {header.get('version')}")
+    return header
+
+
+def _lines_reversed(f, start):
+    """Yields the non-empty lines of <f> from the end of the file back to offset <start>."""
+    position = f.seek(0, os.SEEK_END)
+    partial = b""
+    while position > start:
+        size = min(_BLOCK_SIZE, position - start)
+        position -= size
+        f.seek(position)
+        lines = (f.read(size) + partial).split(b"\n")
+        # The first piece may be the tail end of a line that starts in an earlier block.
+        partial = lines.pop(0)
+        for line in reversed(lines):
+            if line:
+                yield line
+    if partial:
+        yield partial
+
+
+def read_version(path):
+    """Returns the format version of the journal at <path>."""
+    with open(path, "rb") as f:
+        return _read_header(f, path, version=None).get("version")
+
+
+def read_weeks(path, last=None, before=None, since=None, version=VERSION):
+    """Returns the records in the journal at <path> as a dict keyed by week, in week order.
+
+    If <last> is given, only the records for the <last> most recent weeks are read. If <before> is
+    also given, every week from <before> on is read in addition to the <last> weeks before it. If
+    <since> is given, only the weeks from <since> on are read, from the end of the journal.
+    Raises FileNotFoundError if there is no journal at <path> and JournalError if it isn't in
+    format <version>.
+    """
+    records = {}
+    older = 0
+    with open(path, "rb") as f:
+        _read_header(f, path, version)
+        if last is None and since is None:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    records[record["week"]] = record
+        else:
+            for line in _lines_reversed(f, f.tell()):
+                if last is not None and older >= last:
+                    break
+                record = json.loads(line)
+                week = record["week"]
+                if since is not None and week < since:
+                    break
+                # Reading backwards, the first record seen for a week is the one that wins.
+                if week not in records:
+                    records[week] = record
+                    if before is None or week < before:
+                        older += 1
+    return dict(sorted(records.items()))
+
+
+def iter_records(path, version=VERSION):
+    """Yields the records in the journal at <path> in the order they were appended, including the
+    ones superseded by later records, without reading the whole file at once."""
+    # Text mode decodes faster than json.loads() detecting the encoding of every line.
+    with open(path, encoding="utf-8") as f:
+        _read_header(f, path, version)
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def append_weeks(path, records):
+    """Appends <records> to the journal at <path>, creating it if it doesn't exist yet."""
+    if not records:
+        return
+    with open(path, "ab") as f:
+        if f.tell() == 0:
+            f.write(_encode({"format": FORMAT, "version": VERSION}))
+        f.write(b"".join(_encode(record) for record in records))
+
+
+def rewrite_weeks(path, records):
+    """Replaces the journal at <path> with one in the current format that holds <records>."""
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_encode({"format": FORMAT, "version": VERSION}))
+        f.write(b"".join(_encode(record) for record in records))
+    os.replace(tmp, path)
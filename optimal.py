@@ -0,0 +1,149 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""A scheduler that balances how often each person is on duty, as an alternative to the random
+picks in generate_rotation(). Expected usage:
+
+for week, rotation in plan_rotations(leaders, members, index, weeks, history):
+    ...
+
+It follows the same constraints as generate_rotation(): recent leaders can't lead again for
+len(leaders) // 2 weeks, nobody is picked within SHERIFF_COOLDOWN weeks of being on duty, and
+sheriffs are paired according to the working hours they share (see OverlapMatrix).
+
+If nobody can lead a week within those constraints, plan_rotations() raises IndexError like
+generate_rotation() does. Within those constraints, each week is the cheapest choice: the leader is
+the eligible lead who has led the least, and the sheriffs are the pair with the fewest duties
+between them. A lead who is behind on leading costs more as a sheriff, so they stay free to lead.
+Ties go to whoever has been off duty the longest, then are broken randomly. Whether a pair is valid
+only depends on their timezones, so only the two cheapest candidates of each timezone can be part
+of the cheapest valid pair and finding it costs the same however large the roster is once the
+candidates are bucketed.
+"""
+
+from collections import Counter
+import heapq
+import itertools
+import logging
+import random
+
+from rotation import Rotation, SHERIFF_COOLDOWN, get_overlap_matrix
+
+logger = logging.getLogger()
+
+
+class _Load:
+    """How many times each person has been on duty, and when they were last on duty."""
+
+    def __init__(self):
+        self.leads = Counter()
+        self.most_leads = 0
+        self.duties = Counter()
+        self.last_duty = {}
+        self.position = 0
+
+    def lead_debt(self, person):
+        """Returns how many times <person> would need to lead to catch up with the top leader."""
+        return self.most_leads - self.leads[person.id]
+
+    def add(self, rotation):
+        self.leads[rotation.leader.id] += 1
+        self.most_leads = max(self.most_leads, self.leads[rotation.leader.id])
+        for person in [rotation.leader] + rotation.sheriffs:
+            self.duties[person.id] += 1
+            self.last_duty[person.id] = self.position
+        self.position += 1
+
+
+def _pick_leader(leaders, index, load, rng, away):
+    cooldown = len(leaders) // 2
+    candidates = [
+        p
+        for p in leaders
+        if p.id not in away
+        and not index.led_within(p, cooldown)
+        and not index.sheriffed_within(p, SHERIFF_COOLDOWN)
+    ]
+    if not candidates:
+        # Like generate_rotation(), don't break the rules to find a leader: plan_candidate() gives
+        # up on the plan.
+        raise IndexError("No eligible leader")
+    return min(
+        candidates,
+        key=lambda p: (
+            load.leads[p.id],
+            load.duties[p.id],
+            load.last_duty.get(p.id, -1),
+            rng.random(),
+        ),
+    )
+
+
+def _pick_sheriffs(members, leader, index, load, rng, away, week):
+    buckets = {}
+    for person in members:
+        if person == leader or person.id in away:
+            continue
+        if index.led_within(person, SHERIFF_COOLDOWN) or index.sheriffed_within(
+            person, SHERIFF_COOLDOWN
+        ):
+            continue
+        cost = (
+            load.duties[person.id] + (load.lead_debt(person) if person.lead else 0),
+            load.last_duty.get(person.id, -1),
+            rng.random(),
+        )
+        buckets.setdefault(person.get_tz(), []).append((cost, person))
+
+    candidates = []
+    for bucket in buckets.values():
+        candidates.extend(heapq.nsmallest(2, bucket, key=lambda c: c[0]))
+    if len(candidates) < 2:
+        return [person for _, person in candidates]
+
+    overlap = get_overlap_matrix(frozenset(buckets) | {leader.get_tz()}, week)
+
+    def can_join(picked, person):
+        timezones = overlap.allowed(picked)
+        return timezones is None or person.get_tz() in timezones
+
+    best = None
+    for (a_cost, a), (b_cost, b) in itertools.combinations(candidates, 2):
+        if not (
+            can_join([leader], a)
+            and can_join([leader, a], b)
+            or can_join([leader], b)
+            and can_join([leader, b], a)
+        ):
+            continue
+        cost = tuple(x + y for x, y in zip(a_cost, b_cost))
+        if best is None or cost < best[0]:
+            best = (cost, sorted([(a_cost, a), (b_cost, b)], key=lambda c: c[0]))
+    if best is None:
+        # No valid pair: settle for the cheapest single sheriff, like generate_rotation() would.
+        return [min((c for c in candidates if can_join([leader], c[1])), key=lambda c: c[0])[1]]
+    return [person for _, person in best[1]]
+
+
+def plan_rotations(leaders, members, index, weeks, history=None, rng=random, away=None):
+    """Generates a rotation for each of <weeks>, in order, yielding (week, Rotation) pairs.
+
+    <history> is a dict of past rotations keyed by week that is counted when balancing duties.
+    <away> is a dict of week to the ids of the people who are away that week, who aren't picked.
+    Each rotation is added to <index> before the next one is generated.
+    """
+    load = _Load()
+    for _, rotation in sorted((history or {}).items()):
+        load.add(rotation)
+
+    for week in weeks:
+        week_away = (away or {}).get(week, frozenset())
+        leader = _pick_leader(leaders, index, load, rng, week_away)
+        logger.debug(f"Picked {leader} as leader ({load.leads[leader.id]} times before)")
+        sheriffs = _pick_sheriffs(members, leader, index, load, rng, week_away, week)
+        logger.debug(f"Picked {sheriffs} as sheriffs")
+        rotation = Rotation(leader, sheriffs)
+        index.add(week, rotation)
+        load.add(rotation)
+        yield week, rotation
@@ -0,0 +1,306 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""The publish stage of the website: turns rendered pages into the files served from docs/.
+Expected usage (sitegen.py does this for every page):
+
+assets = build_assets(template_sources)
+html = finalize_page(html, assets, root)
+write_compressed(output / "index.html", html.encode())
+
+- Stylesheets and scripts the templates load from the CDN are vendored: they are downloaded once to
+VENDOR_PATH and checked against the integrity hash in the template.
+- Stylesheets are purged of the rules for classes that no template mentions, which removes most of
+Bootstrap.
+- Assets are written to ASSETS_DIR under a name that includes a hash of their content, so they can be
+cached forever, and pages link to them instead of to the CDN.
+- Pages are minified and every file gets precompressed .gz and .br copies next to it for hosts that
+serve them. The .br copies need the optional Brotli package.
+
+If an asset can't be downloaded (e.g. offline), pages keep loading it from the CDN.
+"""
+
+from pathlib import Path
+import base64
+import functools
+import gzip
+import hashlib
+import logging
+import os
+import re
+import urllib.request
+
+VENDOR_PATH = Path(__file__).parent / "vendor"
+# Directory of the hashed assets, relative to the output directory.
+ASSETS_DIR = "assets"
+
+# Classes that are only added by Bootstrap's JavaScript, so they don't appear in the templates.
+SAFELIST_PREFIXES = ("tooltip", "bs-tooltip", "fade", "show")
+
+# Tags that whitespace around can be dropped without changing how the page renders.
+BLOCK_TAGS = {
+    "html", "head", "body", "meta", "link", "title", "script", "style", "div", "header", "nav",
+    "ul", "ol", "li", "form", "h1", "h2", "h3", "h4", "h5", "h6", "p", "pre", "svg", "path",
+    "use",
+}
+
+logger = logging.getLogger()
+
+_CDN_TAG = re.compile(
+    r'<(?:link|script)\b[^>]*?\b(?:href|src)="(https://cdn\.jsdelivr\.net/npm/([^"]+))"[^>]*>',
+)
+_INTEGRITY = re.compile(r'\bintegrity="(sha\d+)-([^"]+)"')
+_TAG_THEN_TAG = re.compile(r"(<(/?)([a-zA-Z][\w-]*)[^<>]*>) (?=<(/?)([a-zA-Z][\w-]*))")
+_RAW_ELEMENT = re.compile(r"(<(script|style|pre|textarea)\b[^>]*>)(.*?)(</\2>)", re.S | re.I)
+
+
+def find_cdn_assets(sources):
+    """Returns {url: integrity} for the CDN stylesheets and scripts loaded by <sources>, the text of
+    the templates."""
+    assets = {}
+    for source in sources:
+        for match in _CDN_TAG.finditer(source):
+            integrity = _INTEGRITY.search(match.group(0))
+            assets[match.group(1)] = integrity.groups() if integrity else None
+    return assets
+
+
+def _matches(content, integrity):
+    algorithm, expected = integrity
+    return base64.b64encode(hashlib.new(algorithm, content).digest()).decode() == expected
+
+
+def fetch_vendored(url, integrity):
+    """Returns the content of <url>, downloading it to VENDOR_PATH the first time. Raises ValueError
+    if it doesn't match <integrity>, an (algorithm, base64 digest) pair, and OSError if it can't
+    be downloaded. A vendored copy that doesn't match <integrity> is downloaded again."""
+    path = VENDOR_PATH / url.split("/npm/", 1)[1]
+    if path.exists():
+        content = path.read_bytes()
+        if not integrity or _matches(content, integrity):
+            return content
+        logger.warning(f"{path} doesn't match its integrity hash: downloading it again")
+
+    logger.debug(f"Downloading {url} to {path}")
+    with urllib.request.urlopen(url, timeout=30) as response:
+        content = response.read()
+    if integrity and not _matches(content, integrity):
+        raise ValueError(f"{url} doesn't match its integrity hash")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Written to a temporary file first so that builds running in parallel (see teams.py) never
+    # see a partly written copy.
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp_path.write_bytes(content)
+    os.replace(tmp_path, path)
+    return content
+
+
+def _split_top_level(text, separator):
+    """Splits <text> on <separator> outside of parentheses, brackets and strings."""
+    parts, depth, quote, start = [], 0, None, 0
+    for i, c in enumerate(text):
+        if quote:
+            quote = None if c == quote else quote
+        elif c in "\"'":
+            quote = c
+        elif c in "([":
+            depth += 1
+        elif c in ")]":
+            depth -= 1
+        elif c == separator and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+    parts.append(text[start:])
+    return parts
+
+
+def _parse_css(css, i=0):
+    """Parses the rules of <css> from offset <i> up to the closing brace of the enclosing block (or
+    the end) and returns (rules, offset after the block). Each rule is (prelude, body) where body
+    is the declarations or, for at-rules like @media that contain rules, a list of rules."""
+    rules = []
+    start = i
+    quote = None
+    while i < len(css):
+        c = css[i]
+        if quote:
+            quote = None if c == quote else quote
+        elif c in "\"'":
+            quote = c
+        elif css.startswith("/*", i):
+            end = css.index("*/", i) + 2
+            if css.startswith("/*!", i):
+                rules.append((css[i:end], None))  # Keep license comments.
+            i = start = end
+            continue
+        elif c == ";" and css[start:i].strip().startswith("@"):
+            rules.append((css[start:i + 1].strip(), None))  # e.g. @charset "UTF-8";
+            start = i + 1
+        elif c == "{":
+            prelude = css[start:i].strip()
+            if re.match(r"@(media|supports|container|layer|keyframes|-webkit-keyframes)\b", prelude):
+                body, i = _parse_css(css, i + 1)
+            else:
+                end = i + 1
+                while css[end] != "}":
+                    end += 1
+                body, i = css[i + 1:end], end + 1
+            rules.append((prelude, body))
+            start = i
+            continue
+        elif c == "}":
+            return rules, i + 1
+        i += 1
+    return rules, i
+
+
+def _selector_used(selector, tokens):
+    # Classes in :not() don't need to be used for the selector to match.
+    selector = re.sub(r":not\([^)]*\)", "", selector)
+    for name in re.findall(r"\.(-?[_a-zA-Z][\w-]*)", selector):
+        if name not in tokens and not name.startswith(SAFELIST_PREFIXES):
+            return False
+    return True
+
+
+def _purge_rules(rules, tokens):
+    kept = []
+    for prelude, body in rules:
+        if body is None:
+            kept.append(prelude)
+        elif re.match(r"@(-webkit-)?keyframes\b", prelude):
+            # Animations are only used by the classes that name them.
+            if prelude.split()[-1] in tokens:
+                kept.append(prelude + "{" + "".join(_purge_rules(body, tokens)) + "}")
+        elif isinstance(body, list):
+            nested = _purge_rules(body, tokens)
+            if nested:
+                kept.append(prelude + "{" + "".join(nested) + "}")
+        elif prelude.startswith("@"):
+            kept.append(prelude + "{" + body + "}")
+        else:
+            selectors = [s for s in _split_top_level(prelude, ",") if _selector_used(s, tokens)]
+            if selectors:
+                kept.append(",".join(selectors) + "{" + body + "}")
+    return kept
+
+
+def purge_css(css, sources):
+    """Returns <css> without the rules whose selectors only match classes that don't appear in
+    <sources>, the text of the templates. Any word in a template counts as used, so classes added
+    from inline scripts are kept too."""
+    tokens = set()
+    for source in sources:
+        tokens.update(re.findall(r"[\w-]+", source))
+    rules, _ = _parse_css(css)
+    return "\n".join(_purge_rules(rules, tokens)) + "\n"
+
+
+def _minify_script(script):
+    lines = (line.strip() for line in script.splitlines())
+    return "\n".join(line for line in lines if line and not line.startswith("//"))
+
+
+def _collapse_whitespace(html):
+    html = re.sub(r"<!--(?!\[if).*?-->", "", html, flags=re.S)
+    html = re.sub(r"\s+", " ", html)
+
+    def between_tags(match):
+        if match.group(3).lower() in BLOCK_TAGS or match.group(5).lower() in BLOCK_TAGS:
+            return match.group(1)
+        return match.group(0)
+
+    return _TAG_THEN_TAG.sub(between_tags, html)
+
+
+def minify_html(html):
+    """Returns <html> without comments and with the whitespace between tags collapsed. Whitespace in
+    <pre> and <textarea> is kept; inline scripts only lose indentation and comment lines."""
+    raw = []
+
+    def set_aside(match):
+        content = match.group(3)
+        if match.group(2).lower() == "script":
+            content = _minify_script(content)
+        raw.append(match.group(1) + content + match.group(4))
+        # Leave an empty element of the same kind so whitespace around it is handled the same.
+        return f'<{match.group(2)} data-raw="{len(raw) - 1}"></{match.group(2)}>'
+
+    html = _collapse_whitespace(_RAW_ELEMENT.sub(set_aside, html)).strip()
+    return re.sub(r'<(\w+) data-raw="(\d+)"></\1>', lambda m: raw[int(m.group(2))], html)
+
+
+def asset_name(path, content):
+    """Returns the name of the hashed asset for the file at <path> with <content>."""
+    stem, dot, suffix = Path(path).name.partition(".")
+    digest = hashlib.sha256(content).hexdigest()[:12]
+    return f"{ASSETS_DIR}/{stem}.{digest}{dot}{suffix}"
+
+
+def build_assets(sources):
+    """Returns {CDN url: (asset name, content)} for the CDN assets loaded by <sources>, the text of
+    the templates, leaving out the ones that couldn't be downloaded."""
+    assets = {}
+    for url, integrity in find_cdn_assets(sources).items():
+        try:
+            content = fetch_vendored(url, integrity)
+        except (OSError, ValueError) as error:
+            logger.warning(f"Loading {url} from the CDN: unable to vendor it ({error})")
+            continue
+        if url.endswith(".css"):
+            content = purge_css(content.decode("utf-8"), sources).encode("utf-8")
+        assets[url] = (asset_name(url, content), content)
+    return assets
+
+
+def finalize_page(html, assets, root=""):
+    """Returns the minified <html> of a page, linking to the hashed <assets> (see build_assets())
+    instead of the CDN. <root> is the relative path from the page to the output directory."""
+
+    def link_asset(match):
+        if match.group(1) not in assets:
+            return match.group(0)
+        tag = match.group(0).replace(match.group(1), root + assets[match.group(1)][0])
+        # The asset is served from the same origin now.
+        return re.sub(r'\s+(integrity|crossorigin)="[^"]*"', "", tag)
+
+    return minify_html(_CDN_TAG.sub(link_asset, html))
+
+
+@functools.lru_cache(maxsize=None)
+def _brotli():
+    """Returns the brotli module, or None if it isn't installed (logged once)."""
+    try:
+        import brotli
+    except ImportError:
+        logger.debug("Brotli isn't installed: not writing .br copies")
+        return None
+    return brotli
+
+
+def compress(content):
+    """Returns {suffix: compressed content} for the precompressed copies of <content>."""
+    copies = {".gz": gzip.compress(content, compresslevel=9, mtime=0)}
+    brotli = _brotli()
+    if brotli is not None:
+        copies[".br"] = brotli.compress(content, quality=11)
+    return copies
+
+
+def write_compressed(path, content):
+    """Writes <content> to <path> along with its precompressed copies."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(content)
+    for suffix, compressed in compress(content).items():
+        path.with_name(path.name + suffix).write_bytes(compressed)
+
+
+def remove_stale_assets(output, keep):
+    """Removes the files in the assets directory of <output> that aren't one of the asset names in
+    <keep> or one of their precompressed copies."""
+    keep = {name + suffix for name in keep for suffix in ("", ".gz", ".br")}
+    for path in (output / ASSETS_DIR).glob("*"):
+        if path.relative_to(output).as_posix() not in keep:
+            logger.debug(f"Removing stale asset {path}")
+            path.unlink()
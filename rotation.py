@@ -1,18 +1,36 @@
 import argparse
-from dataclasses import dataclass
-from datetime import datetime, timedelta, timezone
+from dataclasses import dataclass, field
+from datetime import date, datetime, time, timedelta, timezone
 from enum import Enum
-from googleapiclient.errors import HttpError
 from pathlib import Path
-import gcal
+from zoneinfo import ZoneInfo
+import bisect
+import copy
+import fairness
+import functools
+import hashlib
+import instrument
+import itertools
+import journal
+import json
 import logging
-import pickle
 import os
 import random
+import sys
 
 
 DATE = datetime.now(timezone.utc)
-SAVED_ROTATIONS_PATH = Path("rotations.pickle")
+# Number of weeks after sheriffing (or leading) before someone can be picked as a sheriff again.
+SHERIFF_COOLDOWN = 4
+SAVED_ROTATIONS_PATH = Path("rotations.jsonl")
+# Everyone who is or has been in the rotation: see load_roster().
+ROSTER_PATH = Path(__file__).parent / "roster.json"
+# Rotations used to be pickled: if a pickle is found and there is no journal yet, it is migrated.
+LEGACY_ROTATIONS_PATH = Path("rotations.pickle")
+# Local working hours, used to work out how much of the day people in different timezones share.
+WORKING_HOURS = (time(9), time(17))
+# People need to share at least this many working hours to be paired together.
+MIN_OVERLAP_HOURS = 3
 
 logger = logging.getLogger()
 ch = logging.StreamHandler()
@@ -24,7 +42,15 @@ class Geo(Enum):
     ASIA_AUSTRALIA = "🌏"
 
 
-@dataclass
+# Timezone used for people who don't have one set.
+DEFAULT_TIMEZONES = {
+    Geo.AMERICAS: "America/Toronto",
+    Geo.EUROPE_AFRICA: "Europe/Paris",
+    Geo.ASIA_AUSTRALIA: "Asia/Taipei",
+}
+
+
+@dataclass(frozen=True, slots=True, eq=False)
 class Person:
     name: str
     nick: str
@@ -32,6 +58,20 @@ class Person:
     lead: bool = False
     """<cal_override> at mozilla is used to send the calendar invitations"""
     cal_override: str = None
+    """<tz> is an IANA timezone name, e.g. "America/Vancouver". Defaults to one for <geo>."""
+    tz: str = None
+    """<id> is the key of the person in ROSTER and in saved rotations: never reuse one."""
+    id: int = field(kw_only=True)
+
+    # People are compared by id: everyone is a single shared instance from ROSTER.
+    def __eq__(self, other):
+        return isinstance(other, Person) and self.id == other.id
+
+    def __hash__(self):
+        return self.id
+
+    def __deepcopy__(self, memo):
+        return self
 
     def __repr__(self):
         return f"{self.name} [{self.nick}]"
@@ -39,52 +79,273 @@ class Person:
     def get_cal_nick(self):
         return self.cal_override if self.cal_override else self.nick
 
+    def get_tz(self):
+        return self.tz if self.tz else DEFAULT_TIMEZONES[self.geo]
 
-@dataclass
+
+@dataclass(slots=True)
 class Rotation:
     leader: Person
     sheriffs: list
+    """<roster> is the ROSTER_VERSION the rotation was generated with, if known."""
+    roster: str = field(default=None, compare=False)
 
     def __repr__(self):
         return f"{self.leader}, {self.sheriffs}"
 
 
-MEMBERS = [
-    Person("Andrew Creskey", "acreskey", Geo.AMERICAS, True),
-    Person("Bas Schouten", "bas", Geo.EUROPE_AFRICA, True, cal_override="bschouten"),
-    Person("Benjamin De Kosnik", "bdekoz", Geo.AMERICAS, True),
-    Person("Daniel Holbert", "dholbert", Geo.AMERICAS),
-    Person("Dave Hunt", "davehunt", Geo.EUROPE_AFRICA),
-    Person("Denis Palmeiro", "denispal", Geo.AMERICAS, True, cal_override="dpalmeiro"),
-    Person("Alex Thayer", "alexical", Geo.AMERICAS, True, cal_override="dothayer"),
-    Person("Florian Quèze", "florian", Geo.EUROPE_AFRICA, True),
-    Person(
-        "Gregory Mierzwinski", "sparky", Geo.AMERICAS, True, cal_override="gmierzwinski"
-    ),
-    Person("Julien Wajsberg", "julienw", Geo.EUROPE_AFRICA, True),
-    Person("Marc Leclair", "mleclair", Geo.AMERICAS),
-    Person("Markus Stange", "mstange", Geo.AMERICAS, True),
-    Person("Mike Conley", "mconley", Geo.AMERICAS),
-    Person("Nazim Can Altinova", "canova", Geo.EUROPE_AFRICA, cal_override="naltinova"),
-    Person("Olli Pettay", "smaug", Geo.EUROPE_AFRICA),
-    Person("Randell Jesup", "jesup", Geo.AMERICAS, cal_override="rjesup"),
-    Person("Sean Feng", "sefeng", Geo.AMERICAS, True),
-    Person("Frank Doty", "frankdoty", Geo.AMERICAS, cal_override="fdoty"),
-    Person("Andrej Glavic", "andrej", Geo.AMERICAS, cal_override="aglavic"),
-    Person("Kash Shampur", "kshampur", Geo.AMERICAS),
-    Person("Justin Link", "jlink", Geo.AMERICAS),
-    Person(
-        "Emilio Cobos Álvarez", "emilio", Geo.EUROPE_AFRICA, cal_override="ealvarez"
-    ),
-    Person("Iain Ireland", "iain", Geo.AMERICAS, cal_override="iireland"),
-    Person("Adam Brouwers-Harries", "aabh", Geo.EUROPE_AFRICA, cal_override="abrouwersharries"),
-]
-
-
-def parse_args():
+class RotationIndex:
+    """Tracks the most recent week each person led and sheriffed within the last <window> weeks of
+    history, so that eligibility checks don't need to scan the history.
+
+    Weeks are expected to be added in order. Replacing or inserting a week inside the window (e.g.
+    when regenerating with --force) is supported and rebuilds the index from the window.
+    """
+
+    def __init__(self, window, rotations=None):
+        self.window = window
+        self.size = 0  # position the next week will be recorded at
+        self._weeks = []  # (week, rotation) for the last <window> weeks, in order
+        self._last_led = {}  # person id -> (position, week)
+        self._last_sheriffed = {}
+        for week, rotation in sorted((rotations or {}).items()):
+            self.add(week, rotation)
+
+    def add(self, week, rotation):
+        if not self._weeks or week > self._weeks[-1][0]:
+            self._weeks.append((week, rotation))
+            self._record(self.size, week, rotation)
+            self.size += 1
+            if len(self._weeks) > self.window:
+                self._weeks.pop(0)
+            return
+
+        weeks = [w for w, _ in self._weeks]
+        if week < weeks[0] and len(self._weeks) == self.window:
+            # Older than anything in the window so it can't affect eligibility.
+            return
+        i = bisect.bisect_left(weeks, week)
+        if weeks[i] == week:
+            self._weeks[i] = (week, rotation)
+        else:
+            self._weeks.insert(i, (week, rotation))
+            self.size += 1
+            if len(self._weeks) > self.window:
+                self._weeks.pop(0)
+        self._rebuild()
+
+    def _record(self, position, week, rotation):
+        self._last_led[rotation.leader.id] = (position, week)
+        for sheriff in rotation.sheriffs:
+            self._last_sheriffed[sheriff.id] = (position, week)
+
+    def _rebuild(self):
+        self._last_led.clear()
+        self._last_sheriffed.clear()
+        first = self.size - len(self._weeks)
+        for i, (week, rotation) in enumerate(self._weeks):
+            self._record(first + i, week, rotation)
+
+    def _within(self, last, person, weeks):
+        position, week = last.get(person.id, (-1, None))
+        return week if position >= self.size - weeks else None
+
+    def led_within(self, person, weeks):
+        """Returns the week <person> led if it was one of the last <weeks> weeks, else None."""
+        return self._within(self._last_led, person, weeks)
+
+    def sheriffed_within(self, person, weeks):
+        """Returns the week <person> sheriffed if it was one of the last <weeks> weeks, else None."""
+        return self._within(self._last_sheriffed, person, weeks)
+
+
+def working_hours(tz, day):
+    """Returns the start and end of WORKING_HOURS in <tz> on <day>, in UTC."""
+    start, end = WORKING_HOURS
+    zone = ZoneInfo(tz)
+    return (
+        datetime.combine(day, start, tzinfo=zone).astimezone(timezone.utc),
+        datetime.combine(day, end, tzinfo=zone).astimezone(timezone.utc),
+    )
+
+
+def _monday(week):
+    # strptime() doesn't parse years before 1000, which long synthetic histories (bench.py) reach.
+    return date(*map(int, week.split("-")))
+
+
+class OverlapMatrix:
+    """The working hours shared by every pair of <timezones> in the week of <week> (yyyy-mm-dd), in
+    hours: the least they share on any of its working days, since DST doesn't start or end on the
+    same day everywhere.
+
+    It decides who can be paired: if everyone picked so far shares enough working hours, anyone
+    can be picked next; otherwise the next pick has to share enough working hours with at least
+    one of them. With the default timezones, no geos share enough working hours for most of the
+    year, so this is the same as only mixing two geos in a week. In the weeks between the start or
+    end of DST in North America and in Europe, Toronto and Paris share MIN_OVERLAP_HOURS, so they
+    can be paired and someone from the third geo can join them.
+    """
+
+    def __init__(self, timezones, week):
+        self.timezones = sorted(timezones)
+        monday = _monday(week)
+        self.hours = {}
+        for day in (monday + timedelta(days=d) for d in range(5)):
+            hours = {tz: working_hours(tz, day) for tz in self.timezones}
+            # Compare with the neighbouring days too, for timezones on either side of the date line.
+            nearby = {
+                tz: [working_hours(tz, day + timedelta(days=d)) for d in (-1, 0, 1)]
+                for tz in self.timezones
+            }
+            for a in self.timezones:
+                start, end = hours[a]
+                for b in self.timezones:
+                    shared = max(
+                        min(end, b_end) - max(start, b_start) for b_start, b_end in nearby[b]
+                    )
+                    shared = max(shared.total_seconds() / 3600, 0)
+                    self.hours[a, b] = min(self.hours.get((a, b), shared), shared)
+        self.pairable = {
+            a: frozenset(b for b in self.timezones if self.hours[a, b] >= MIN_OVERLAP_HOURS)
+            for a in self.timezones
+        }
+        self._allowed = {}  # timezones picked -> allowed(), which runs for every pick
+
+    def allowed(self, picked):
+        """Returns the timezones the next person can be picked from to join <picked>, or None if
+        they can be picked from anywhere."""
+        timezones = frozenset(p.get_tz() for p in picked)
+        if timezones not in self._allowed:
+            if all(b in self.pairable[a] for a in timezones for b in timezones):
+                self._allowed[timezones] = None
+            else:
+                self._allowed[timezones] = frozenset().union(*(self.pairable[tz] for tz in timezones))
+        return self._allowed[timezones]
+
+
+_overlap_matrices = {}  # (timezones, UTC offsets of their working hours) -> OverlapMatrix
+
+
+@functools.lru_cache(maxsize=1024)
+def get_overlap_matrix(timezones, week):
+    """Returns the OverlapMatrix of the frozenset <timezones> for <week> (yyyy-mm-dd). It is shared
+    with the other weeks in which every timezone has the same UTC offsets."""
+    monday = _monday(week)
+    days = [monday + timedelta(days=d) for d in range(-1, 6)]
+    key = timezones, tuple(
+        ZoneInfo(tz).utcoffset(datetime.combine(day, t))
+        for tz in sorted(timezones)
+        for day in days
+        for t in WORKING_HOURS
+    )
+    if key not in _overlap_matrices:
+        _overlap_matrices[key] = OverlapMatrix(timezones, week)
+    return _overlap_matrices[key]
+
+
+class CandidatePool:
+    """Candidates bucketed by timezone, with constant-time removal and random picks."""
+
+    def __init__(self, people=()):
+        self.buckets = {}  # timezone -> list of people
+        self._positions = {}  # person id -> position in its bucket
+        for person in people:
+            self.add(person)
+
+    def __len__(self):
+        return len(self._positions)
+
+    def add(self, person):
+        bucket = self.buckets.setdefault(person.get_tz(), [])
+        self._positions[person.id] = len(bucket)
+        bucket.append(person)
+
+    def remove(self, person):
+        bucket = self.buckets[person.get_tz()]
+        i = self._positions.pop(person.id)
+        last = bucket.pop()
+        if last != person:
+            # move the last person into the hole
+            bucket[i] = last
+            self._positions[last.id] = i
+
+    def pop(self, rng, timezones=None):
+        """Removes and returns a random person from the buckets of <timezones> (or any bucket if
+        None), or None if they are empty. Everyone in those buckets is equally likely."""
+        buckets = [
+            b for tz, b in self.buckets.items() if b and (timezones is None or tz in timezones)
+        ]
+        n = rng.randrange(sum(len(b) for b in buckets)) if buckets else None
+        for bucket in buckets:
+            if n < len(bucket):
+                person = bucket[n]
+                self.remove(person)
+                return person
+            n -= len(bucket)
+        return None
+
+
+def _person_from_roster(record):
+    return Person(
+        record["name"],
+        record["nick"],
+        Geo[record["geo"]],
+        record.get("lead", False),
+        cal_override=record.get("cal_override"),
+        tz=record.get("tz"),
+        id=record["id"],
+    )
+
+
+def load_roster(path=ROSTER_PATH):
+    """Returns (members, former members) from the roster file at <path>. Former members are no
+    longer in the rotation but are in its history."""
+    with open(path, encoding="utf-8") as f:
+        roster = json.load(f)
+    members = [_person_from_roster(r) for r in roster["members"]]
+    former_members = [_person_from_roster(r) for r in roster["former_members"]]
+    ids = [p.id for p in members + former_members]
+    if len(set(ids)) != len(ids):
+        raise ValueError(f"{path} has more than one person with the same id")
+    return members, former_members
+
+
+def roster_version(members):
+    """Returns a short hash of <members> that changes whenever anyone joins, leaves or changes."""
+    people = [
+        [p.id, p.name, p.nick, p.geo.name, p.lead, p.cal_override, p.tz]
+        for p in sorted(members, key=lambda p: p.id)
+    ]
+    return hashlib.sha256(json.dumps(people).encode("utf-8")).hexdigest()[:12]
+
+
+def use_roster(path):
+    """Makes the roster file at <path> the one every function in this module uses, e.g. to
+    generate the rotation of another team (see teams.py)."""
+    global ROSTER_PATH, MEMBERS, FORMER_MEMBERS, ROSTER, ROSTER_VERSION
+    ROSTER_PATH = Path(path)
+    MEMBERS, FORMER_MEMBERS = load_roster(path)
+    # Everyone who has ever been in the rotation, keyed by id. Saved rotations only store the ids.
+    ROSTER = {person.id: person for person in MEMBERS + FORMER_MEMBERS}
+    # Saved with every generated week to tell which weeks were planned with an older roster.
+    ROSTER_VERSION = roster_version(MEMBERS)
+
+
+use_roster(ROSTER_PATH)
+
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument("--debug", action="store_true", help="Run in debug mode (extra logging)")
     parser.add_argument("--force", action="store_true", help="Ignore cached rotations and regenerate")
+    parser.add_argument(
+        "--horizon",
+        type=int,
+        default=2,
+        metavar="N",
+        help="Number of weeks to plan, starting with this week (default: %(default)s)",
+    )
     parser.add_argument(
         "--production",
         action="store_true",
@@ -94,248 +355,504 @@ def parse_args():
             "development, i.e. so we're not adding calendar invites every time"
         ),
     )
-    return parser.parse_args()
+    parser.add_argument(
+        "--strategy",
+        choices=["random", "optimal"],
+        default="random",
+        help=(
+            "how to pick people: 'random' picks randomly among eligible people, 'optimal' picks "
+            "whoever has been on duty the least (default: %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "--candidates",
+        type=int,
+        default=1,
+        metavar="K",
+        help="Plan K schedules in parallel and keep the best one (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--metric",
+        choices=sorted(fairness.METRICS),
+        default="combined",
+        help="How candidate schedules are scored (default: %(default)s)",
+    )
+    parser.add_argument("--seed", type=int, help="Seed the random choices to reproduce a run")
+    parser.add_argument(
+        "--availability",
+        action="store_true",
+        help=(
+            "Don't pick people who are away according to their calendars. Needs credentials with "
+            "access to free/busy information: see availability.py"
+        ),
+    )
+    parser.add_argument(
+        "--availability-file",
+        metavar="FILE",
+        help="Like --availability, reading when people are busy from FILE instead of the calendars",
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="FILE",
+        help="Write how long each phase took, with peak memory and counters, to FILE as JSON",
+    )
+    parser.add_argument(
+        "--cprofile", metavar="FILE", help="Profile the run with cProfile and save the stats to FILE"
+    )
+    parser.add_argument(
+        "--profile-startup",
+        action="store_true",
+        help=(
+            "Report how long importing each package takes, without running anything: the modules "
+            "a run with the other arguments would import"
+        ),
+    )
+    args = parser.parse_args(argv)
+    if args.horizon < 2:
+        parser.error("--horizon must include at least this week and next week")
+    if args.candidates < 1:
+        parser.error("--candidates must be at least 1")
+    return args
+
+
+def rotation_to_record(week, rotation):
+    return {
+        "week": week,
+        "leader": rotation.leader.id,
+        "sheriffs": [s.id for s in rotation.sheriffs],
+        "roster": rotation.roster,
+    }
+
+
+def rotation_from_record(record):
+    return Rotation(
+        ROSTER[record["leader"]], [ROSTER[i] for i in record["sheriffs"]], record.get("roster")
+    )
 
 
-def load_rotations():
+def _person_id(nick):
+    for person in ROSTER.values():
+        if person.nick == nick:
+            return person.id
+    raise KeyError(f"{nick} is not in {ROSTER_PATH.name}: add them to the former members")
+
+
+def migrate_v1_record(record):
+    """Returns the record of journal version 2 for <record>, which has the details of every person
+    instead of their id."""
+    return {
+        "week": record["week"],
+        "leader": _person_id(record["leader"]["nick"]),
+        "sheriffs": [_person_id(s["nick"]) for s in record["sheriffs"]],
+    }
+
+
+def load_legacy_rotations():
+    import pickle
+    import types
+
+    class Unpickler(pickle.Unpickler):
+        # People in the pickle predate ids: load them as plain objects and look them up by nick.
+        def find_class(self, module, name):
+            if name in ("Person", "Rotation"):
+                return types.SimpleNamespace
+            return super().find_class(module, name)
+
+    with LEGACY_ROTATIONS_PATH.open(mode="rb") as html:
+        rotations = Unpickler(html).load()
+        logger.debug(f"Loading cached rotations from {LEGACY_ROTATIONS_PATH}")
+    if isinstance(rotations, list):
+        # migrate to dict format with dates
+        rotations_dict = {}
+        for rotation in reversed(rotations):
+            week = get_week(DATE - timedelta(weeks=len(rotations_dict) - 1))
+            rotations_dict.setdefault(week, rotation)
+        rotations = rotations_dict
+    return {
+        week: Rotation(
+            ROSTER[_person_id(r.leader.nick)], [ROSTER[_person_id(s.nick)] for s in r.sheriffs]
+        )
+        for week, r in rotations.items()
+    }
+
+
+def load_rotations(last=None, before=None, since=None):
+    """Returns the saved rotations keyed by week. If <last> is given, only the <last> most recent
+    weeks (before <before>, if given, plus every week from <before> on) are read from the end of
+    the journal, and if <since> is given only the weeks from <since> on."""
+    if not SAVED_ROTATIONS_PATH.exists() and LEGACY_ROTATIONS_PATH.exists():
+        logger.debug(f"Migrating {LEGACY_ROTATIONS_PATH} to {SAVED_ROTATIONS_PATH}")
+        save_rotations(dict(sorted(load_legacy_rotations().items())))
     try:
-        with SAVED_ROTATIONS_PATH.open(mode="rb") as html:
-            rotations = pickle.load(html)
-            logger.debug(f"Loading cached rotations from {SAVED_ROTATIONS_PATH}")
-        if isinstance(rotations, list):
-            # migrate to dict format with dates
-            rotations_dict = {}
-            for rotation in reversed(rotations):
-                week = get_week(DATE - timedelta(weeks=len(rotations_dict) - 1))
-                rotations_dict.setdefault(week, rotation)
-            return rotations_dict
+        if journal.read_version(SAVED_ROTATIONS_PATH) == 1:
+            logger.debug(f"Migrating {SAVED_ROTATIONS_PATH} to journal version {journal.VERSION}")
+            records = journal.read_weeks(SAVED_ROTATIONS_PATH, version=1)
+            journal.rewrite_weeks(
+                SAVED_ROTATIONS_PATH, [migrate_v1_record(r) for r in records.values()]
+            )
+        records = journal.read_weeks(SAVED_ROTATIONS_PATH, last, before, since)
+        logger.debug(f"Loading cached rotations from {SAVED_ROTATIONS_PATH}")
     except FileNotFoundError:
         logger.debug("Cached rotations not found")
-        rotations = {}
-    return rotations
+        return {}
+    return {week: rotation_from_record(r) for week, r in records.items()}
 
 
-def generate_html(rotations):
-    path = Path("docs")
-    path.mkdir(exist_ok=True)
-    fpath = (path / "index.html").with_suffix(".html")
-    this_week = rotations[get_week(DATE)]
-    next_week = rotations[get_week(DATE + timedelta(weeks=1))]
+def save_rotations(rotations):
+    """Appends <rotations> to the journal. Earlier records for the same weeks are superseded."""
+    journal.append_weeks(
+        SAVED_ROTATIONS_PATH, [rotation_to_record(w, r) for w, r in rotations.items()]
+    )
 
-    html = """
-<html>
-
-<head>
-    <meta charset="utf-8">
-    <meta name="viewport" content="width=device-width, initial-scale=1">
-    <title>Performance Triage: Rotation</title>
-    <link href="https://cdn.jsdelivr.net/npm/bootstrap@5.2.0/dist/css/bootstrap.min.css" rel="stylesheet"
-        integrity="sha384-gH2yIJqKdNHPEq0n4Mqa/HGKIhSkIHeL5AyhkYV8i59U5AR6csBvApHHNl/vI1Bx" crossorigin="anonymous">
-</head>
-
-<body>
-    <script src="https://cdn.jsdelivr.net/npm/bootstrap@5.2.0/dist/js/bootstrap.bundle.min.js"
-        integrity="sha384-A3rJD856KowSb7dwlZdYEkO39Gagi7vIsF0jrRAoQmDKKtQBHUuLZ9AsSv4jD4Xa"
-        crossorigin="anonymous"></script>
-
-    <div class="container">
-        <header class="d-flex flex-wrap justify-content-center py-3 mb-4 border-bottom">
-            <a href="/" class="d-flex align-items-center mb-3 mb-md-0 me-md-auto text-dark text-decoration-none">
-                <svg class="bi me-2" width="40" height="32">
-                    <use xlink:href="#bootstrap"></use>
-                </svg>
-                <span class="fs-4">Performance Triage: Rotation</span>
-            </a>
-
-            <ul class="nav nav-pills">
-                <li class="nav-item"><a href="calculator.html" class="nav-link">Impact Calculator</a></li>
-                <li class="nav-item"><a href="#" class="nav-link active" aria-current="page">Rotation</a>
-                </li>
-            </ul>
-
-            <a class="mx-3 d-flex" href="https://github.com/mozilla/perf-triage" target="_blank" rel="noopener noreferrer" title="Go to the Git repository (this opens in a new window)">
-              <svg width="22" height="22" class="octicon octicon-mark-github m-auto" viewBox="0 0 16 16" version="1.1" aria-label="github"><path fill-rule="evenodd" d="M8 0C3.58 0 0 3.58 0 8c0 3.54 2.29 6.53 5.47 7.59.4.07.55-.17.55-.38 0-.19-.01-.82-.01-1.49-2.01.37-2.53-.49-2.69-.94-.09-.23-.48-.94-.82-1.13-.28-.15-.68-.52-.01-.53.63-.01 1.08.58 1.23.82.72 1.21 1.87.87 2.33.66.07-.52.28-.87.51-1.07-1.78-.2-3.64-.89-3.64-3.95 0-.87.31-1.59.82-2.15-.08-.2-.36-1.02.08-2.12 0 0 .67-.21 2.2.82.64-.18 1.32-.27 2-.27.68 0 1.36.09 2 .27 1.53-1.04 2.2-.82 2.2-.82.44 1.1.16 1.92.08 2.12.51.56.82 1.27.82 2.15 0 3.07-1.87 3.75-3.65 3.95.29.25.54.73.54 1.48 0 1.07-.01 1.93-.01 2.2 0 .21.15.46.55.38A8.013 8.013 0 0 0 16 8c0-4.42-3.58-8-8-8z"></path></svg>
-            </a>
-        </header>
-    </div>
-
-    <div class="container">
-
-        <div class="row">
-
-            <div class="col-sm-6">
-                <div class="card mb-3">
-                    <div class="card-header text-bg-primary">
-                        This week
-                    </div>
-                    <ol class="list-group list-group-flush">
-                        <li class="list-group-item"><strong>{{this_week.leader}}</strong></li>
-                        {% for sheriff in this_week.sheriffs %}<li class="list-group-item">{{sheriff}}</li>
-                        {% endfor %}
-                    </ol>
-                </div>
-            </div>
-
-            <div class="col-sm-6">
-                <div class="card mb-3">
-                    <div class="card-header text-bg-secondary">
-                        Next week
-                    </div>
-                    <ol class="list-group list-group-flush">
-                        <li class="list-group-item"><strong>{{next_week.leader}}</strong></li>
-                        {% for sheriff in next_week.sheriffs %}<li class="list-group-item">{{sheriff}}</li>
-                        {% endfor %}
-                    </ol>
-                </div>
-            </div>
-
-        </div>
-
-        <div class="row">
-
-            <div class="col">
-                <div class="card mb-3">
-                    <div class="card-header">
-                        History
-                    </div>
-                    <ul class="list-group list-group-flush">
-                        {% for date in history %}<li class="list-group-item">{{ date }}: <strong>{{ history[date].leader }}</strong>, {{ history[date].sheriffs }}</li>
-                        {% endfor %}
-                    </ul>
-                </div>
-            </div>
-        </div>
-
-        <div class="mb-3">Generated on {{timestamp}}.</div>
-
-    </div>
-</body>
-
-</html>"""
-
-    import jinja2
-
-    environment = jinja2.Environment()
-    template = environment.from_string(html)
-    history = dict(sorted(rotations.items(), reverse=True)[2:])
-
-    with fpath.open(mode="w+") as html:
-        html.write(
-            template.render(
-                this_week=this_week,
-                next_week=next_week,
-                history=history,
-                timestamp=DATE,
-            )
-        )
 
+def generate_html(rotations=None, output=None, changed=()):
+    """Updates the rotation website in <output> (default: docs/): see sitegen.py. The pages are
+    built from <rotations>, every week, if given. Otherwise only the years that can have changed,
+    the ones of the weeks shown on the index page and of the weeks in <changed>, are read from the
+    end of the journal, and the earlier years only if their archives have to be rendered again."""
+    import sitegen
 
-def generate_rotation(leaders, rotations):
-    leader_candidates = leaders.copy()
-    sheriff_candidates = MEMBERS.copy()
-
-    # remove recent leaders from pool
-    for w, r in list(sorted(rotations.items()))[(len(leaders) // 2) * -1 :]:
-        if r.leader in leader_candidates:
-            logger.debug(f"Removing {r.leader} from leader pool because they led on {w}")
-            leader_candidates.remove(r.leader)
-
-    # remove recent sheriffs from pools
-    for w, r in list(sorted(rotations.items()))[-4:]:
-        if r.leader in sheriff_candidates:
-            logger.debug(f"Removing {r.leader} from sheriff pool because they sheriffed on {w}")
-            sheriff_candidates.remove(r.leader)
-        for sheriff in r.sheriffs:
-            if sheriff in leader_candidates:
-                logger.debug(f"Removing {sheriff} from leader pool because they sheriffed on {w}")
-                leader_candidates.remove(sheriff)
-            if sheriff in sheriff_candidates:
-                logger.debug(f"Removing {sheriff} from sheriff pool because they sheriffed on {w}")
-                sheriff_candidates.remove(sheriff)
+    next_week = get_week(DATE + timedelta(weeks=1))
+    output = sitegen.OUTPUT_PATH if output is None else Path(output)
+    load_history = None
+    if rotations is None:
+        first_week = min([get_week(DATE - timedelta(weeks=sitegen.RECENT_WEEKS)), *changed])
+        rotations = load_rotations(since=f"{first_week[:4]}-01-01")
+        load_history = load_rotations
+    written = sitegen.build_site(
+        rotations, get_week(DATE), next_week, DATE, output, load_history
+    )
+    for path in written:
+        logger.debug(f"Wrote {path}")
+
+
+def history_window(leaders):
+    """Returns the number of most recent weeks generate_rotation() looks at."""
+    return max(len(leaders) // 2, SHERIFF_COOLDOWN)
+
+
+def generate_rotation(leaders, index, rng=random, members=None, away=frozenset(), week=None):
+    """Generates the rotation of <week> (yyyy-mm-dd, default: this week). <away> is the ids of the
+    people who are away that week: see availability.py."""
+    members = MEMBERS if members is None else members
+    week = get_week(DATE) if week is None else week
+    # remove recent leaders and sheriffs, and people who are away, from pool
+    leader_candidates = []
+    for person in leaders:
+        if person.id in away:
+            logger.debug(f"Removing {person} from leader pool because they are away")
+        elif recent := index.led_within(person, len(leaders) // 2):
+            logger.debug(f"Removing {person} from leader pool because they led on {recent}")
+        elif recent := index.sheriffed_within(person, SHERIFF_COOLDOWN):
+            logger.debug(f"Removing {person} from leader pool because they sheriffed on {recent}")
+        else:
+            leader_candidates.append(person)
+
+    instrument.count("generate_rotation")
+    instrument.observe("leader_candidates", len(leader_candidates))
 
     # pick a leader
-    leader = random.choice(leader_candidates)
+    leader = rng.choice(leader_candidates)
     logger.debug(f"Picked {leader} as leader")
 
-    # remove leader from pool
-    sheriff_candidates.remove(leader)
-    logger.debug(f"Removed {leader} from sheriff pool because they have been picked as the leader")
+    # remove recent sheriffs and the leader from pool
+    sheriff_candidates = CandidatePool()
+    for person in members:
+        if person == leader:
+            logger.debug(f"Removed {leader} from sheriff pool because they have been picked as the leader")
+        elif person.id in away:
+            logger.debug(f"Removing {person} from sheriff pool because they are away")
+        elif recent := (
+            index.led_within(person, SHERIFF_COOLDOWN)
+            or index.sheriffed_within(person, SHERIFF_COOLDOWN)
+        ):
+            logger.debug(f"Removing {person} from sheriff pool because they sheriffed on {recent}")
+        else:
+            sheriff_candidates.add(person)
+
+    instrument.observe("sheriff_candidates", len(sheriff_candidates))
 
     # pick sheriffs from pool
+    overlap = get_overlap_matrix(frozenset(sheriff_candidates.buckets) | {leader.get_tz()}, week)
     sheriffs = []
     for _ in range(2):
-        geos = {s.geo for s in [leader] + sheriffs}
-        if len(geos) > 1:
-            # remove sheriffs outside of selected geos from pool
-            for sheriff in [c for c in sheriff_candidates if c.geo not in geos]:
-                logger.debug(f"Removing {sheriff} from pool as they are in {sheriff.geo} and leader/sheriffs are in {geos}")
-                sheriff_candidates.remove(sheriff)
-        if len(sheriff_candidates) > 0:
-            random.shuffle(sheriff_candidates)
-            sheriff = sheriff_candidates.pop()
+        timezones = overlap.allowed([leader] + sheriffs)
+        if timezones is not None:
+            logger.debug(f"Only picking sheriffs in {sorted(timezones)} to overlap with {[leader] + sheriffs}")
+        sheriff = sheriff_candidates.pop(rng, timezones)
+        if sheriff:
             sheriffs.append(sheriff)
             logger.debug(f"Picked {sheriff} as sheriff")
     return Rotation(leader, sheriffs)
 
 
-def get_addresses_from_rotation(rotation):
-    attendees = [rotation.leader] + [s for s in rotation.sheriffs]
-    return [a.get_cal_nick() + "@mozilla.com" for a in attendees]
+def plan_rotations(leaders, index, weeks, rng=random, away=None):
+    """Generates a rotation for each of <weeks>, in order, yielding (week, Rotation) pairs. Each
+    rotation is added to <index> before the next one is generated so the exclusion rules carry
+    forward across the whole plan. <away> is a dict of week to the ids of the people who are away
+    that week."""
+    for week in weeks:
+        week_away = (away or {}).get(week, frozenset())
+        rotation = generate_rotation(leaders, index, rng, away=week_away, week=week)
+        index.add(week, rotation)
+        yield week, rotation
+
+
+def _busy_soon(person, upcoming, lead_cooldown, as_leader):
+    """Returns whether putting <person> on duty would break the cooldowns of the <upcoming>
+    rotations, which follow it in order."""
+    for rotation in upcoming[:SHERIFF_COOLDOWN]:
+        if person == rotation.leader or person in rotation.sheriffs:
+            return True
+    return as_leader and any(person == r.leader for r in upcoming[:lead_cooldown])
+
+
+def repair_rotation(leaders, index, rotation, upcoming, rng=random, away=frozenset(), week=None):
+    """Returns <rotation>, the rotation of <week> (yyyy-mm-dd, default: this week), with the people
+    who no longer fit the rules replaced, e.g. because they left, stopped leading, moved to a
+    timezone that can't be paired with the others or are in <away>, the ids of the people who are
+    away that week. Everyone else stays. Replacements are eligible given <index> and aren't on duty
+    too soon in <upcoming>, the rotations already planned for the following weeks, in order.
+
+    If nobody else can lead, the leader is kept even if they no longer fit, unless they left the
+    roster: then this raises IndexError."""
+    lead_cooldown = len(leaders) // 2
+    members = set(MEMBERS)
+    week = get_week(DATE) if week is None else week
+    overlap = get_overlap_matrix(frozenset(p.get_tz() for p in MEMBERS), week)
+
+    def can_sheriff(person):
+        return person in members and person.id not in away and not (
+            index.led_within(person, SHERIFF_COOLDOWN)
+            or index.sheriffed_within(person, SHERIFF_COOLDOWN)
+        )
 
+    def can_lead(person):
+        return person in leaders and person.id not in away and not (
+            index.led_within(person, lead_cooldown)
+            or index.sheriffed_within(person, SHERIFF_COOLDOWN)
+        )
 
-def add_gcal_reminder(is_production, rotation, generated_next_week):
-    """Adds a triage reminder event to the Performance Team Google Calendar based on the rotation.
-    See the top-of-file comment in gcal.py for requirements to run this function.
+    leader = rotation.leader if can_lead(rotation.leader) else None
+    sheriffs = []
+    for sheriff in rotation.sheriffs:
+        timezones = overlap.allowed([leader] + sheriffs if leader else sheriffs)
+        if can_sheriff(sheriff) and (timezones is None or sheriff.get_tz() in timezones):
+            sheriffs.append(sheriff)
 
-    This function may raise HttpError for google API or network failures and
-    FileNotFoundError if the GCloud Project secrets are missing.
-    """
-    # TODO: the states (is_production, generated_next_week, & CI envvar) seem confusing - is there a cleaner solution?
-    dry_run_mode = False
-    if not generated_next_week:
-        dry_run_mode = True
-        print(
-            (
-                "INFO: for this script to be idempotent, we only add calendar reminders when we "
-                "generate new rotations for next week. We did not generate it this time so we "
-                "run add_gcal_reminder in dry run mode."
+    if leader is None:
+        timezones = overlap.allowed(sheriffs)
+        candidates = [
+            p for p in leaders
+            if p not in sheriffs and can_lead(p) and (timezones is None or p.get_tz() in timezones)
+        ]
+        free = [p for p in candidates if not _busy_soon(p, upcoming, lead_cooldown, as_leader=True)]
+        if free:
+            leader = rng.choice(free)
+        elif candidates:
+            leader = rng.choice(candidates)
+            logger.warning(
+                f"Nobody can lead the week of {week} without being on duty again too soon: picked "
+                f"{leader}, check the following weeks"
             )
-        )
+        elif rotation.leader not in members:
+            raise IndexError(
+                f"Nobody can lead the week of {week} instead of {rotation.leader}, who left"
+            )
+        else:
+            leader = rotation.leader
+            logger.warning(
+                f"Nobody else can lead the week of {week}: keeping {leader}, who no longer fits"
+            )
+        if leader != rotation.leader:
+            logger.debug(f"Picked {leader} as leader instead of {rotation.leader}")
+
+    sheriff_candidates = CandidatePool(
+        p for p in MEMBERS
+        if p != leader
+        and p not in sheriffs
+        and can_sheriff(p)
+        and not _busy_soon(p, upcoming, lead_cooldown, as_leader=False)
+    )
+    for _ in range(len(rotation.sheriffs) - len(sheriffs)):
+        sheriff = sheriff_candidates.pop(rng, overlap.allowed([leader] + sheriffs))
+        if sheriff:
+            sheriffs.append(sheriff)
+            logger.debug(f"Picked {sheriff} as sheriff instead of one of {rotation.sheriffs}")
+    return Rotation(leader, sheriffs, ROSTER_VERSION)
+
+
+def repair_rotations(leaders, rotations, first_week, rng=random, away=None, check=()):
+    """Brings the saved <rotations> from <first_week> on up to date with the roster and returns the
+    ones that changed, keyed by week. Weeks planned with another version of the roster, or with
+    someone who is away according to <away> (a dict of week to ids), are checked again and repaired
+    with repair_rotation(); so are the weeks in <check>, e.g. because the weeks before them were
+    planned again, but they are only returned if someone was replaced. Other weeks, and weeks that
+    can't be repaired, are left alone."""
+    weeks = [w for w in sorted(rotations) if w >= first_week]
+    index = RotationIndex(
+        history_window(leaders), {w: r for w, r in rotations.items() if w < first_week}
+    )
+    lookahead = max(len(leaders) // 2, SHERIFF_COOLDOWN)
+    repaired = {}
+    for i, week in enumerate(weeks):
+        rotation = rotations[week]
+        week_away = (away or {}).get(week, frozenset())
+        on_duty = {rotation.leader.id} | {s.id for s in rotation.sheriffs}
+        stale = rotation.roster != ROSTER_VERSION or bool(on_duty & week_away)
+        if stale or week in check:
+            upcoming = [rotations[w] for w in weeks[i + 1:i + 1 + lookahead]]
+            try:
+                repaired_rotation = repair_rotation(
+                    leaders, index, rotation, upcoming, rng, week_away, week
+                )
+            except IndexError as error:
+                # Keep the week as it was saved, with its old roster, so the next run tries again.
+                logger.error(f"{error}: leaving the week as it is")
+                index.add(week, rotation)
+                continue
+            if stale or repaired_rotation != rotation:
+                rotations[week] = repaired[week] = repaired_rotation
+        index.add(week, rotations[week])
+    return repaired
+
+
+def plan_candidate(strategy, metric, leaders, index, weeks, history, seed, away=None):
+    """Plans <weeks> with the given strategy and a random number generator seeded with <seed>,
+    without the people who are <away> (see plan_rotations()). Returns the plan as a list of (week,
+    Rotation) pairs, its score according to <metric> and None. If the plan runs out of eligible
+    leaders, returns an infinite score, no plan and the week it ran out in."""
+    rng = random.Random(seed)
+    # Candidates sent to a worker in the same chunk share one copy of <index>.
+    index = copy.deepcopy(index)
+    plan = []
+    try:
+        if strategy == "optimal":
+            import optimal
 
-    if not is_production:
-        dry_run_mode = True
-        print(
-            "INFO: --production was not specified so running add_gcal_reminder in dry run mode."
+            plan.extend(optimal.plan_rotations(leaders, MEMBERS, index, weeks, history, rng, away))
+        else:
+            plan.extend(plan_rotations(leaders, index, weeks, rng, away))
+    except IndexError:
+        logger.debug(f"Candidate seeded with {seed} ran out of eligible leaders")
+        return float("inf"), None, weeks[len(plan)]
+    return fairness.METRICS[metric](MEMBERS, history, plan), plan, None
+
+
+def plan_best_candidate(
+    strategy, metric, leaders, index, weeks, history, seed, candidates, away=None
+):
+    """Plans <candidates> independent schedules for <weeks> across a process pool and returns the
+    one with the lowest score, as (candidate number, score, plan). Candidate i is seeded with
+    "<seed>:<i>" so any of them can be reproduced from <seed>.
+
+    If every candidate runs out of eligible leaders in a week because of the people who are away
+    that week according to <away>, that week is planned without availability: its entry in <away>
+    is cleared, and the candidates are planned again."""
+    seeds = [f"{seed}:{i}" for i in range(candidates)]
+    while True:
+        if candidates == 1:
+            results = [
+                plan_candidate(strategy, metric, leaders, index, weeks, history, seeds[0], away)
+            ]
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+
+            # The workers need the roster of this process, which they don't inherit if they are
+            # spawned rather than forked (the default on macOS and Windows), e.g. in teams.py.
+            with ProcessPoolExecutor(initializer=use_roster, initargs=(ROSTER_PATH,)) as pool:
+                chunksize = max(candidates // ((os.cpu_count() or 1) * 4), 1)
+                results = list(
+                    pool.map(
+                        plan_candidate,
+                        itertools.repeat(strategy),
+                        itertools.repeat(metric),
+                        itertools.repeat(leaders),
+                        itertools.repeat(index),
+                        itertools.repeat(weeks),
+                        itertools.repeat(history),
+                        seeds,
+                        itertools.repeat(away),
+                        chunksize=chunksize,
+                    )
+                )
+        best = min(range(candidates), key=lambda i: results[i][0])
+        if results[best][1] is not None:
+            return best, results[best][0], results[best][1]
+
+        # Candidates that ran out earlier may only have been unlucky: clear the latest week.
+        failed = [week for _, _, week in results if (away or {}).get(week)]
+        if not failed:
+            raise IndexError(f"All {candidates} candidate schedules ran out of eligible leaders")
+        week = max(failed)
+        # Like a failed availability lookup, don't fail the run because people are away.
+        logger.warning(
+            f"Nobody can lead the week of {week} with the people who are away: planning it "
+            "without availability"
         )
+        away[week] = frozenset()
+
+
+def get_address(person):
+    return person.get_cal_nick() + "@mozilla.com"
+
+
+def get_addresses_from_rotation(rotation):
+    attendees = [rotation.leader] + [s for s in rotation.sheriffs]
+    return [get_address(a) for a in attendees]
 
-    if not dry_run_mode:
-        credentials = gcal.auth_as_user()
-        service = gcal.get_calendar_service(credentials)
 
-    # N.B.: for simplicity, this code assumes this script executes on Monday
-    # or Tuesday the week before we want to set the reminder.
-    #
-    # Our reminders appear one week in advance. Note that we don't use the time fields.
-    reminder_date = DATE + timedelta(weeks=1)
+def get_reminder_date(week):
+    """Returns the date (yyyy-mm-dd) of the calendar reminder for the rotation of <week>."""
     # Show the reminder on Tuesday: we want the reminder to appear as early in
     # the week as possible but add a buffer day in case Monday is a holiday.
-    while reminder_date.weekday() != 1:  # 1 == Tuesday
-        reminder_date += timedelta(days=1)
+    reminder_date = datetime.strptime(week, "%Y-%m-%d") + timedelta(days=1)  # 1 == Tuesday
     # To save time in changing the original implementation,
-    # send_triage_reminder takes a yyyy-mm-dd instead of a datetime.
-    reminder_date = reminder_date.strftime("%Y-%m-%d")
+    # the gcal APIs take a yyyy-mm-dd instead of a datetime.
+    return reminder_date.strftime("%Y-%m-%d")
 
-    addresses = get_addresses_from_rotation(rotation)
 
-    if not dry_run_mode:
-        gcal.send_triage_reminder(service, reminder_date, addresses)
-    else:
+def get_reminders(rotations, first_week):
+    """Returns the triage reminders for <rotations> from <first_week> on, as a dict of reminder
+    date to email addresses."""
+    return {
+        get_reminder_date(week): get_addresses_from_rotation(rotation)
+        for week, rotation in rotations.items()
+        if week >= first_week
+    }
+
+
+def add_gcal_reminder(is_production, rotations, first_week):
+    """Makes the triage reminder events on the Performance Team Google Calendar match the rotations
+    from <first_week> on. See the top-of-file comment in gcal.py for requirements to run this
+    function.
+
+    This is idempotent: reminders that are already on the calendar are left alone, so this can run
+    whether or not the rotations were just generated.
+
+    Changes that fail with transient errors are retried, and saved to a retry queue for the next
+    run if they still fail: see gcal_dispatch.py. This function may raise HttpError for other google
+    API failures and FileNotFoundError if the GCloud Project secrets are missing.
+    """
+    reminders = get_reminders(rotations, first_week)
+
+    if is_production:
+        import gcal
+
+        credentials = gcal.auth_as_user()
+        service = gcal.get_calendar_service(credentials)
+        changed = gcal.reconcile_triage_reminders(service, reminders, credentials=credentials)
+        print("Calendar reminders are up to date ({} changed)".format(changed))
+        return
+
+    print("INFO: --production was not specified so running add_gcal_reminder in dry run mode.")
+    for reminder_date, addresses in reminders.items():
         if os.getenv("CI"):
             # Don't print full email addresses to CI logs.
             addresses = [a.split("@")[0] for a in addresses]
         print(
             (
-                "\nadd_gcal_reminder dry-run mode: would have created calendar "
+                "\nadd_gcal_reminder dry-run mode: would have made sure there is a calendar "
                 "invite with date {} and invitees {}"
             ).format(reminder_date, addresses)
         )
@@ -362,9 +879,11 @@ def add_gcal_reminder_manually(date):
         this_week if selected_rotation == "1" else next_week
     )
 
+    import gcal
+
     credentials = gcal.auth_as_user()
     service = gcal.get_calendar_service(credentials)
-    gcal.send_triage_reminder(service, date, addresses)
+    gcal.send_triage_reminder(service, date, addresses, credentials=credentials)
 
 
 def get_week(date):
@@ -372,51 +891,217 @@ def get_week(date):
     return week.strftime("%Y-%m-%d")
 
 
-def main():
-    args = parse_args()
-    logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+def profile_startup(args, top=15):
+    """Imports this module in a new interpreter under `python -X importtime`, along with the
+    modules a run with <args> imports lazily, and prints how long importing each top-level package
+    took, slowest first. Nothing is run, so this doesn't change the journal, the website or the
+    calendar."""
+    import subprocess
+
+    modules = ["rotation", "sitegen"]
+    if args.production:
+        modules.append("gcal")
+    if args.availability or args.availability_file:
+        modules.append("availability")
+    if args.strategy == "optimal":
+        modules.append("optimal")
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {', '.join(modules)}"],
+        cwd=Path(__file__).parent,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+    own_time = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            print(line, file=sys.stderr)
+            continue
+        fields = line[len("import time:"):].split("|")
+        if not fields[0].strip().isdigit():
+            continue  # The header line.
+        package = fields[2].strip().split(".")[0]
+        own_time[package] = own_time.get(package, 0) + int(fields[0])
+
+    print(f"\nImport time by package (total {sum(own_time.values()) / 1000:.1f} ms):")
+    for package, us in sorted(own_time.items(), key=lambda item: -item[1])[:top]:
+        print(f"{us / 1000:8.1f} ms  {package}")
+    return result.returncode
+
+
+def get_away(args, weeks):
+    """Returns a dict of each of <weeks> to the ids of the people who are away that week, from
+    the file given with --availability-file or from the calendars. See availability.py. Nobody is
+    away the weeks every leader is away, since nobody could lead them otherwise."""
+    import availability
+
+    if args.availability_file:
+        busy = availability.load_busy(args.availability_file)
+    else:
 
-    rotations = load_rotations()
+        def get_service():
+            import gcal
+
+            credentials = gcal.auth_as_user(gcal.SCOPES + [gcal.FREEBUSY_SCOPE])
+            return gcal.get_calendar_service(credentials)
+
+        time_min, time_max = availability.time_range(weeks)
+        addresses = [get_address(m) for m in MEMBERS]
+        busy = availability.get_busy(addresses, time_min, time_max, get_service)
+    away = availability.weeks_away(busy, MEMBERS, weeks)
+    for week, ids in sorted(away.items()):
+        if ids:
+            print(f"Away the week of {week}: {[ROSTER[i] for i in sorted(ids)]}")
+        if all(m.id in ids for m in MEMBERS if m.lead):
+            # Nobody could lead that week: plan it like a failed lookup, without availability.
+            logger.warning(
+                f"Every leader is away the week of {week}: planning it without availability"
+            )
+            away[week] = frozenset()
+    return away
+
+
+def update_rotations(args, output=None):
+    """Plans the weeks that need it, saves them and updates the website in <output>. Returns the
+    rotations of the most recent weeks of history and of the weeks planned, keyed by week."""
     leaders = [m for m in MEMBERS if m.lead]
-    while len(rotations) < len(leaders):
-        # create some history to improve selection
-        week = get_week(DATE - timedelta(weeks=(len(leaders) - len(rotations))))
-        rotations.setdefault(week, generate_rotation(leaders, rotations))
+    this_week = get_week(DATE)
+    next_week = get_week(DATE + timedelta(weeks=1))
+    with instrument.span("load"):
+        # generate_rotation only looks at the most recent weeks so don't read the whole history.
+        last = max(len(leaders), SHERIFF_COOLDOWN)
+        if args.strategy == "optimal" or args.candidates > 1:
+            # Balancing duties and scoring candidates needs more history.
+            last = max(last, fairness.FAIRNESS_WEEKS)
+        rotations = load_rotations(last=last, before=this_week)
+        # Only the weeks before a week count towards its cooldowns: see RotationIndex.
+        index = RotationIndex(
+            history_window(leaders), {w: r for w, r in rotations.items() if w < this_week}
+        )
+
+    seed = args.seed if args.seed is not None else random.SystemRandom().randrange(2**32)
+    print(f"Using seed {seed} (pass --seed {seed} to reproduce)")
+    rng = random.Random(seed)
+
+    away = None
+    if args.availability or args.availability_file:
+        with instrument.span("availability"):
+            horizon = {get_week(DATE + timedelta(weeks=i)) for i in range(args.horizon)}
+            weeks = sorted(horizon | {w for w in rotations if w >= this_week})
+            try:
+                away = get_away(args, weeks)
+            except Exception:
+                if args.availability_file:
+                    raise
+                # Like the calendar reminders, don't fail the run because of the calendar.
+                logging.exception("unable to look up availability: planning without it")
+
+    generated = {}
+    with instrument.span("bootstrap"):
+        while len(rotations) < len(leaders):
+            # create some history to improve selection
+            week = get_week(DATE - timedelta(weeks=(len(leaders) - len(rotations))))
+            if week not in rotations:
+                rotations[week] = generated[week] = generate_rotation(
+                    leaders, index, rng, week=week
+                )
+                rotations[week].roster = ROSTER_VERSION
+                index.add(week, rotations[week])
+
+    with instrument.span("repair"):
+        # Weeks planned with another roster, or with people who are away, are only changed where
+        # they no longer fit.
+        planned = dict(rotations)
+        repaired = repair_rotations(leaders, rotations, next_week, rng, away)
+        for week, rotation in repaired.items():
+            if rotation != planned[week]:
+                print(f"Updated {week}: {planned[week]} -> {rotation}")
+            generated[week] = rotation
+
+    with instrument.span("generate"):
+        horizon = [get_week(DATE + timedelta(weeks=i)) for i in range(args.horizon)]
+        missing = [w for w in horizon if args.force or not rotations.get(w)]
+        if missing:
+            # The weeks of the horizon saved after the first missing week are planned again with
+            # it, since its cooldowns only depend on the weeks before it.
+            missing = [w for w in horizon if w >= missing[0]]
+            index = RotationIndex(
+                history_window(leaders), {w: r for w, r in rotations.items() if w < missing[0]}
+            )
+            history = {w: r for w, r in rotations.items() if w not in missing}
+            candidate, score, plan = plan_best_candidate(
+                args.strategy,
+                args.metric,
+                leaders,
+                index,
+                missing,
+                history,
+                seed,
+                args.candidates,
+                away,
+            )
+            if args.candidates > 1:
+                print(
+                    f"Picked candidate {candidate} of {args.candidates} "
+                    f"with {args.metric} score {score:.2f}"
+                )
+            for week, rotation in plan:
+                rotation.roster = ROSTER_VERSION
+                rotations[week] = generated[week] = rotation
+
+            # The weeks saved after the horizon now follow a new plan: replace whoever no longer
+            # fits in them.
+            later = {w for w in rotations if w > missing[-1]}
+            if later:
+                planned = dict(rotations)
+                repaired = repair_rotations(leaders, rotations, missing[0], rng, away, later)
+                for week, rotation in repaired.items():
+                    if rotation != planned[week]:
+                        print(f"Updated {week}: {planned[week]} -> {rotation}")
+                    generated[week] = rotation
 
     print(f"Generated on {DATE}")
 
     print("\nThis week:")
-    this_week = get_week(DATE)
-    if args.force or not rotations.get(this_week):
-        rotations[this_week] = generate_rotation(leaders, rotations)
     print(f"{this_week}: {rotations[this_week]}")
 
     print("\nNext week:")
-    next_week = get_week(DATE + timedelta(weeks=1))
-    generated_next_week = False
-    if args.force or not rotations.get(next_week):
-        generated_next_week = True
-        rotations[next_week] = generate_rotation(leaders, rotations)
     print(f"{next_week}: {rotations[next_week]}")
 
+    upcoming = [w for w in sorted(rotations) if w > next_week]
+    if upcoming:
+        print("\nUpcoming:")
+        for week in upcoming:
+            print(f"{week}: {rotations[week]}")
+
+    with instrument.span("save"):
+        save_rotations(generated)
+
     print("\nHistory:")
-    for week, rotation in list(sorted(rotations.items(), reverse=True))[2:]:
-        print(f"{week}: {rotation}")
+    for week, rotation in sorted(rotations.items(), reverse=True):
+        if week < this_week:
+            print(f"{week}: {rotation}")
+
+    with instrument.span("render"):
+        generate_html(output=output, changed=generated)
+    return rotations
 
-    generate_html(rotations)
 
-    with SAVED_ROTATIONS_PATH.open(mode="wb") as f:
-        pickle.dump(rotations, f)
+def run(args):
+    rotations = update_rotations(args)
+    next_week = get_week(DATE + timedelta(weeks=1))
 
     print("")  # Add a newline between rotation output and calendar reminder output.
     try:
-        add_gcal_reminder(args.production, rotations[next_week], generated_next_week)
+        with instrument.span("calendar"):
+            add_gcal_reminder(args.production, rotations, next_week)
     except Exception as err:
         # If this script fails (returns a non-zero exit code), the triage rotation website will not
         # get updated. Since contacting the network to send a reminder can hit a lot of errors, we
         # catch all exceptions to be safe and avoid this possibility.
         # TODO: separate this into a separate build task to make generate rotation even safer.
-        if type(err) is HttpError:
+        # The Google client is only imported when it's used: don't import it just for this check.
+        google_errors = sys.modules.get("googleapiclient.errors")
+        if google_errors and isinstance(err, google_errors.HttpError):
             logging.exception(
                 "during network request when adding google calendar reminder"
             )
@@ -429,5 +1114,31 @@ def main():
             logging.exception("cause unknown")
 
 
+def main():
+    args = parse_args()
+    logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+    if args.profile_startup:
+        sys.exit(profile_startup(args))
+
+    instrument.start(trace_memory=args.metrics is not None)
+    profiler = None
+    if args.cprofile:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with instrument.span("total"):
+            run(args)
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(args.cprofile)
+            print(f"Wrote profile to {args.cprofile}")
+        if args.metrics:
+            instrument.write_metrics(args.metrics)
+            print(f"Wrote metrics to {args.metrics}")
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,263 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Serves the saved rotations as a JSON API, from memory. Expected usage:
+
+python serve.py --port 8000
+curl localhost:8000/api/weeks/current
+
+Endpoints:
+- /api/weeks/current and /api/weeks/next: the rotation of this week and next week.
+- /api/weeks/<yyyy-mm-dd>: the rotation of the week of that day.
+- /api/people/<nick>/upcoming: the weeks from this week on that <nick> is on duty.
+- /api/members: the people in the rotation.
+
+The history and the roster are loaded once into a Snapshot, which also keeps every response it
+sent, so requests don't touch the disk or run the generator. A watcher thread checks the journal
+and the roster file every --poll seconds and swaps in a new Snapshot when they change, e.g. after
+rotation.py ran. Responses have an ETag: clients that send it back in If-None-Match get an empty
+304 response until the answer changes.
+"""
+
+from datetime import datetime, timedelta, timezone
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+import argparse
+import bisect
+import hashlib
+import json
+import logging
+import os
+import threading
+import urllib.parse
+
+import rotation
+
+logger = logging.getLogger()
+
+
+def person_to_json(person):
+    return {
+        "id": person.id,
+        "name": person.name,
+        "nick": person.nick,
+        "geo": person.geo.name,
+        "lead": person.lead,
+        "tz": person.get_tz(),
+    }
+
+
+def rotation_to_json(week, r):
+    return {
+        "week": week,
+        "leader": person_to_json(r.leader),
+        "sheriffs": [person_to_json(s) for s in r.sheriffs],
+    }
+
+
+class Snapshot:
+    """The rotations and members at one point in time, with the responses computed from them."""
+
+    def __init__(self, rotations, members, signature):
+        self.rotations = rotations
+        self.members = members
+        self.signature = signature  # of the files it was loaded from, see RotationStore
+        self.duties = {}  # nick -> [(week, role)] in week order
+        for week, r in sorted(rotations.items()):
+            self.duties.setdefault(r.leader.nick, []).append((week, "leader"))
+            for sheriff in r.sheriffs:
+                self.duties.setdefault(sheriff.nick, []).append((week, "sheriff"))
+        self._responses = {}  # key -> (body, etag)
+
+    def response(self, key, build):
+        """Returns (body, etag) for the response cached under <key>, calling <build>() for the
+        JSON object to send the first time, or None if it returns None."""
+        cached = self._responses.get(key)
+        if cached is None:
+            content = build()
+            if content is None:
+                return None
+            body = json.dumps(content, ensure_ascii=False).encode("utf-8")
+            etag = '"{}"'.format(hashlib.sha256(body).hexdigest()[:20])
+            # Responses for the same key are the same, so it doesn't matter if another thread
+            # stores one first.
+            cached = self._responses[key] = (body, etag)
+        return cached
+
+    def week(self, week):
+        r = self.rotations.get(week)
+        return rotation_to_json(week, r) if r else None
+
+    def upcoming(self, nick, this_week):
+        duties = self.duties.get(nick)
+        if duties is None:
+            return None
+        first = bisect.bisect_left(duties, (this_week,))
+        return {
+            "nick": nick,
+            "duties": [{"week": week, "role": role} for week, role in duties[first:]],
+        }
+
+
+class RotationStore:
+    """Keeps the Snapshot of the journal at <journal_path> and the roster at <roster_path>."""
+
+    def __init__(self, journal_path, roster_path):
+        self.journal_path = Path(journal_path)
+        self.roster_path = Path(roster_path)
+        self.snapshot = self._load()
+
+    def _signature(self):
+        signature = []
+        for path in (self.journal_path, self.roster_path):
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                signature.append(None)
+            else:
+                signature.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+        return tuple(signature)
+
+    def _load(self):
+        # Taken first so that a change made while loading is picked up by the next check.
+        signature = self._signature()
+        rotation.use_roster(self.roster_path)
+        rotation.SAVED_ROTATIONS_PATH = self.journal_path
+        return Snapshot(rotation.load_rotations(), list(rotation.MEMBERS), signature)
+
+    def refresh(self):
+        """Loads a new Snapshot if the files changed since the current one and returns whether it
+        did."""
+        if self._signature() == self.snapshot.signature:
+            return False
+        self.snapshot = self._load()
+        logger.info(f"Reloaded {len(self.snapshot.rotations)} weeks from {self.journal_path}")
+        return True
+
+    def watch(self, interval, stop):
+        """Calls refresh() every <interval> seconds until the <stop> event is set."""
+        while not stop.wait(interval):
+            try:
+                self.refresh()
+            except Exception:
+                # Keep serving the last good snapshot, e.g. if the journal is being rewritten.
+                logger.exception(f"unable to reload {self.journal_path}")
+
+
+class RotationRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # Keep connections open for clients that poll.
+    # The headers and the body are written separately: don't wait for the ACK of the headers.
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        snapshot = self.server.store.snapshot
+        this_week = rotation.get_week(datetime.now(timezone.utc))
+        parts = urllib.parse.urlsplit(self.path).path.strip("/").split("/")
+        match parts:
+            case ["api", "weeks", "current"]:
+                response = snapshot.response(("week", this_week), lambda: snapshot.week(this_week))
+            case ["api", "weeks", "next"]:
+                week = rotation.get_week(datetime.now(timezone.utc) + timedelta(weeks=1))
+                response = snapshot.response(("week", week), lambda: snapshot.week(week))
+            case ["api", "weeks", day]:
+                try:
+                    week = rotation.get_week(datetime.strptime(day, "%Y-%m-%d"))
+                except ValueError:
+                    return self._send_error(HTTPStatus.BAD_REQUEST, "Give weeks as yyyy-mm-dd")
+                response = snapshot.response(("week", week), lambda: snapshot.week(week))
+            case ["api", "people", nick, "upcoming"]:
+                response = snapshot.response(
+                    ("upcoming", nick, this_week), lambda: snapshot.upcoming(nick, this_week)
+                )
+            case ["api", "members"]:
+                response = snapshot.response(
+                    ("members",), lambda: [person_to_json(m) for m in snapshot.members]
+                )
+            case _:
+                return self._send_error(HTTPStatus.NOT_FOUND, "Unknown endpoint")
+        if response is None:
+            return self._send_error(HTTPStatus.NOT_FOUND, "No rotation found")
+
+        body, etag = response
+        if_none_match = [t.strip() for t in self.headers.get("If-None-Match", "").split(",")]
+        if etag in if_none_match or "*" in if_none_match:
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self._send_json(HTTPStatus.OK, body, etag)
+
+    def _send_json(self, status, body, etag=None):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        if etag:
+            self.send_header("ETag", etag)
+            # Clients can keep the response but have to check it's still current.
+            self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message):
+        self._send_json(status, json.dumps({"error": message}).encode("utf-8"))
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+def serve(store, host, port, poll):
+    """Serves the rotations in <store> until interrupted, refreshing it every <poll> seconds."""
+    server = ThreadingHTTPServer((host, port), RotationRequestHandler)
+    server.store = store
+    stop = threading.Event()
+    watcher = threading.Thread(target=store.watch, args=(poll, stop), daemon=True)
+    watcher.start()
+    weeks = len(store.snapshot.rotations)
+    print(f"Serving {weeks} weeks on http://{host}:{server.server_port}/api/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--host", default="localhost", help="Address to listen on (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--port", type=int, default=8000, help="Port to listen on (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--journal",
+        default=rotation.SAVED_ROTATIONS_PATH,
+        help="Rotation journal to serve (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--roster", default=rotation.ROSTER_PATH, help="Roster file (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--poll",
+        type=float,
+        default=1.0,
+        metavar="SECONDS",
+        help="How often to check the journal and roster for changes (default: %(default)s)",
+    )
+    parser.add_argument("--debug", action="store_true", help="Log every request")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logger.setLevel(logging.DEBUG if args.debug else logging.INFO)
+    serve(RotationStore(args.journal, args.roster), args.host, args.port, args.poll)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Monte Carlo simulation of the rotation algorithm in rotation.py. Expected usage:
+
+python simulate.py --runs 10000 --years 10
+python simulate.py --check  # compare the simulation against generate_rotation()
+
+The members are encoded as arrays (geo codes and lead flags) and thousands of independent rotation
+histories are advanced one week at a time with NumPy, following the same rules as
+generate_rotation(): recent leaders can't lead again for len(leaders) // 2 weeks, nobody can be a
+sheriff within SHERIFF_COOLDOWN weeks of being on duty, and when the leader and the first sheriff
+don't share enough working hours, the second sheriff must share enough with one of them (see
+OverlapMatrix). Simulated weeks are the weeks from this week on, so the working hours shared
+follow DST like they do in generate_rotation(). Every choice is uniform over the eligible
+candidates, as random.choice() and the sheriff pick are.
+
+This needs NumPy, which isn't needed to generate the rotation: pip install -r
+requirements-analysis.txt
+"""
+
+from dataclasses import dataclass
+from datetime import timedelta
+import argparse
+import random
+import sys
+
+import numpy as np
+
+import rotation
+
+# Marks "never" in the last-duty arrays: far enough back that nobody is excluded by it.
+NEVER = -(2**30)
+NO_ONE = -1
+
+
+@dataclass
+class SimulationResult:
+    members: list
+    weeks: int  # weeks counted in the statistics, per run
+    runs: int
+    total_weeks: int  # weeks counted in the statistics, across all runs
+    lead_counts: np.ndarray  # [member]: total times led across all runs
+    sheriff_counts: np.ndarray  # [member]: total times sheriffed across all runs
+    gap_histogram: np.ndarray  # [gap]: number of duties that came <gap> weeks after the previous one
+    gap_sum: np.ndarray  # [member]
+    gap_sum_squares: np.ndarray  # [member]
+    gap_count: np.ndarray  # [member]
+    gap_max: np.ndarray  # [member]
+    uncovered: np.ndarray  # [geo]: number of weeks no one on duty was in the geo
+    no_leader: int  # weeks with no eligible leader (generate_rotation() would raise)
+    missing_sheriffs: int  # sheriff slots left empty because the pool ran out
+
+    def lead_rate(self):
+        """Returns how often each member leads, per week."""
+        return self.lead_counts / self.total_weeks
+
+    def sheriff_rate(self):
+        """Returns how often each member sheriffs, per week."""
+        return self.sheriff_counts / self.total_weeks
+
+    def gap_mean(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.gap_sum / self.gap_count
+
+    def gap_std(self):
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self.gap_sum / self.gap_count
+            return np.sqrt(np.maximum(self.gap_sum_squares / self.gap_count - mean**2, 0))
+
+    def gap_percentiles(self, percentiles=(50, 90, 99)):
+        """Returns the percentiles of the gap between consecutive duties, across everyone."""
+        cumulative = np.cumsum(self.gap_histogram)
+        total = cumulative[-1] if len(cumulative) else 0
+        if not total:
+            return [None for _ in percentiles]
+        return [int(np.searchsorted(cumulative, total * p / 100)) for p in percentiles]
+
+
+def encode_members(members):
+    """Returns the geo codes, timezone codes and lead flags of <members> as arrays, indexed like
+    <members>, and the timezones the timezone codes stand for."""
+    geos = list(rotation.Geo)
+    timezones = sorted({m.get_tz() for m in members})
+    geo = np.array([geos.index(m.geo) for m in members], dtype=np.int8)
+    tz = np.array([timezones.index(m.get_tz()) for m in members], dtype=np.int16)
+    lead = np.array([m.lead for m in members], dtype=bool)
+    return geo, tz, lead, timezones
+
+
+def get_week(week):
+    """Returns the week (yyyy-mm-dd) simulated as week number <week>."""
+    return rotation.get_week(rotation.DATE + timedelta(weeks=week))
+
+
+def pairable_matrix(timezones, week):
+    """Returns [a, b]: whether the timezones coded a and b share enough working hours in <week>."""
+    overlap = rotation.get_overlap_matrix(frozenset(timezones), week)
+    return np.array([[b in overlap.pairable[a] for b in timezones] for a in timezones])
+
+
+def _pick(rng, eligible):
+    """Picks one eligible column uniformly at random for each row of <eligible>. Returns the picked
+    columns and whether each row had anyone eligible."""
+    keys = rng.random(eligible.shape)
+    keys[~eligible] = -1
+    return keys.argmax(axis=1), eligible.any(axis=1)
+
+
+def simulate(members=None, weeks=520, runs=1000, seed=None, burn_in=None, stop_when_stuck=False):
+    """Simulates <runs> independent histories of <weeks> weeks each, starting without any history.
+    The first <burn_in> weeks (by default, one per leader like main() does to bootstrap history)
+    are not counted in the statistics.
+
+    When no one is eligible to lead, generate_rotation() raises. By default the simulation carries
+    on by picking any leader; with <stop_when_stuck>, the history ends there instead.
+    """
+    members = rotation.MEMBERS if members is None else members
+    geo, tz, lead, timezones = encode_members(members)
+    leaders = [m for m in members if m.lead]
+    lead_cooldown = len(leaders) // 2
+    cooldown = rotation.SHERIFF_COOLDOWN
+    burn_in = len(leaders) if burn_in is None else burn_in
+    rng = np.random.default_rng(seed)
+
+    n = len(members)
+    rows = np.arange(runs)
+    last_led = np.full((runs, n), NEVER, dtype=np.int64)
+    last_sheriffed = np.full((runs, n), NEVER, dtype=np.int64)
+
+    lead_counts = np.zeros(n, dtype=np.int64)
+    sheriff_counts = np.zeros(n, dtype=np.int64)
+    gap_histogram = np.zeros(weeks + burn_in + 1, dtype=np.int64)
+    gap_sum = np.zeros(n, dtype=np.float64)
+    gap_sum_squares = np.zeros(n, dtype=np.float64)
+    gap_count = np.zeros(n, dtype=np.int64)
+    gap_max = np.zeros(n, dtype=np.int64)
+    uncovered = np.zeros(len(rotation.Geo), dtype=np.int64)
+    no_leader = 0
+    missing_sheriffs = 0
+    total_weeks = 0
+    alive = np.ones(runs, dtype=bool)
+
+    for week in range(burn_in + weeks):
+        counted = week >= burn_in
+
+        # pick a leader
+        can_lead = lead & (last_led < week - lead_cooldown) & (last_sheriffed < week - cooldown)
+        leader, has_leader = _pick(rng, can_lead)
+        if not has_leader.all():
+            # generate_rotation() would raise here: fall back to any leader to keep going.
+            fallback, _ = _pick(rng, np.broadcast_to(lead, can_lead.shape))
+            leader = np.where(has_leader, leader, fallback)
+            no_leader += int((alive & ~has_leader).sum()) if counted else 0
+            if stop_when_stuck:
+                alive &= has_leader
+
+        # pick sheriffs
+        can_sheriff = (last_led < week - cooldown) & (last_sheriffed < week - cooldown)
+        can_sheriff[rows, leader] = False
+        first, has_first = _pick(rng, can_sheriff)
+        can_sheriff[rows, first] = False
+        leader_geo = geo[leader]
+        leader_tz = tz[leader]
+        first_tz = np.where(has_first, tz[first], leader_tz)
+        # if the leader and the first sheriff don't share enough working hours, the second sheriff
+        # has to share enough with one of them
+        pairable = pairable_matrix(timezones, get_week(week))
+        can_sheriff &= (
+            pairable[leader_tz, first_tz][:, None]
+            | pairable[leader_tz][:, tz]
+            | pairable[first_tz][:, tz]
+        )
+        second, has_second = _pick(rng, can_sheriff)
+        first = np.where(has_first, first, NO_ONE)
+        second = np.where(has_second, second, NO_ONE)
+
+        if counted:
+            has_first &= alive
+            has_second &= alive
+            total_weeks += int(alive.sum())
+            on_duty = [(leader, alive), (first, has_first), (second, has_second)]
+            last_duty = np.maximum(last_led, last_sheriffed)
+            for person, present in on_duty:
+                people = person[present]
+                last = last_duty[rows[present], people]
+                gaps, people = week - last[last > NEVER], people[last > NEVER]
+                gap_histogram += np.bincount(gaps, minlength=len(gap_histogram))[: len(gap_histogram)]
+                np.add.at(gap_sum, people, gaps)
+                np.add.at(gap_sum_squares, people, gaps.astype(np.float64) ** 2)
+                np.add.at(gap_count, people, 1)
+                np.maximum.at(gap_max, people, gaps)
+
+            lead_counts += np.bincount(leader[alive], minlength=n)
+            sheriff_counts += np.bincount(first[has_first], minlength=n)
+            sheriff_counts += np.bincount(second[has_second], minlength=n)
+            missing_sheriffs += int((alive & ~has_first).sum() + (alive & ~has_second).sum())
+
+            for code in range(len(uncovered)):
+                covered = (
+                    (leader_geo == code)
+                    | (has_first & (geo[first] == code))
+                    | (has_second & (geo[second] == code))
+                )
+                uncovered[code] += int((alive & ~covered).sum())
+
+        last_led[rows, leader] = week
+        last_sheriffed[rows[has_first], first[has_first]] = week
+        last_sheriffed[rows[has_second], second[has_second]] = week
+
+    return SimulationResult(
+        members=members,
+        weeks=weeks,
+        runs=runs,
+        total_weeks=total_weeks,
+        lead_counts=lead_counts,
+        sheriff_counts=sheriff_counts,
+        gap_histogram=gap_histogram,
+        gap_sum=gap_sum,
+        gap_sum_squares=gap_sum_squares,
+        gap_count=gap_count,
+        gap_max=gap_max,
+        uncovered=uncovered,
+        no_leader=no_leader,
+        missing_sheriffs=missing_sheriffs,
+    )
+
+
+def _run_generate_rotation(weeks, runs, burn_in, seed):
+    """Returns lead and sheriff counts, the gap histogram, geo coverage and the number of counted
+    weeks of <runs> histories generated with generate_rotation(). A history ends early if
+    generate_rotation() can't find a leader."""
+    members = rotation.MEMBERS
+    position = {m.id: i for i, m in enumerate(members)}
+    geos = list(rotation.Geo)
+    leaders = [m for m in members if m.lead]
+    lead_counts = np.zeros(len(members), dtype=np.int64)
+    sheriff_counts = np.zeros(len(members), dtype=np.int64)
+    gap_histogram = np.zeros(burn_in + weeks + 1, dtype=np.int64)
+    uncovered = np.zeros(len(geos), dtype=np.int64)
+    total_weeks = 0
+    rng = random.Random(seed)
+    for _ in range(runs):
+        index = rotation.RotationIndex(rotation.history_window(leaders))
+        last_duty = {}
+        for week in range(burn_in + weeks):
+            try:
+                r = rotation.generate_rotation(leaders, index, rng, week=get_week(week))
+            except IndexError:
+                break
+            index.add(get_week(week), r)
+            on_duty = [r.leader] + r.sheriffs
+            if week >= burn_in:
+                total_weeks += 1
+                lead_counts[position[r.leader.id]] += 1
+                for sheriff in r.sheriffs:
+                    sheriff_counts[position[sheriff.id]] += 1
+                for person in on_duty:
+                    if person.id in last_duty:
+                        gap_histogram[week - last_duty[person.id]] += 1
+                for geo in set(geos) - {p.geo for p in on_duty}:
+                    uncovered[geos.index(geo)] += 1
+            for person in on_duty:
+                last_duty[person.id] = week
+    return lead_counts, sheriff_counts, gap_histogram, uncovered, total_weeks
+
+
+def _compare(name, labels, simulated, counts, samples, tolerance):
+    """Returns (name, label, simulated, expected) for each proportion in <simulated> that is more
+    than <tolerance> standard errors away from <counts> / <samples>."""
+    mismatches = []
+    for label, s, count in zip(labels, simulated, counts):
+        e = count / samples
+        # Weeks within a history aren't independent so treat this as a loose bound.
+        error = np.sqrt(max(e * (1 - e), 1 / samples) / samples)
+        if abs(s - e) > tolerance * error:
+            mismatches.append((name, label, s, e))
+    return mismatches
+
+
+def check_equivalence(weeks=104, runs=100, seed=0, tolerance=5):
+    """Compares the simulation against histories generated by generate_rotation(): each member's
+    lead and sheriff rates, the distribution of gaps between duties and how often each geo is
+    uncovered. Returns the list of (statistic, label, simulated, expected) proportions that differ
+    by more than <tolerance> standard errors."""
+    leaders = [m for m in rotation.MEMBERS if m.lead]
+    result = simulate(
+        weeks=weeks, runs=runs * 100, seed=seed, burn_in=len(leaders), stop_when_stuck=True
+    )
+    lead_counts, sheriff_counts, gap_histogram, uncovered, samples = _run_generate_rotation(
+        weeks, runs, len(leaders), seed
+    )
+    nicks = [m.nick for m in rotation.MEMBERS]
+    gaps = range(len(gap_histogram))
+    return (
+        _compare("lead rate", nicks, result.lead_rate(), lead_counts, samples, tolerance)
+        + _compare("sheriff rate", nicks, result.sheriff_rate(), sheriff_counts, samples, tolerance)
+        + _compare(
+            "gap",
+            gaps,
+            result.gap_histogram / result.gap_histogram.sum(),
+            gap_histogram,
+            gap_histogram.sum(),
+            tolerance,
+        )
+        + _compare(
+            "uncovered",
+            [g.name for g in rotation.Geo],
+            result.uncovered / result.total_weeks,
+            uncovered,
+            samples,
+            tolerance,
+        )
+    )
+
+
+def print_report(result):
+    print(f"Simulated {result.runs} histories of {result.weeks} weeks")
+    print(f"\n{'member':<30}{'geo':>4}{'lead/yr':>9}{'sheriff/yr':>12}{'gap':>7}{'±':>6}{'max':>6}")
+    gap_mean, gap_std = result.gap_mean(), result.gap_std()
+    for i, member in enumerate(result.members):
+        print(
+            f"{repr(member):<30}{member.geo.value:>4}"
+            f"{result.lead_rate()[i] * 52:>9.2f}{result.sheriff_rate()[i] * 52:>12.2f}"
+            f"{gap_mean[i]:>7.1f}{gap_std[i]:>6.1f}{result.gap_max[i]:>6}"
+        )
+
+    p50, p90, p99 = result.gap_percentiles()
+    print(f"\nWeeks between duties: median {p50}, 90th percentile {p90}, 99th percentile {p99}")
+    total_weeks = result.total_weeks
+    print("\nWeeks without anyone on duty in:")
+    for geo, count in zip(rotation.Geo, result.uncovered):
+        print(f"{geo.value} {geo.name}: {count / total_weeks:.1%}")
+    print(f"\nWeeks without an eligible leader: {result.no_leader / total_weeks:.2%}")
+    print(f"Sheriff slots left empty: {result.missing_sheriffs / (2 * total_weeks):.2%}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=1000, help="Number of independent histories")
+    parser.add_argument("--years", type=int, default=10, help="Length of each history")
+    parser.add_argument("--seed", type=int, help="Seed for reproducible results")
+    parser.add_argument(
+        "--check",
+        action="store_true",
+        help="Check the simulation against generate_rotation() instead of reporting",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.check:
+        mismatches = check_equivalence(seed=args.seed or 0)
+        for statistic, label, simulated, expected in mismatches:
+            print(
+                f"{statistic} {label}: simulated {simulated:.4f}, "
+                f"generate_rotation {expected:.4f}"
+            )
+        if mismatches:
+            sys.exit(1)
+        print("Simulation matches generate_rotation()")
+        return
+    print_report(simulate(weeks=args.years * 52, runs=args.runs, seed=args.seed))
+
+
+if __name__ == "__main__":
+    main()
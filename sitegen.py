@@ -0,0 +1,185 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Builds the website in docs/ from the templates in templates/. Expected usage:
+
+written = build_site(rotations, this_week, next_week, timestamp)
+
+The index page shows this week, next week, the upcoming weeks and the last RECENT_WEEKS weeks of
+history, so its size doesn't grow with the history. Older weeks are archived in one page per year
+under history/.
+
+Pages and the assets they load go through the publish stage in publish.py: they are minified,
+Bootstrap is vendored and purged and the assets get content-hashed names.
+
+Each page is only rendered and written when its inputs changed: the hash of the templates, assets
+and rotations on a page is recorded in MANIFEST_NAME, and a page whose hash matches is skipped. The
+"Updated on" timestamp is not part of the hash, so it tells when the page content last changed.
+Assets are recorded in the manifest too so they are only rewritten when their content changes.
+
+The manifest also records the hash of the weeks in each yearly archive under ARCHIVES_KEY, so the
+site can be updated from the most recent years of history alone: the archives of earlier years are
+kept as they are unless they have to be rendered again, e.g. because the templates changed or a new
+year was added to the links between them, and only then is the whole history needed.
+"""
+
+from pathlib import Path
+import functools
+import hashlib
+import json
+import logging
+
+import publish
+
+OUTPUT_PATH = Path("docs")
+TEMPLATES_PATH = Path(__file__).parent / "templates"
+# Records the hash of the inputs of each generated page, relative to the output directory.
+MANIFEST_NAME = ".site-manifest.json"
+# Key of the manifest that maps each archived year to the hash of its weeks.
+ARCHIVES_KEY = "archives"
+
+# Number of weeks of history shown on the index page: the rest is in the yearly archives.
+RECENT_WEEKS = 8
+
+logger = logging.getLogger()
+
+
+@functools.lru_cache(maxsize=None)
+def get_environment():
+    """Returns the Jinja2 environment, created once per process so templates are only compiled the
+    first time they are used."""
+    import jinja2
+
+    return jinja2.Environment(loader=jinja2.FileSystemLoader(TEMPLATES_PATH), autoescape=True)
+
+
+@functools.lru_cache(maxsize=None)
+def _template_sources():
+    return {path.name: path.read_text() for path in sorted(TEMPLATES_PATH.glob("*.html"))}
+
+
+@functools.lru_cache(maxsize=None)
+def _templates_hash():
+    digest = hashlib.sha256()
+    for name, source in _template_sources().items():
+        digest.update(name.encode() + b"\0" + source.encode())
+    return digest.hexdigest()
+
+
+def _inputs_hash(template, context, assets):
+    asset_names = {url: name for url, (name, _) in assets.items()}
+    inputs = json.dumps(
+        [_templates_hash(), asset_names, template, context], sort_keys=True, default=str
+    )
+    return hashlib.sha256(inputs.encode()).hexdigest()
+
+
+def _read_manifest(output):
+    try:
+        with (output / MANIFEST_NAME).open() as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _weeks_hash(weeks):
+    return hashlib.sha256(json.dumps(weeks, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _pages(rotations, this_week, next_week, archived):
+    """Yields (page path, template name, context) for each page of the site. The years in
+    <archived> aren't in <rotations>: their archives get a context without "history"."""
+    history = {w: r for w, r in sorted(rotations.items(), reverse=True) if w < this_week}
+    years = sorted({week[:4] for week in history} | set(archived), reverse=True)
+
+    yield "calculator.html", "calculator.html", {"root": ""}
+    yield "index.html", "index.html", {
+        "root": "",
+        "this_week": rotations[this_week],
+        "next_week": rotations[next_week],
+        "upcoming": {w: r for w, r in sorted(rotations.items()) if w > next_week},
+        "history": dict(list(history.items())[:RECENT_WEEKS]),
+        "years": years,
+    }
+    for year in years:
+        context = {"root": "../", "year": year, "years": years}
+        if year not in archived:
+            context["history"] = {w: r for w, r in history.items() if w.startswith(year)}
+        yield f"history/{year}.html", "history.html", context
+
+
+def _write_assets(output, assets, manifest):
+    written = []
+    for name, content in assets.values():
+        path = output / name
+        digest = hashlib.sha256(content).hexdigest()
+        if manifest.get(name) == digest and path.exists():
+            continue
+        publish.write_compressed(path, content)
+        manifest[name] = digest
+        written.append(path)
+
+    names = {name for name, _ in assets.values()}
+    publish.remove_stale_assets(output, names)
+    for name in list(manifest):
+        if name.startswith(publish.ASSETS_DIR + "/") and name not in names:
+            del manifest[name]
+    return written
+
+
+def build_site(
+    rotations, this_week, next_week, timestamp, output=OUTPUT_PATH, load_history=None
+):
+    """Writes the pages for <rotations>, a dict of Rotation keyed by week, and the assets they load
+    to <output> and returns the paths of the files that changed.
+
+    If <load_history> is given, <rotations> can leave out the years before the first one it has
+    weeks of, as long as it has every week from then on. Their archives are kept as they are and
+    load_history(), which returns every week, is only called if one of them has to be rendered
+    again.
+    """
+    manifest = _read_manifest(output)
+    assets = publish.build_assets(list(_template_sources().values()))
+
+    archived = {}
+    if load_history is not None:
+        if ARCHIVES_KEY in manifest:
+            first_year = min(rotations)[:4]
+            archived = {y: h for y, h in manifest[ARCHIVES_KEY].items() if y < first_year}
+        else:
+            # Built before the archives were recorded, or not built yet.
+            rotations = load_history()
+
+    archives = {}
+    pages = []
+    for name, template, context in _pages(rotations, this_week, next_week, archived):
+        inputs = context
+        if template == "history.html":
+            year = context["year"]
+            archives[year] = archived.get(year) or _weeks_hash(context["history"])
+            inputs = dict(context, history=archives[year])
+        digest = _inputs_hash(template, inputs, assets)
+        if manifest.get(name) == digest and (output / name).exists():
+            logger.debug(f"Skipping {output / name}: unchanged")
+        else:
+            pages.append((name, template, context, digest))
+
+    if any(context.get("year") in archived for _, _, context, _ in pages):
+        logger.debug("Reading the whole history to render the archives of earlier years again")
+        return build_site(load_history(), this_week, next_week, timestamp, output)
+
+    written = _write_assets(output, assets, manifest)
+    for name, template, context, digest in pages:
+        path = output / name
+        html = get_environment().get_template(template).render(context, timestamp=timestamp)
+        html = publish.finalize_page(html, assets, context["root"])
+        publish.write_compressed(path, html.encode("utf-8"))
+        manifest[name] = digest
+        written.append(path)
+
+    if written or manifest.get(ARCHIVES_KEY) != archives:
+        manifest[ARCHIVES_KEY] = archives
+        with (output / MANIFEST_NAME).open("w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+    return written
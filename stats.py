@@ -0,0 +1,297 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Counts how often each person has been on duty. Expected usage:
+
+python stats.py report --last 52  # duties per person and geo over the last year
+python stats.py report --since 2023-01-02 --until 2024-01-01 --window 8
+python stats.py export  # only write the columns, e.g. to load them with NumPy elsewhere
+
+The history is exported from the journal to one NumPy array per column in COLUMNS_PATH, with a row
+per person on duty each week, in week order:
+- week.npy: the Monday of the week, in days since 1970-01-01 (int32).
+- role.npy: LEADER or SHERIFF (int8).
+- member.npy: the id of the person in the roster (int32).
+- geo.npy: the position of the person's current Geo in rotation.Geo (int8).
+meta.json says which journal the columns were exported from. The report exports them again when the
+journal changed, then memory-maps them, so it only reads the rows of the weeks it reports on, and
+computes everything with NumPy group-bys rather than a loop over the weeks:
+- How many times each person led and sheriffed, and how many weeks there were between their duties.
+- Their workload over --window weeks: the most duties they had in any --window consecutive weeks,
+and the duties in the last --window weeks of the report.
+- How many times people of each geo led and sheriffed.
+"""
+
+from datetime import date, datetime, timedelta
+from pathlib import Path
+import argparse
+import json
+import os
+import sys
+
+import numpy as np
+
+import journal
+import rotation
+
+COLUMNS_PATH = Path("rotations-columns")
+COLUMNS = {"week": np.int32, "role": np.int8, "member": np.int32, "geo": np.int8}
+# Bumped when the layout of the columns changes.
+COLUMNS_VERSION = 1
+LEADER, SHERIFF = 0, 1
+DEFAULT_WINDOW = 8
+# Weeks are saved as days since 1970-01-01.
+EPOCH = date(1970, 1, 1).toordinal()
+
+
+def _journal_signature(journal_path):
+    stat = os.stat(journal_path)
+    return {"path": str(journal_path), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def export_columns(journal_path, directory=COLUMNS_PATH):
+    """Writes the columns of the rotations in the journal at <journal_path> to <directory> and
+    returns the number of rows."""
+    signature = _journal_signature(journal_path)
+    records = journal.read_weeks(journal_path)
+    geos = {geo: i for i, geo in enumerate(rotation.Geo)}
+    weeks, roles, members = [], [], []
+    for week, record in records.items():
+        days = _days(week)
+        on_duty = [record["leader"]] + record["sheriffs"]
+        weeks += [days] * len(on_duty)
+        roles += [LEADER] + [SHERIFF] * len(record["sheriffs"])
+        members += on_duty
+    columns = {
+        "week": np.array(weeks, dtype=COLUMNS["week"]),
+        "role": np.array(roles, dtype=COLUMNS["role"]),
+        "member": np.array(members, dtype=COLUMNS["member"]),
+        "geo": np.array([geos[rotation.ROSTER[m].geo] for m in members], dtype=COLUMNS["geo"]),
+    }
+    # The journal is in week order as strings, which doesn't hold for years before 1000.
+    order = np.argsort(columns["week"], kind="stable")
+
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    # Written last, so that columns interrupted halfway through are exported again.
+    (directory / "meta.json").unlink(missing_ok=True)
+    for name, column in columns.items():
+        np.save(directory / f"{name}.npy", column[order])
+    with open(directory / "meta.json", "w") as f:
+        json.dump(
+            {
+                "version": COLUMNS_VERSION,
+                "journal": signature,
+                "geos": [geo.name for geo in rotation.Geo],
+                "rows": len(members),
+            },
+            f,
+            indent=1,
+        )
+    return len(members)
+
+
+def is_up_to_date(journal_path, directory=COLUMNS_PATH):
+    """Returns whether the columns in <directory> were exported from the journal as it is now."""
+    try:
+        with open(Path(directory) / "meta.json") as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return False
+    return (
+        meta.get("version") == COLUMNS_VERSION
+        and meta["journal"] == _journal_signature(journal_path)
+        and meta["geos"] == [geo.name for geo in rotation.Geo]
+    )
+
+
+def load_columns(directory=COLUMNS_PATH):
+    """Returns a dict of column name to the memory-mapped array saved in <directory>."""
+    return {
+        name: np.load(Path(directory) / f"{name}.npy", mmap_mode="r") for name in COLUMNS
+    }
+
+
+def _days(week):
+    # Much faster than strptime(), which matters when exporting centuries of history.
+    return date(*map(int, week.split("-"))).toordinal() - EPOCH
+
+
+def _week(days):
+    return date.fromordinal(EPOCH + int(days)).isoformat()
+
+
+def select_weeks(columns, since=None, until=None):
+    """Returns the rows of <columns> from the week of <since> until the week before <until> (both
+    yyyy-mm-dd, or None for no limit), as arrays read from the memory-mapped columns."""
+    week = columns["week"]
+    first = np.searchsorted(week, _days(since), "left") if since else 0
+    last = np.searchsorted(week, _days(until), "left") if until else len(week)
+    return {name: np.asarray(column[first:last]) for name, column in columns.items()}
+
+
+def person_stats(rows, window=DEFAULT_WINDOW):
+    """Returns a dict of statistics for the people on duty in <rows>, which can't be empty: the
+    "member" ids, in increasing order, and arrays aligned with them.
+
+    "leads", "sheriffs": how many times they led and sheriffed.
+    "first", "last": the first and last week they were on duty, in days since 1970-01-01.
+    "mean_gap", "min_gap", "max_gap": the weeks between their duties (NaN or 0 with a single duty).
+    "peak": the most duties they had in any <window> consecutive weeks.
+    "recent": their duties in the last <window> weeks of <rows>.
+    """
+    member = rows["member"]
+    role = rows["role"]
+
+    # Group the duties of each person together, in week order.
+    order = np.lexsort((rows["week"], member))
+    member = member[order]
+    days = rows["week"][order].astype(np.int64)
+    week = days // 7  # Mondays are 7 days apart, so differences between them are whole weeks.
+    role = role[order]
+    starts = np.flatnonzero(np.r_[True, member[1:] != member[:-1]])
+    ends = np.r_[starts[1:], len(member)]
+    counts = ends - starts
+
+    # gaps[i] is the gap to the next duty of the same person, or a neutral value at the last one.
+    same = np.r_[member[1:] == member[:-1], False]
+    gaps = np.r_[np.diff(week), 0]
+    first, last = days[starts], days[ends - 1]
+
+    # Duties of the same person within the window ending at each duty, from sorted keys.
+    keys = member.astype(np.int64) * (week.max() - week.min() + window + 1) + (week - week.min())
+    in_window = np.arange(len(keys)) - np.searchsorted(keys, keys - (window - 1), "left") + 1
+    recent = np.bincount(
+        np.repeat(np.arange(len(starts)), counts)[week > week.max() - window],
+        minlength=len(starts),
+    )
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_gap = (week[ends - 1] - week[starts]) / (counts - 1)
+    return {
+        "member": member[starts],
+        "leads": np.add.reduceat(role == LEADER, starts, dtype=np.int64),
+        "sheriffs": np.add.reduceat(role == SHERIFF, starts, dtype=np.int64),
+        "first": first,
+        "last": last,
+        "mean_gap": mean_gap,
+        "min_gap": np.where(
+            counts > 1,
+            np.minimum.reduceat(np.where(same, gaps, np.iinfo(np.int64).max), starts),
+            0,
+        ),
+        "max_gap": np.maximum.reduceat(np.where(same, gaps, 0), starts),
+        "peak": np.maximum.reduceat(in_window, starts),
+        "recent": recent,
+    }
+
+
+def geo_stats(rows):
+    """Returns (leads, sheriffs) arrays with the number of duties of each rotation.Geo in <rows>."""
+    geos = len(rotation.Geo)
+    leads = np.bincount(rows["geo"][rows["role"] == LEADER], minlength=geos)
+    sheriffs = np.bincount(rows["geo"][rows["role"] == SHERIFF], minlength=geos)
+    return leads, sheriffs
+
+
+def print_report(rows, window):
+    weeks = len(np.unique(rows["week"]))
+    if not weeks:
+        print("No rotations in these weeks")
+        return
+    print(f"{weeks} weeks from {_week(rows['week'][0])} to {_week(rows['week'][-1])}")
+
+    stats = person_stats(rows, window)
+    # Current members who weren't on duty are listed too.
+    on_duty = set(stats["member"].tolist())
+    idle = [m.id for m in rotation.MEMBERS if m.id not in on_duty]
+    print(
+        f"\n{'member':<30}{'geo':>4}{'lead':>6}{'sheriff':>9}{'last':>12}"
+        f"{'gap':>7}{'min':>5}{'max':>5}{f'peak/{window}w':>10}{f'last {window}w':>9}"
+    )
+    totals = stats["leads"] + stats["sheriffs"]
+    for i in np.lexsort((stats["member"], -totals)):
+        person = rotation.ROSTER.get(int(stats["member"][i]))
+        name = repr(person) if person else f"#{stats['member'][i]}"
+        geo = person.geo.value if person else "?"
+        print(
+            f"{name:<30}{geo:>4}{stats['leads'][i]:>6}{stats['sheriffs'][i]:>9}"
+            f"{_week(stats['last'][i]):>12}{stats['mean_gap'][i]:>7.1f}{stats['min_gap'][i]:>5}"
+            f"{stats['max_gap'][i]:>5}{stats['peak'][i]:>10}{stats['recent'][i]:>9}"
+        )
+    for member_id in idle:
+        person = rotation.ROSTER[member_id]
+        print(f"{repr(person):<30}{person.geo.value:>4}{0:>6}{0:>9}{'-':>12}")
+
+    leads, sheriffs = geo_stats(rows)
+    print(f"\n{'geo':<20}{'lead':>6}{'sheriff':>9}{'share':>8}")
+    total = leads.sum() + sheriffs.sum()
+    for geo, lead_count, sheriff_count in zip(rotation.Geo, leads, sheriffs):
+        share = (lead_count + sheriff_count) / total
+        print(f"{geo.value} {geo.name:<17}{lead_count:>6}{sheriff_count:>9}{share:>8.1%}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--journal",
+        type=Path,
+        default=rotation.SAVED_ROTATIONS_PATH,
+        help="Rotation journal (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--columns",
+        type=Path,
+        default=COLUMNS_PATH,
+        help="Directory of the exported columns (default: %(default)s)",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("export", help="Export the journal to columns")
+    report = subparsers.add_parser("report", help="Report the duties of each person and geo")
+    report.add_argument("--since", metavar="WEEK", help="Start from the week of WEEK (yyyy-mm-dd)")
+    report.add_argument("--until", metavar="WEEK", help="Stop before the week of WEEK (yyyy-mm-dd)")
+    report.add_argument(
+        "--last", type=int, metavar="N", help="Only the last N weeks, up to and including this week"
+    )
+    report.add_argument(
+        "--window",
+        type=int,
+        default=DEFAULT_WINDOW,
+        metavar="N",
+        help="Weeks to measure the workload over (default: %(default)s)",
+    )
+    args = parser.parse_args()
+    if args.command == "report":
+        if args.window < 1:
+            parser.error("--window must be at least 1")
+        for option in ("since", "until"):
+            day = getattr(args, option)
+            if day:
+                try:
+                    setattr(args, option, rotation.get_week(datetime.strptime(day, "%Y-%m-%d")))
+                except ValueError:
+                    parser.error(f"--{option} must be a date, as yyyy-mm-dd")
+        if args.last is not None:
+            if args.since or args.until:
+                parser.error("--last can't be combined with --since or --until")
+            args.until = rotation.get_week(rotation.DATE + timedelta(weeks=1))
+            args.since = rotation.get_week(rotation.DATE - timedelta(weeks=args.last - 1))
+    return args
+
+
+def main():
+    args = parse_args()
+    try:
+        if args.command == "export" or not is_up_to_date(args.journal, args.columns):
+            rows = export_columns(args.journal, args.columns)
+            print(f"Exported {rows} rows from {args.journal} to {args.columns}", file=sys.stderr)
+    except FileNotFoundError as error:
+        sys.exit(f"Unable to read the journal: {error}")
+    if args.command == "report":
+        rows = select_weeks(load_columns(args.columns), args.since, args.until)
+        print_report(rows, args.window)
+
+
+if __name__ == "__main__":
+    main()
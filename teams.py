@@ -0,0 +1,178 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Runs the rotation of several teams at once. Expected usage:
+
+python teams.py teams/ --production  # takes the same options as rotation.py
+
+Each team is a JSON file in the directory, e.g. teams/perf.json:
+
+{
+  "roster": "../roster.json",
+  "history": "../rotations.jsonl",
+  "calendar_id": "mozilla.com_...@group.calendar.google.com",
+  "output": "../docs"
+}
+
+Paths are relative to the file. The name of the team is the name of the file unless "name" is
+given, and the calendar sync cache is kept in .gcal-sync-cache.<name>.json unless "sync_cache" is
+given. Every team needs its own history, output directory and calendar.
+
+Teams are planned, saved and rendered in parallel across a process pool, with one team per task.
+rotation.py keeps the roster and history paths in module globals, and pool workers are reused for
+other teams when there are more teams than --jobs, so run_team() sets all of them for the team it
+runs: the roster with rotation.use_roster(), the history, and the legacy pickle to migrate, which is
+looked for next to the history (e.g. ../rotations.pickle) rather than in the working directory.
+With --candidates, the processes that plan the candidates of a team are started with its roster
+too (see rotation.plan_best_candidate()).
+
+The calendar is then updated from this process with a single authenticated service, and the
+changes for every team are sent together (see gcal.reconcile_calendars()), so adding a team costs
+about one more list request rather than a whole run.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import timedelta
+from pathlib import Path
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import sys
+
+import rotation
+
+
+@dataclass
+class TeamConfig:
+    name: str
+    roster: Path
+    history: Path
+    calendar_id: str
+    output: Path
+    sync_cache: Path
+
+
+def load_team_config(path):
+    """Returns the TeamConfig in the JSON file at <path>."""
+    path = Path(path)
+    with path.open() as f:
+        config = json.load(f)
+    name = config.get("name", path.stem)
+    return TeamConfig(
+        name=name,
+        roster=path.parent / config["roster"],
+        history=path.parent / config["history"],
+        calendar_id=config["calendar_id"],
+        output=path.parent / config["output"],
+        sync_cache=Path(config.get("sync_cache", f".gcal-sync-cache.{name}.json")),
+    )
+
+
+def load_team_configs(directory):
+    """Returns the TeamConfig of every JSON file in <directory>, in name order. Raises ValueError if
+    two teams would share a history, output directory or calendar."""
+    configs = [load_team_config(path) for path in sorted(Path(directory).glob("*.json"))]
+    for field in ("name", "history", "output", "calendar_id", "sync_cache"):
+        values = [getattr(config, field) for config in configs]
+        if len(set(values)) != len(values):
+            raise ValueError(f"Teams in {directory} must each have their own {field}")
+    return configs
+
+
+def run_team(config, args):
+    """Plans, saves and renders the rotation of the team in <config> with the rotation.py <args>.
+    Returns (what rotation.py printed, the reminders to send): see rotation.get_reminders()."""
+    rotation.use_roster(config.roster)
+    rotation.SAVED_ROTATIONS_PATH = config.history
+    rotation.LEGACY_ROTATIONS_PATH = config.history.with_suffix(".pickle")
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output):
+        rotations = rotation.update_rotations(args, config.output)
+    next_week = rotation.get_week(rotation.DATE + timedelta(weeks=1))
+    return output.getvalue(), rotation.get_reminders(rotations, next_week)
+
+
+def run_teams(configs, args, jobs=None):
+    """Runs every team in <configs> across a process pool of <jobs> processes (default: one per
+    team, up to the number of CPUs), printing the output of each team in order. Returns a dict of
+    team name to reminders for the teams that succeeded."""
+    reminders = {}
+    jobs = jobs or min(len(configs), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(run_team, config, args) for config in configs]
+        for config, future in zip(configs, futures):
+            print(f"\n=== {config.name} ===")
+            try:
+                output, reminders[config.name] = future.result()
+            except Exception:
+                logging.exception(f"unable to update the rotation of {config.name}")
+                continue
+            print(output, end="")
+    return reminders
+
+
+def send_reminders(is_production, configs, reminders):
+    """Makes the calendar of each team match its <reminders>, with a single calendar service."""
+    configs = {config.name: config for config in configs if config.name in reminders}
+    if not is_production:
+        print("INFO: --production was not specified so not updating the calendars.")
+        for name, team_reminders in reminders.items():
+            print(f"{name}: {len(team_reminders)} reminders for {configs[name].calendar_id}")
+        return
+
+    import gcal
+
+    credentials = gcal.auth_as_user()
+    service = gcal.get_calendar_service(credentials)
+    changed = gcal.reconcile_calendars(
+        service,
+        {
+            name: (configs[name].calendar_id, team_reminders, configs[name].sync_cache)
+            for name, team_reminders in reminders.items()
+        },
+        credentials=credentials,
+    )
+    for name, count in changed.items():
+        print(f"{name}: calendar reminders are up to date ({count} changed)")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        epilog="Other options are passed on to rotation.py for every team."
+    )
+    parser.add_argument("teams", help="Directory of team configs")
+    parser.add_argument(
+        "--jobs", type=int, metavar="N", help="Run N teams at once (default: one per CPU)"
+    )
+    args, rest = parser.parse_known_args()
+    return args, rotation.parse_args(rest)
+
+
+def main():
+    args, team_args = parse_args()
+    logging.getLogger().setLevel(logging.DEBUG if team_args.debug else logging.INFO)
+    try:
+        configs = load_team_configs(args.teams)
+    except (OSError, KeyError, ValueError) as error:
+        sys.exit(f"Unable to load the team configs: {error!r}")
+    if not configs:
+        sys.exit(f"No team configs in {args.teams}")
+
+    reminders = run_teams(configs, team_args, args.jobs)
+    print("")
+    try:
+        send_reminders(team_args.production, configs, reminders)
+    except Exception:
+        # Like rotation.py, don't fail the job (and skip publishing) because of the calendar.
+        logging.exception("unable to update the calendar reminders")
+    if len(reminders) < len(configs):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
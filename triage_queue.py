@@ -0,0 +1,128 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Assigns a stream of bugs to the people on triage duty this week. Expected usage:
+
+python triage_queue.py bugs.ndjson --output assignments.ndjson
+bugzilla-export | python triage_queue.py - > assignments.ndjson
+
+The input has one JSON object per line for each bug, with its "id" and the options selected in the
+Performance Impact Calculator (see impact.py); other fields are ignored. Each bug is scored with
+the calculator's rules and assigned to the leader or one of the sheriffs of this week's rotation:
+every bug goes to whoever has the least work so far, counting a bug as IMPACT_WEIGHTS[impact]. The
+output has one JSON object per line with the bug's id, score, impact and assignee.
+
+Bugs are read, scored and written CHUNK_SIZE at a time, so memory use doesn't depend on the size of
+the export. This needs NumPy: pip install -r requirements-analysis.txt
+"""
+
+from datetime import datetime, timezone
+import argparse
+import heapq
+import itertools
+import json
+import sys
+
+import impact
+import rotation
+
+# Number of bugs scored at once.
+CHUNK_SIZE = 10_000
+
+# Roughly how much triage work a bug of each impact is.
+IMPACT_WEIGHTS = {"none": 1, "low": 2, "medium": 5, "high": 10}
+
+
+class Assigner:
+    """Assigns each bug to the person with the least work so far. Ties go to the sheriffs first,
+    in order, then to the leader, who also coordinates the triage."""
+
+    def __init__(self, rotation):
+        people = rotation.sheriffs + [rotation.leader]
+        self.people = people
+        self.load = [0] * len(people)
+        self.counts = [0] * len(people)
+        self._heap = [(0, i) for i in range(len(people))]
+
+    def assign(self, weight):
+        """Returns the person the next bug with <weight> is assigned to."""
+        load, i = heapq.heappop(self._heap)
+        self.load[i] = load + weight
+        self.counts[i] += 1
+        heapq.heappush(self._heap, (self.load[i], i))
+        return self.people[i]
+
+
+def read_chunks(f, size=CHUNK_SIZE):
+    """Yields lists of up to <size> bugs read from the NDJSON file <f>, skipping blank lines."""
+    records = (json.loads(line) for line in f if line.strip())
+    while chunk := list(itertools.islice(records, size)):
+        yield chunk
+
+
+def assign_bugs(rules, chunks, assigner):
+    """Yields an assignment for each bug in <chunks>, scoring a chunk at a time."""
+    fields = set(rules.fields()) | {impact.ID_FIELD}
+    for chunk in chunks:
+        bugs = [{k: v for k, v in bug.items() if k in fields} for bug in chunk]
+        scores, impacts, _ = impact.score_bugs(rules, impact.encode_bugs(rules, bugs))
+        for bug, score, bug_impact in zip(bugs, scores, impacts):
+            person = assigner.assign(IMPACT_WEIGHTS[bug_impact])
+            yield {
+                impact.ID_FIELD: bug.get(impact.ID_FIELD),
+                "score": float(score),
+                "impact": str(bug_impact),
+                "assignee": person.nick,
+            }
+
+
+def get_current_rotation(date):
+    """Returns the saved rotation for the week of <date>."""
+    week = rotation.get_week(date)
+    rotations = rotation.load_rotations(last=1, before=week)
+    if week not in rotations:
+        raise KeyError(f"No rotation saved for the week of {week}: run rotation.py first")
+    return rotations[week]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("bugs", help="NDJSON file of bugs, or - to read from stdin")
+    parser.add_argument("--output", help="Write the assignments to this file instead of stdout")
+    parser.add_argument(
+        "--date",
+        type=lambda d: datetime.strptime(d, "%Y-%m-%d").replace(tzinfo=timezone.utc),
+        default=rotation.DATE,
+        help="Assign to the rotation of the week of this date (yyyy-mm-dd, default: today)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    try:
+        assigner = Assigner(get_current_rotation(args.date))
+    except KeyError as error:
+        sys.exit(error.args[0])
+    rules = impact.load_rules()
+
+    source = sys.stdin if args.bugs == "-" else open(args.bugs)
+    output = open(args.output, "w") if args.output else sys.stdout
+    try:
+        for assignment in assign_bugs(rules, read_chunks(source), assigner):
+            output.write(json.dumps(assignment) + "\n")
+    except ValueError as error:
+        sys.exit(f"{args.bugs}: {error}")
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        if output is not sys.stdout:
+            output.close()
+
+    for person, count, load in zip(assigner.people, assigner.counts, assigner.load):
+        print(f"{person}: {count} bugs (weight {load})", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
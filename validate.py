@@ -0,0 +1,158 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at https://mozilla.org/MPL/2.0/.
+
+"""Checks that the saved rotations follow the rules generate_rotation() enforces. Expected usage:
+
+python validate.py  # checks rotations.jsonl
+python validate.py --since 2024-01-01 other.jsonl
+
+Every violation is printed with its week and person, and the exit status is 1 if there were any:
+- leaders have to be leads, and can't lead again within len(leaders) // 2 weeks;
+- nobody can be on duty within SHERIFF_COOLDOWN weeks of sheriffing, or sheriff within
+SHERIFF_COOLDOWN weeks of leading, and nobody is on duty twice in a week;
+- each sheriff has to be pairable with the people picked before them (see OverlapMatrix), using
+the working hours of that week like generate_rotation() does.
+
+Who leads, how many leaders there are and where people are change with the roster, and the rosters
+weeks were planned with aren't kept, only their ROSTER_VERSION. So the rules about leads, the lead
+cooldown and pairing are only checked for weeks planned with the current roster: a week planned
+before someone stopped leading or moved isn't a violation.
+
+The journal is read once, in the order it was written, and only the last weeks are kept in memory:
+a RotationIndex over the cooldown window to check each week, and the HOLDBACK_WEEKS most recent
+weeks, which aren't checked until a later record can no longer supersede them (see journal.py).
+The time taken is linear in the size of the journal, so this can run on every CI job.
+"""
+
+from dataclasses import dataclass
+import argparse
+import sys
+
+import journal
+import rotation
+
+# Weeks held back before being checked in case they are saved again, e.g. by --force or when
+# the roster changes. Larger than any --horizon in use.
+HOLDBACK_WEEKS = 52
+
+
+@dataclass
+class Violation:
+    week: str
+    person: rotation.Person  # None if the violation isn't about anyone in particular
+    message: str
+
+    def __str__(self):
+        if self.person is None:
+            return f"{self.week}: {self.message}"
+        return f"{self.week}: {self.person} {self.message}"
+
+
+def check_rotation(week, r, leaders, index, overlap):
+    """Yields the violations of rotation <r> for <week>, given the earlier weeks in <index>. The
+    rules that depend on the roster are only checked if <r> was planned with the current one."""
+    same_roster = r.roster == rotation.ROSTER_VERSION
+    lead_cooldown = len(leaders) // 2
+    if same_roster and not r.leader.lead:
+        yield Violation(week, r.leader, "leads but isn't a lead")
+    if same_roster and (led := index.led_within(r.leader, lead_cooldown)):
+        yield Violation(week, r.leader, f"leads within {lead_cooldown} weeks of leading on {led}")
+    if sheriffed := index.sheriffed_within(r.leader, rotation.SHERIFF_COOLDOWN):
+        yield Violation(
+            week,
+            r.leader,
+            f"leads within {rotation.SHERIFF_COOLDOWN} weeks of sheriffing on {sheriffed}",
+        )
+
+    picked = [r.leader]
+    for sheriff in r.sheriffs:
+        if sheriff in picked:
+            yield Violation(week, sheriff, "is on duty twice")
+        if on_duty := (
+            index.led_within(sheriff, rotation.SHERIFF_COOLDOWN)
+            or index.sheriffed_within(sheriff, rotation.SHERIFF_COOLDOWN)
+        ):
+            yield Violation(
+                week,
+                sheriff,
+                f"sheriffs within {rotation.SHERIFF_COOLDOWN} weeks of being on duty on {on_duty}",
+            )
+        timezones = overlap.allowed(picked) if same_roster else None
+        if timezones is not None and sheriff.get_tz() not in timezones:
+            yield Violation(week, sheriff, f"can't be paired with {picked}")
+        picked.append(sheriff)
+
+
+def validate(records, leaders, since=None, holdback=HOLDBACK_WEEKS):
+    """Yields the violations in <records>, journal records in the order they were appended. Weeks
+    before <since> are only used as history for the weeks after them."""
+    index = rotation.RotationIndex(rotation.history_window(leaders))
+    timezones = frozenset(p.get_tz() for p in rotation.ROSTER.values())
+    pending = {}  # week -> record, in week order
+    checked = None  # the last week checked
+
+    def check(week, record):
+        try:
+            r = rotation.rotation_from_record(record)
+        except KeyError as error:
+            yield Violation(week, None, f"has someone who isn't in the roster (id {error})")
+            return
+        if since is None or week >= since:
+            overlap = rotation.get_overlap_matrix(timezones, week)
+            yield from check_rotation(week, r, leaders, index, overlap)
+        index.add(week, r)
+
+    for record in records:
+        week = record["week"]
+        if week in pending:
+            pending[week] = record  # Supersedes the earlier record.
+        elif checked is not None and week <= checked:
+            yield Violation(week, None, f"is saved again after {holdback} later weeks")
+        elif pending and week < next(reversed(pending)):
+            yield Violation(week, None, "is saved out of week order")
+        else:
+            pending[week] = record
+            if len(pending) > holdback:
+                checked = next(iter(pending))
+                yield from check(checked, pending.pop(checked))
+    for week, record in pending.items():
+        yield from check(week, record)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "journal",
+        nargs="?",
+        default=rotation.SAVED_ROTATIONS_PATH,
+        help="Rotation journal to check (default: %(default)s)",
+    )
+    parser.add_argument("--since", metavar="WEEK", help="Only report violations from this week on")
+    parser.add_argument(
+        "--holdback",
+        type=int,
+        default=HOLDBACK_WEEKS,
+        metavar="N",
+        help="Weeks a record can be superseded for before it is checked (default: %(default)s)",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    leaders = [m for m in rotation.MEMBERS if m.lead]
+    count = 0
+    try:
+        records = journal.iter_records(args.journal)
+        for violation in validate(records, leaders, args.since, args.holdback):
+            sys.stdout.write(f"{violation}\n")
+            count += 1
+    except (OSError, journal.JournalError) as error:
+        sys.exit(error)
+    print(f"{count} violations" if count else "No violations", file=sys.stderr)
+    sys.exit(1 if count else 0)
+
+
+if __name__ == "__main__":
+    main()